@@ -0,0 +1,133 @@
+"""
+Memory (and time) used by the Condition and Patient summaries for a large
+number of distinct codes.
+
+    python benchmarks/memory.py [--codes 100000] [--conditions 300000] 
+                                [--populations 3]
+
+Each condition carries a data-dictionary coding along with its HPO/MONDO 
+coding, as the Whistle output does, so ChooseCode has a choice to make.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+import random
+import time
+import tracemalloc
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from summfhir.condition import Condition
+from summfhir.interning import ResetInterning
+from summfhir.patient import Patient
+
+def BuildCondition(index, code, subject):
+    prefix = "HP" if code % 2 == 0 else "MONDO"
+    return {
+        "resourceType": "Condition",
+        "id": f"c{index}",
+        "identifier": [{
+            "system": "https://example.org/fhir/condition",
+            "value": f"c{index}"
+        }],
+        "subject": {
+            "reference": f"Patient/p{subject}"
+        },
+        "verificationStatus": {
+            "coding": [{
+                "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status",
+                "code": random.choice(["confirmed", "confirmed", "confirmed", "refuted"])
+            }]
+        },
+        "code": {
+            "coding": [{
+                "system": "https://example.org/fhir/CodeSystem/data-dictionary/conditions",
+                "code": f"cond-{code}",
+                "display": f"Condition {code}"
+            }, {
+                "system": f"http://purl.obolibrary.org/obo/{prefix.lower()}.owl",
+                "code": f"{prefix}:{code:07d}",
+                "display": f"Condition {code}"
+            }],
+            "text": f"Condition {code}"
+        }
+    }
+
+def BuildPatient(index):
+    return {
+        "resourceType": "Patient",
+        "id": f"p{index}",
+        "identifier": [{
+            "system": "https://example.org/fhir/patient",
+            "value": f"p{index}"
+        }],
+        "gender": random.choice(["female", "male", "unknown"]),
+        "extension": [{
+            "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
+            "extension": [{
+                "url": "ombCategory",
+                "valueCoding": {
+                    "system": "urn:oid:2.16.840.1.113883.6.238",
+                    "code": "2106-3",
+                    "display": "White"
+                }
+            }]
+        }]
+    }
+
+def Measure(label, build):
+    # Memory is measured first so that it includes whatever gets interned.
+    # Tracing slows everything down considerably, so the time comes from a
+    # second run. Each run starts afresh, as a new study would
+    ResetInterning()
+    tracemalloc.start()
+    result = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    ResetInterning()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<12} {current / 1048576.0:8.1f}MB retained {peak / 1048576.0:8.1f}MB peak {elapsed:7.2f}s")
+    return result
+
+def exec():
+    parser = ArgumentParser(description="Memory used by the Patient and Condition summaries")
+    parser.add_argument("--codes", type=int, default=100000)
+    parser.add_argument("--conditions", type=int, default=300000)
+    parser.add_argument("--patients", type=int, default=50000)
+    parser.add_argument("--populations", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    # The resources are built as they are summarized, just as they would
+    # arrive a page at a time, so that anything the summaries hold on to
+    # is counted. Building them is included in the times
+    def summarize_conditions():
+        random.seed(args.seed)
+        summaries = [Condition() for i in range(args.populations)]
+        for i in range(args.conditions):
+            condition = BuildCondition(i, random.randrange(args.codes), random.randrange(args.patients))
+            for summary in summaries:
+                summary.add_resource(condition)
+        return summaries
+
+    def summarize_patients():
+        random.seed(args.seed)
+        summaries = [Patient() for i in range(args.populations)]
+        for i in range(args.patients):
+            patient = BuildPatient(i)
+            for summary in summaries:
+                summary.add_resource(patient)
+        return summaries
+
+    print(f"{args.conditions} conditions with {args.codes} distinct codes, "
+        f"{args.patients} patients, {args.populations} populations")
+    Measure("Conditions", summarize_conditions)
+    Measure("Patients", summarize_patients)
+
+if __name__ == "__main__":
+    exec()
@@ -0,0 +1,230 @@
+"""
+Micro-benchmarks for the summarization hot paths, run against a synthetic
+study (see summfhir/synthetic.py).
+
+    python benchmarks/suite.py [--patients 20000] [--repeat 3]
+                               [--save results.json] [--baseline results.json]
+
+Each benchmark reports its throughput (best of --repeat runs) and the peak
+memory allocated during a separate, traced run. Results saved with --save
+can be passed back as --baseline to see how each throughput has changed.
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from pathlib import Path
+import io
+import json
+import tempfile
+import time
+import tracemalloc
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from summfhir import InitMetaTag, SetInputClient
+from summfhir.ndjson_client import NdjsonClient
+from summfhir.synthetic import SyntheticStudy
+from summfhir.patient import Patient
+from summfhir.condition import Condition
+from summfhir.population import Population
+from summfhir.summary import ChooseCode
+from summfhir.observation_source import SourceTable, SelectKeyCode
+from summfhir.terminology import InitTerminologyCache, CacheReference
+
+class Benchmark:
+    def __init__(self, name, run, items):
+        self.name = name
+
+        # Called with no arguments, run does the work being measured
+        self.run = run
+
+        # The number of items (resources, codings, summaries) run handles
+        self.items = items
+
+    def measure(self, repeat):
+        tracemalloc.start()
+        self.run()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            self.run()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return {
+            "items": self.items,
+            "seconds": best,
+            "throughput": self.items / best,
+            "peak_mb": peak / 1048576.0
+        }
+
+def BuildBenchmarks(study):
+    InitMetaTag(study.tag_system, study.tag)
+
+    # The ValueSets go straight into the terminology cache so that building
+    # the tables never needs to read from the (empty) client
+    client = NdjsonClient(tempfile.mkdtemp())
+    SetInputClient(client)
+    cache = InitTerminologyCache(None)
+    for valueset in study.value_sets():
+        cache.put(CacheReference(f"ValueSet/{valueset['id']}", client), "",
+                    valueset['expansion']['contains'])
+
+    patients = list(study.patient_resources())
+    conditions = list(study.condition_resources())
+    rows = list(study.source_rows())
+    activity_definitions = list(study.activity_definitions())
+    observation_definitions = list(study.observation_definitions())
+    population = Population(next(study.groups()))
+
+    codings = [condition['code']['coding'] for condition in conditions]
+    component_codes = [component['code'] for row in rows for component in row['component']]
+    components = sum(len(row['component']) for row in rows)
+
+    def summarize_patients():
+        summary = Patient()
+        for patient in patients:
+            summary.add_resource(patient)
+        return summary
+
+    def summarize_conditions():
+        summary = Condition()
+        for condition in conditions:
+            summary.add_resource(condition)
+        return summary
+
+    def choose_codes():
+        for coding in codings:
+            ChooseCode(coding)
+
+    def select_key_codes():
+        for code in component_codes:
+            SelectKeyCode(code)
+
+    def build_tables():
+        with redirect_stdout(io.StringIO()):
+            return [SourceTable(ad, observation_definitions) for ad in activity_definitions]
+
+    def summarize_rows():
+        tables = build_tables()
+        for row in rows:
+            for table in tables:
+                table.ParseData(row)
+        return tables
+
+    # Rows already routed to their table (as SourceRouter does), which is
+    # just the per-component dispatch and parsing
+    routed = build_tables()
+    by_table = dict([(table.table_name, table) for table in routed])
+    routed_rows = [(by_table[row['code']['coding'][1]['code']], row) for row in rows]
+
+    def parse_rows():
+        for table, row in routed_rows:
+            table.ParseRow(row)
+
+    # Only the coded components, handed straight to their parsers
+    coded = []
+    for table, row in routed_rows:
+        for component in row['component']:
+            parser = table.observation_definitions[SelectKeyCode(component['code'])]
+            if 'valueCodeableConcept' in component and hasattr(parser, 'value_counts'):
+                coded.append((parser, component))
+
+    def parse_coded():
+        for parser, component in coded:
+            parser.ParseData(component)
+
+    patient_summary = summarize_patients()
+    condition_summary = summarize_conditions()
+    tables = summarize_rows()
+
+    def build_observations(summaries):
+        def build():
+            for summary in summaries:
+                summary.BuildSummaryObservations(population)
+        return build, sum(len(summary.BuildSummaryObservations(population)) for summary in summaries)
+
+    build_patients, patient_observations = build_observations([patient_summary])
+    build_conditions, condition_observations = build_observations([condition_summary])
+    build_sources, source_observations = build_observations(tables)
+
+    return [
+        Benchmark("Patient.add_resource", summarize_patients, len(patients)),
+        Benchmark("Condition.add_resource", summarize_conditions, len(conditions)),
+        Benchmark("ChooseCode", choose_codes, len(codings)),
+        Benchmark("SelectKeyCode", select_key_codes, len(component_codes)),
+        Benchmark("SourceTable.ParseData", summarize_rows, len(rows)),
+        Benchmark("SourceTable.ParseRow (components)", parse_rows, components),
+        Benchmark("ComponentValueSetParser.ParseData", parse_coded, len(coded)),
+        Benchmark("Patient.BuildSummaryObservations", build_patients, patient_observations),
+        Benchmark("Condition.BuildSummaryObservations", build_conditions, condition_observations),
+        Benchmark("SourceTable.BuildSummaryObservations", build_sources, source_observations)
+    ]
+
+def exec():
+    parser = ArgumentParser(description="Throughput and peak memory of the "
+                    "summarization hot paths")
+    parser.add_argument("--patients", type=int, default=20000)
+    parser.add_argument("--conditions-per-patient", type=int, default=3)
+    parser.add_argument("--condition-codes", type=int, default=5000)
+    parser.add_argument("--tables", type=int, default=4)
+    parser.add_argument("--variables", type=int, default=12)
+    parser.add_argument("--rows-per-patient", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3,
+        help="Number of timed runs of each benchmark, of which the best is "
+            "reported")
+    parser.add_argument("--only", type=str, default=None,
+        help="Only run the benchmarks whose names contain this")
+    parser.add_argument("--save", type=str, default=None,
+        help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None,
+        help="Compare the throughput against results written by --save")
+    args = parser.parse_args()
+
+    study = SyntheticStudy(patients=args.patients,
+                            conditions_per_patient=args.conditions_per_patient,
+                            condition_codes=args.condition_codes,
+                            tables=args.tables,
+                            variables=args.variables,
+                            rows_per_patient=args.rows_per_patient,
+                            seed=args.seed)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'rt') as inf:
+            baseline = json.load(inf)['results']
+
+    print(f"{args.patients} patients, {args.condition_codes} condition codes, "
+        f"{args.tables} tables of {args.variables} variables")
+    print(f"{'':<38} {'items':>9} {'seconds':>9} {'items/s':>12} {'peak':>9}")
+
+    results = {}
+    for benchmark in BuildBenchmarks(study):
+        if args.only is not None and args.only not in benchmark.name:
+            continue
+
+        result = benchmark.measure(args.repeat)
+        results[benchmark.name] = result
+
+        change = ""
+        if benchmark.name in baseline:
+            ratio = result['throughput'] / baseline[benchmark.name]['throughput']
+            change = f" {(ratio - 1.0) * 100.0:+7.1f}%"
+        print(f"{benchmark.name:<38} {result['items']:>9} {result['seconds']:>9.3f} "
+            f"{result['throughput']:>12.0f} {result['peak_mb']:>7.1f}MB{change}")
+
+    if args.save is not None:
+        with open(args.save, 'wt') as outf:
+            json.dump({
+                "settings": vars(args),
+                "results": results
+            }, outf, indent=2)
+
+if __name__ == "__main__":
+    exec()
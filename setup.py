@@ -15,9 +15,15 @@ setup(
     packages=find_namespace_packages(),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'columnar': ['numpy'],
+        'fast-output': ['orjson', 'zstandard']
+    },
     entry_points={
         'console_scripts': [
-            'summarize = summfhir.summarize:exec'
+            'summarize = summfhir.summarize:exec',
+            'summarize-synthetic = summfhir.synthetic:exec',
+            'summarize-standin = summfhir.standin:exec'
         ]
     }
 )
@@ -87,6 +87,7 @@ def SetInputClient(fhir_client):
         _fhir_output = fhir_client
 
 def SetOutputClient(fhir_client):
+    global _fhir_output
     _fhir_output = fhir_client
 
 def GetInputClient():
@@ -0,0 +1,261 @@
+"""
+Columnar summarization of source table rows.
+
+Rather than handing each component of each row to its variable's parser, the
+rows for a table are decoded into a column per variable (category codes as
+indices into the ValueSet, quantities as float64) and each batch of rows is
+summarized with NumPy. The results are folded into the very same parsers the
+row at a time path uses, so the summaries are identical either way:
+
+    * Category counts come from bincount
+    * Sums (and sums of squares) are computed exactly, by adding up the
+      values' integer mantissas for each exponent, and added to the parser's
+      ExactSum as the handful of doubles that represent the exact total
+    * Quantile sketch buckets are counted with unique, checking any value
+      which falls right on a bucket boundary with math.log so that it lands
+      in the same bucket it would have otherwise
+
+Anything that doesn't vectorize (strings, values that aren't in the data
+dictionary) is passed to the parser's ParseData as before.
+
+NumPy is optional. Without it, we stick with the row at a time path.
+"""
+
+from summfhir.stats import TwoProduct
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# The number of rows to collect for a table before summarizing them
+BATCH_SIZE = 10000
+
+_columnar = False
+
+def UseColumnar(enabled):
+    global _columnar
+    if enabled and np is None:
+        print("The columnar engine requires NumPy, which isn't installed. "
+            "Continuing one row at a time.")
+        enabled = False
+    _columnar = enabled
+
+def ColumnarEnabled():
+    return _columnar
+
+def ExactPartials(values):
+    """Doubles whose (exact) sum is exactly the sum of the values"""
+    if len(values) == 0:
+        return []
+
+    mantissas, exponents = np.frexp(values)
+
+    # Each value is mantissa * 2^(exponent - 53) with a 53 bit integer
+    # mantissa, which we split into 27 and 26 bit halves so that a great many
+    # of them can be added up as int64 without overflowing
+    mantissas = np.ldexp(mantissas, 53).astype(np.int64)
+    high = mantissas >> 26
+    low = mantissas & ((1 << 26) - 1)
+
+    order = np.argsort(exponents, kind='stable')
+    exponents = exponents[order]
+    starts = np.flatnonzero(np.r_[True, exponents[1:] != exponents[:-1]])
+    high_sums = np.add.reduceat(high[order], starts)
+    low_sums = np.add.reduceat(low[order], starts)
+
+    base = int(exponents[0])
+    total = 0
+    for exponent, high_sum, low_sum in zip(exponents[starts], high_sums, low_sums):
+        total += ((int(high_sum) << 26) + int(low_sum)) << (int(exponent) - base)
+    scale = base - 53
+
+    # Peel off 53 bits at a time, each of which is exactly one double
+    partials = []
+    while total != 0:
+        shift = max(total.bit_length() - 53, 0)
+        top = total >> shift
+        partials.append(math.ldexp(float(top), scale + shift))
+        total -= top << shift
+    return partials
+
+def TwoProducts(a, b):
+    """Vectorized TwoProduct (see stats.py)"""
+    p = a * b
+    c = 134217729.0 * a
+    ahi = c - (c - a)
+    alo = a - ahi
+    c = 134217729.0 * b
+    bhi = c - (c - b)
+    blo = b - bhi
+    return p, ((ahi * bhi - p) + ahi * blo + alo * bhi) + alo * blo
+
+def SketchKeys(sketch, magnitudes):
+    """The sketch's bucket keys for the (positive) values, exactly as """
+    """sketch.key() would compute them"""
+    ratios = np.log(magnitudes) / sketch.log_gamma
+    keys = np.ceil(ratios)
+
+    # NumPy's log may differ from math.log in the last place, which only
+    # matters when the ratio is (nearly) a whole number
+    for i in np.flatnonzero(np.abs(ratios - np.rint(ratios)) < 1e-6):
+        keys[i] = sketch.key(float(magnitudes[i]))
+    return keys.astype(np.int64)
+
+def CountKeys(buckets, keys):
+    unique, counts = np.unique(keys, return_counts=True)
+    for key, count in zip(unique.tolist(), counts.tolist()):
+        buckets[key] = buckets.get(key, 0) + count
+
+class RawColumn:
+    """Components that are handed to the parser as they are"""
+    def __init__(self):
+        self.raw = []
+
+    def append(self, component):
+        self.raw.append(component)
+
+    def apply(self, parsers):
+        for parser in parsers:
+            for component in self.raw:
+                parser.ParseData(component)
+        self.raw = []
+
+class CategoryColumn(RawColumn):
+    def __init__(self, valid_values):
+        super().__init__()
+        self.codes = list(valid_values.keys())
+
+        # code => (system, index into codes)
+        self.index = dict([(code, (valid_values[code].system, i)) for i, code in enumerate(self.codes)])
+        self.indices = []
+
+    def append(self, component):
+        if 'valueString' not in component and 'valueCodeableConcept' in component:
+            for coding in component['valueCodeableConcept']['coding']:
+                if 'code' not in coding:
+                    break
+                valid = self.index.get(coding['code'])
+                if valid is not None:
+                    system, index = valid
+                    if 'system' not in coding:
+                        break
+                    if coding['system'] == system:
+                        self.indices.append(index)
+                        return
+
+        # Mismatches and anything unexpected are the parser's business
+        self.raw.append(component)
+
+    def apply(self, parsers):
+        if len(self.indices) > 0:
+            counts = np.bincount(np.array(self.indices, dtype=np.int64), minlength=len(self.codes))
+            for i in np.flatnonzero(counts).tolist():
+                for parser in parsers:
+                    parser.value_counts[self.codes[i]] += int(counts[i])
+        self.indices = []
+        super().apply(parsers)
+
+class QuantityColumn(RawColumn):
+    def __init__(self):
+        super().__init__()
+        self.values = []
+
+    def append(self, component):
+        if 'valueQuantity' in component:
+            self.values.append(component['valueQuantity']['value'])
+        else:
+            self.raw.append(component)
+
+    def apply(self, parsers):
+        if len(self.values) > 0:
+            values = np.array(self.values, dtype=np.float64)
+            sums = ExactPartials(values)
+            with np.errstate(over='ignore', invalid='ignore'):
+                high, low = TwoProducts(values, values)
+            if np.isfinite(high).all() and np.isfinite(low).all():
+                squares = ExactPartials(high) + ExactPartials(low)
+            else:
+                # Some squares overflow, which the exact sums can't represent, 
+                # so they're added just as the row at a time path adds them
+                squares = [term for x in self.values for term in TwoProduct(x, x)]
+
+            # The extremes are taken from the original values so that they
+            # come out exactly as they went in (ints stay ints)
+            smallest = self.values[int(np.argmin(values))]
+            largest = self.values[int(np.argmax(values))]
+
+            positive = values[values > 0]
+            negative = -values[values < 0]
+            zeros = len(values) - len(positive) - len(negative)
+
+            for parser in parsers:
+                parser.count += len(values)
+
+                moments = parser.moments
+                moments.count += len(values)
+                moments.sum.add_many(sums)
+                moments.squares.add_many(squares)
+
+                sketch = parser.quantiles
+                sketch.count += len(values)
+                sketch.zeros += zeros
+                CountKeys(sketch.positive, SketchKeys(sketch, positive))
+                CountKeys(sketch.negative, SketchKeys(sketch, negative))
+                if sketch.min is None or smallest < sketch.min:
+                    sketch.min = smallest
+                if sketch.max is None or largest > sketch.max:
+                    sketch.max = largest
+        self.values = []
+        super().apply(parsers)
+
+class ColumnarTable:
+    """Collects the rows for one table as columns, summarizing them into """
+    """each copy of the table (one per population) a batch at a time"""
+    def __init__(self, tables):
+        self.tables = tables
+        template = tables[0]
+
+        # variable code => column
+        self.columns = {}
+        for code, parser in template.observation_definitions.items():
+            self.columns[code] = parser.column()
+
+        # (system, code) of the component's code => variable code
+        self.variables = dict([(key, code) for key, (code, parser) in template.variables.items()])
+        self.variable_code = template.variable_code
+        self.rows = 0
+
+    def add_row(self, resource):
+        columns = []
+        for component in resource['component']:
+            coding = component['code']['coding'][0]
+            key = (coding['system'], coding['code'])
+            code = self.variables.get(key)
+            if code is None:
+                code = self.variable_code(component['code'])
+                self.variables[key] = code
+
+            column = self.columns.get(code)
+            if column is None:
+                # Let the row path complain about variables it doesn't know
+                self.flush()
+                for table in self.tables:
+                    table.ParseRow(resource)
+                return
+            columns.append((column, component))
+
+        for column, component in columns:
+            column.append(component)
+        self.rows += 1
+        if self.rows >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        for table in self.tables:
+            table.n += self.rows
+        self.rows = 0
+
+        for code, column in self.columns.items():
+            column.apply([table.observation_definitions[code] for table in self.tables])
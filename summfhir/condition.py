@@ -4,43 +4,72 @@ Summarize conditions associated with a select group of patients
 
 from summfhir import MetaTag
 from summfhir.summary import Summary, ChooseCode
+from summfhir.interning import (CountMatrix, InternCodeableConcept, InternPackedConcept,
+                                UnpackCodeableConcept)
 from summfhir.terms import VAR_SUM_CC, COUNT
 from copy import deepcopy
 
 
 class Condition(Summary):
-    def __init__(self, conditions):
+    # The only elements we look at, so there's no reason to pull the rest
+    ELEMENTS = ["id", "identifier", "subject", "code", "verificationStatus"]
+
+    def __init__(self, conditions=None):
         super().__init__()
 
+        # code => verification status => count, kept as arrays since there 
+        # may be a great many codes
+        self.counts = CountMatrix()
+
+        # observed_codes holds code => packed CodeableConcept (see interning)
+
+        # This gets set from the first resource we see, which allows conditions
+        # to be streamed in one at a time rather than handed over as a list
+        self.identifier_system = None
+
+        if conditions is not None:
+            for resource in conditions:
+                self.add_resource(resource)
+
+    def add_resource(self, resource):
         # Let's grab some identifier details from the first resource as a 
         # starting point for a system to use inside each of our summary objects
-        self.identifier_system = conditions[0]['identifier'][0]['system'] + "/summary"
+        if self.identifier_system is None:
+            self.identifier_system = resource['identifier'][0]['system'] + "/summary"
 
-        for resource in conditions:
-            self.add_resource(resource)
+        self.resource_count += 1
 
-    def add_resource(self, resource):
         # Skip any that have a verificationStatus that isn't confirmed
         verstat = "confirm"
         if "verificationStatus" in resource:
             verstat = resource['verificationStatus']['coding'][0]['code']
 
             if verstat not in self.observed_codes:
-                self.observed_codes[verstat] = resource['verificationStatus']
+                self.observed_codes[verstat] = InternCodeableConcept(verstat, resource['verificationStatus'])
 
+        contribution = []
         cc = ChooseCode(resource['code']['coding'])
         if cc is not None:
             code = cc['code']
             if code not in self.observed_codes:
-                self.observed_codes[code] = deepcopy(resource['code'])
+                self.observed_codes[code] = InternCodeableConcept(code, resource['code'])
                 
             self.counts[code][verstat] += 1
+            contribution.append((code, verstat))
+
+        return contribution
+
+    def merge_observed_codes(self, other):
+        # Conditions keep their codings directly under the code
+        for code, packed in other.observed_codes.items():
+            if code not in self.observed_codes:
+                self.observed_codes[code] = InternPackedConcept(code, packed)
 
     def return_text_results(self):        
         result = f""
 
         for code in sorted(self.counts.keys()):
-            display = self.observed_codes[code]['coding'][0]['display']
+            display = UnpackCodeableConcept(self.observed_codes[code])['coding'][0]['display']
             result += f"  {code}: {self.counts[code]['confirmed']} ({display})\n"
 
         return result
@@ -68,7 +97,7 @@ class Condition(Summary):
                 "value": f"{population.id}.{code}"
             }]
 
-            summary['valueCodeableConcept'] = self.observed_codes[code]
+            summary['valueCodeableConcept'] = UnpackCodeableConcept(self.observed_codes[code])
             summary['subject'] = {
                 "reference": f"Group/{population.id}"
             }
@@ -0,0 +1,575 @@
+"""
+Page-at-a-time access to FHIR searches.
+
+Rather than letting the client walk every page of a search and hand back one
+enormous result, we ask for a single Bundle at a time and follow the 'next'
+link ourselves. Callers iterate over resources as they arrive, so the most we
+ever hold is one page (plus those prefetched), regardless of how large the 
+study is.
+
+While the caller summarizes a page, the next few are fetched in a background
+thread, so waiting on the server overlaps with summarizing rather than 
+alternating with it. The queue of prefetched pages is bounded, so a slow
+consumer holds the fetching back rather than piling up pages.
+
+Following next links keeps a search to one request at a time, however large
+it is. When the server pages by offset into a stored result set (as HAPI 
+does), the remaining offsets are instead split between several threads, each
+fetching a disjoint range, so that several pages are in flight at once.
+"""
+
+from summfhir import GetInputClient
+from urllib.parse import urlencode, urlparse, urlunparse, parse_qs
+from time import perf_counter
+import threading
+import queue
+import json
+
+# Cleared if the server rejects _elements, after which we ask for everything
+_elements_supported = True
+
+# Query (without _elements) => ProjectionStats
+_projection_stats = {}
+
+# The number of pages fetched ahead of the one being summarized. 0 turns
+# prefetching off
+DEFAULT_PREFETCH_PAGES = 2
+_prefetch_pages = DEFAULT_PREFETCH_PAGES
+
+def SetPrefetchPages(pages):
+    global _prefetch_pages
+    _prefetch_pages = pages
+
+# The number of pages of a large search fetched at once (see 
+# PartitionedPages). 1 follows the next links one page at a time
+DEFAULT_SEARCH_PARTITIONS = 4
+_search_partitions = DEFAULT_SEARCH_PARTITIONS
+
+def SetSearchPartitions(partitions):
+    global _search_partitions
+    _search_partitions = partitions
+
+# Bounds on the _count chosen for the pages of partitioned searches
+MIN_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+# Pages grow until the per-request overhead is no more than this share of
+# the time a page takes, so long as they stay under MAX_PAGE_BYTES
+PAGE_OVERHEAD = 0.1
+MAX_PAGE_BYTES = 8 * 1048576
+
+# One page in this many is measured for its payload size
+PAYLOAD_SAMPLE = 16
+
+class IncompleteSearch(Exception):
+    pass
+
+def UseElements(enabled):
+    """Turn projection (_elements) on or off for all subsequent searches"""
+    global _elements_supported
+    _elements_supported = enabled
+
+def AddParameter(query, name, value):
+    separator = "&" if "?" in query else "?"
+    return f"{query}{separator}{name}={value}"
+
+def PayloadSize(response):
+    """Our client hands back parsed JSON, so we measure the compact """
+    """serialization, which is close to what came over the wire"""
+    return len(json.dumps(response, separators=(',', ':')))
+
+def IsSubsetted(resource):
+    for tag in resource.get('meta', {}).get('tag', []):
+        if tag.get('code') == "SUBSETTED":
+            return True
+    return False
+
+class ProjectionStats:
+    """Tracks what a projected search returned. The first page is also """
+    """requested without _elements so that we have a measured basis for """
+    """estimating how much the projection saved. Serializing every page """
+    """just to measure it is expensive, so only one page in PAYLOAD_SAMPLE """
+    """is measured and the bytes received are scaled up from those"""
+    def __init__(self, query, elements, label=None):
+        # The query sampled, and the name it is reported under
+        self.query = query
+        self.label = query if label is None else label
+        self.elements = elements
+        self.pages = 0
+        self.resources = 0
+
+        # Size and resource count of the pages measured
+        self.measured_bytes = 0
+        self.measured_resources = 0
+
+        # Bytes per resource for the sample page with and without _elements
+        self.projected_sample = None
+        self.full_sample = None
+
+        # Did the server mark the resources as SUBSETTED?
+        self.subsetted = False
+
+    def record_page(self, response, entries):
+        if self.measured_resources == 0 or self.pages % PAYLOAD_SAMPLE == 0:
+            self.measured_bytes += PayloadSize(response)
+            self.measured_resources += len(entries)
+        self.pages += 1
+        self.resources += len(entries)
+
+        if len(entries) > 0 and IsSubsetted(entries[0].get('resource', {})):
+            self.subsetted = True
+
+    def sample(self, projected_response, projected_entries, client):
+        if len(projected_entries) == 0:
+            return
+        result = client.get(self.query, recurse=False)
+        if result.success() and len(result.entries) > 0:
+            self.projected_sample = PayloadSize(projected_response) / len(projected_entries)
+            self.full_sample = PayloadSize(result.response) / len(result.entries)
+
+    def merge(self, other):
+        """Add the pages of the same search made in another process"""
+        self.pages += other.pages
+        self.resources += other.resources
+        self.measured_bytes += other.measured_bytes
+        self.measured_resources += other.measured_resources
+        self.subsetted = self.subsetted or other.subsetted
+        if self.full_sample is None:
+            self.projected_sample = other.projected_sample
+            self.full_sample = other.full_sample
+
+    @property
+    def bytes(self):
+        """Estimated bytes received across all the pages"""
+        if self.measured_resources == 0:
+            return self.measured_bytes
+        return int(self.resources * self.measured_bytes / self.measured_resources)
+
+    def bytes_saved(self):
+        if self.full_sample is None:
+            return 0
+        return int(self.resources * (self.full_sample - self.projected_sample))
+
+    def report(self):
+        saved = self.bytes_saved()
+        full = self.bytes + saved
+        pct = 0.0
+        if full > 0:
+            pct = 100.0 * saved / full
+
+        honored = ""
+        if not self.subsetted and saved <= 0:
+            honored = " (server appears to ignore _elements)"
+        return f"{self.label}\n" + \
+            f"    {self.resources} resources in {self.pages} pages, " + \
+            f"~{self.bytes / 1048576.0:.2f}MB received, " + \
+            f"~{saved / 1048576.0:.2f}MB ({pct:.1f}%) saved{honored}\n"
+
+def GetProjectionStats():
+    return _projection_stats
+
+def ResetProjectionStats():
+    _projection_stats.clear()
+
+def MergeProjectionStats(projection_stats):
+    """Fold in the ProjectionStats (query => stats) of another process"""
+    for query, stats in projection_stats.items():
+        if query in _projection_stats:
+            _projection_stats[query].merge(stats)
+        else:
+            _projection_stats[query] = stats
+
+def ProjectionReport():
+    report = ""
+    for query in _projection_stats:
+        report += _projection_stats[query].report()
+    return report
+
+def NextLink(bundle):
+    """Return the URL of the next page of a search Bundle (or None)"""
+    if bundle is None:
+        return None
+
+    for link in bundle.get('link', []):
+        if link.get('relation') == 'next':
+            return link.get('url')
+    return None
+
+def PageResults(query, client=None, elements=None, label=None):
+    """Yield the client's result for each page of the search, one page at a """
+    """time. If elements is provided, only those elements are requested, """
+    """and the projection stats are kept under label (the query, unless """
+    """provided). A failure on any page, the first included, raises """
+    """IncompleteSearch, since an empty or partial answer would look like """
+    """a complete one"""
+    global _elements_supported
+    if client is None:
+        client = GetInputClient()
+    if label is None:
+        label = query
+
+    stats = None
+    base_query = query
+    if elements is not None and _elements_supported:
+        query = AddParameter(query, "_elements", ",".join(elements))
+        if label not in _projection_stats:
+            _projection_stats[label] = ProjectionStats(base_query, elements, label)
+        stats = _projection_stats[label]
+
+    first_page = True
+    while query is not None:
+        result = client.get(query, recurse=False)
+        if not result.success():
+            if first_page and stats is not None and result.status_code == 400:
+                # Some servers reject _elements outright, so we'll just ask
+                # for everything from now on
+                print(f"The server rejected _elements ({result.status_code}). "
+                    "Requesting complete resources.")
+                _elements_supported = False
+                del _projection_stats[label]
+                stats = None
+                query = base_query
+                continue
+            if first_page:
+                raise IncompleteSearch(f"{base_query} failed ({result.status_code})")
+            raise IncompleteSearch(f"{base_query} failed part way through "
+                f"({result.status_code})")
+
+        if stats is not None:
+            stats.record_page(result.response, result.entries)
+            if first_page and stats.full_sample is None:
+                stats.sample(result.response, result.entries, client)
+
+        first_page = False
+        yield result
+        query = NextLink(result.response)
+
+def PageBundles(query, client=None, elements=None):
+    """Yield the entries of each page of the search (see PageResults)"""
+    for result in PageResults(query, client, elements):
+        yield result.entries
+
+class Handoff:
+    """Passes items from background threads to the consuming generator """
+    """through a bounded queue. The consumer may stop listening at any """
+    """time, so the threads never wait on a full queue forever"""
+    def __init__(self, depth):
+        self.ready = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+
+    def put(self, kind, item=None):
+        while not self.stop.is_set():
+            try:
+                self.ready.put((kind, item), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def items(self, producers=1):
+        """Yield each page put until every producer has put done. An """
+        """error put by a producer is raised here"""
+        finished = 0
+        try:
+            while finished < producers:
+                kind, item = self.ready.get()
+                if kind == "done":
+                    finished += 1
+                elif kind == "error":
+                    raise item
+                else:
+                    yield item
+        finally:
+            self.stop.set()
+
+def Prefetch(pages, depth=None):
+    """Yield each item of the (page) iterator, which runs in a background """
+    """thread keeping up to depth items ready. Exceptions are raised here """
+    """as they would have been without the thread"""
+    if depth is None:
+        depth = _prefetch_pages
+    if depth < 1:
+        yield from pages
+        return
+
+    handoff = Handoff(depth)
+
+    def produce():
+        try:
+            for page in pages:
+                if not handoff.put("page", page):
+                    return
+            handoff.put("done")
+        except BaseException as e:
+            handoff.put("error", e)
+        finally:
+            pages.close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    yield from handoff.items()
+
+def PageOffset(link):
+    """The offset of the page (_getpagesoffset) in a next link, if it has one"""
+    offset = parse_qs(urlparse(link).query).get('_getpagesoffset')
+    if offset is None:
+        return None
+    return int(offset[0])
+
+def OffsetPage(link, offset, count):
+    """The next link rewritten to ask for count resources from offset"""
+    url = urlparse(link)
+    params = parse_qs(url.query, keep_blank_values=True)
+    params['_getpagesoffset'] = [str(offset)]
+    params['_count'] = [str(count)]
+    return urlunparse(url._replace(query=urlencode(params, doseq=True, safe=',|/:')))
+
+class PageSizer:
+    """Chooses the _count for each page from how long the pages so far """
+    """took and how large they were. A page's time is fitted as a fixed """
+    """overhead (latency) plus a cost per resource, and pages grow until """
+    """the overhead is a small part of the whole"""
+    def __init__(self, count, minimum=MIN_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.current = min(max(count, minimum), maximum)
+
+        # Running sums for the least squares fit of seconds against count
+        self.n = 0
+        self.sx = 0.0
+        self.sy = 0.0
+        self.sxx = 0.0
+        self.sxy = 0.0
+
+        self.bytes_per_resource = None
+        self.lock = threading.Lock()
+
+    def count(self):
+        with self.lock:
+            return self.current
+
+    def limit(self, count):
+        """The server gave us fewer than we asked for, so that's its maximum"""
+        with self.lock:
+            self.maximum = max(min(self.maximum, count), 1)
+            self.current = min(self.current, self.maximum)
+
+    def record(self, count, seconds, size=None):
+        if count == 0:
+            return
+        with self.lock:
+            self.n += 1
+            self.sx += count
+            self.sy += seconds
+            self.sxx += count * count
+            self.sxy += count * seconds
+            if size is not None:
+                self.bytes_per_resource = size / count
+            self.current = self.choose()
+
+    def choose(self):
+        # Until there is a spread of page sizes to fit, keep growing
+        target = self.current * 2
+        spread = self.n * self.sxx - self.sx * self.sx
+        if self.n > 1 and spread > 0:
+            per_resource = (self.n * self.sxy - self.sx * self.sy) / spread
+            overhead = (self.sy - per_resource * self.sx) / self.n
+            if per_resource > 0:
+                target = min(target, max(overhead, 0.0) * (1.0 - PAGE_OVERHEAD) / 
+                                (PAGE_OVERHEAD * per_resource))
+        if self.bytes_per_resource is not None:
+            target = min(target, MAX_PAGE_BYTES / self.bytes_per_resource)
+        return int(min(max(target, self.minimum), self.maximum))
+
+class OffsetRanges:
+    """Hands out disjoint ranges (offset, count) of a search's results for """
+    """servers which page by offset. Whatever part of a range the server """
+    """didn't cover is handed out again, so every offset is fetched once. """
+    """With ahead set, new ranges aren't handed out more than ahead pages """
+    """past the last offset delivered"""
+    def __init__(self, start, total, sizer, partitions, ahead=None):
+        self.next = start
+        self.total = total
+        self.sizer = sizer
+        self.partitions = partitions
+        self.ahead = ahead
+        self.delivered = start
+
+        # (start, end) of ranges which were only partly served
+        self.gaps = []
+
+        # Ranges handed out which haven't been released. Until they are, 
+        # there may be gaps to come
+        self.outstanding = 0
+        self.changed = threading.Condition()
+
+    def take(self, stop):
+        """The next range to fetch, or None once there are no more"""
+        with self.changed:
+            while not stop.is_set():
+                count = self.sizer.count()
+                if len(self.gaps) > 0:
+                    start, end = self.gaps.pop()
+                    count = min(count, end - start)
+                    if start + count < end:
+                        self.gaps.append((start + count, end))
+                    self.outstanding += 1
+                    return start, count
+
+                if self.next < self.total:
+                    if self.ahead is None or self.next < self.delivered + self.ahead * count:
+                        # Near the end, the remainder is split between the 
+                        # partitions rather than left to one page
+                        remaining = self.total - self.next
+                        count = min(count, remaining, 
+                                    max(-(-remaining // self.partitions), self.sizer.minimum))
+                        start = self.next
+                        self.next += count
+                        self.outstanding += 1
+                        return start, count
+                elif self.outstanding == 0:
+                    return None
+                self.changed.wait(0.1)
+        return None
+
+    def release(self, start, count, served):
+        with self.changed:
+            if served < count:
+                self.gaps.append((start + served, start + count))
+            self.outstanding -= 1
+            self.changed.notify_all()
+
+    def deliver(self, offset):
+        """Everything before offset has been delivered"""
+        with self.changed:
+            self.delivered = offset
+            self.changed.notify_all()
+
+def PartitionedPages(query, client=None, elements=None, partitions=None):
+    """Yield the entries of each page of the search, fetching up to """
+    """partitions pages at once. If the first page's next link pages by """
+    """offset (_getpagesoffset, as HAPI's do) and its Bundle has a total, """
+    """the rest of the results are split into disjoint ranges of offsets, """
+    """which are fetched concurrently with a _count fitted to the time and """
+    """size of the pages so far. The pages are delivered in offset order, """
+    """as a serial search would, so whatever a summary keeps from the first """
+    """resource it sees doesn't vary from run to run. Otherwise, we follow """
+    """the next links, prefetching as usual"""
+    if client is None:
+        client = GetInputClient()
+    if partitions is None:
+        partitions = _search_partitions
+
+    results = PageResults(query, client, elements)
+    first = next(results, None)
+    if first is None:
+        return
+
+    link = NextLink(first.response)
+    total = first.response.get('total')
+    if partitions < 2 or link is None or total is None or PageOffset(link) is None:
+        yield first.entries
+        yield from Prefetch(result.entries for result in results)
+        return
+    results.close()
+
+    print(f"{query}: {total} resources, fetching {partitions} pages at a time")
+    sizer = PageSizer(len(first.entries))
+    depth = partitions + max(_prefetch_pages, 0)
+    ranges = OffsetRanges(PageOffset(link), total, sizer, partitions, ahead=2 * depth)
+    handoff = Handoff(depth)
+
+    def fetch():
+        try:
+            pages = 0
+            while True:
+                taken = ranges.take(handoff.stop)
+                if taken is None:
+                    break
+                start, count = taken
+
+                began = perf_counter()
+                result = client.get(OffsetPage(link, start, count), recurse=False)
+                seconds = perf_counter() - began
+                if not result.success():
+                    raise IncompleteSearch(f"{query} failed at offset {start} "
+                        f"({result.status_code})")
+
+                # The next link says where the server's page actually ended
+                served = count
+                following = NextLink(result.response)
+                if following is not None and PageOffset(following) is not None:
+                    served = min(PageOffset(following) - start, count)
+                if served < 1:
+                    raise IncompleteSearch(f"{query} returned an empty page at offset {start}")
+                if served < count:
+                    sizer.limit(served)
+
+                size = None
+                if pages % PAYLOAD_SAMPLE == 0:
+                    size = PayloadSize(result.response)
+                pages += 1
+                sizer.record(len(result.entries), seconds, size)
+                ranges.release(start, count, served)
+
+                if not handoff.put("page", (start, served, result)):
+                    return
+            handoff.put("done")
+        except BaseException as e:
+            handoff.put("error", e)
+
+    for i in range(partitions):
+        threading.Thread(target=fetch, daemon=True).start()
+
+    stats = None
+    if elements is not None:
+        stats = _projection_stats.get(query)
+
+    # Pages which arrived ahead of one still being fetched, by offset
+    waiting = {}
+    expected = PageOffset(link)
+    try:
+        yield first.entries
+        for start, served, result in handoff.items(partitions):
+            waiting[start] = (served, result)
+            while expected in waiting:
+                served, result = waiting.pop(expected)
+                expected += served
+                ranges.deliver(expected)
+                if stats is not None:
+                    stats.record_page(result.response, result.entries)
+                yield result.entries
+        if len(waiting) > 0:
+            raise IncompleteSearch(f"{query} is missing results from offset {expected}")
+    finally:
+        handoff.stop.set()
+
+def StreamResources(query, client=None, elements=None):
+    """Yield each resource returned by the search, one page in memory at a """
+    """time. If elements is provided, the server is only asked for those"""
+    if client is None:
+        client = GetInputClient()
+
+    # Input sources which can stream resources themselves (such as the NDJSON 
+    # reader) don't need to go through pages at all
+    if hasattr(client, 'stream_resources'):
+        yield from client.stream_resources(query)
+        return
+
+    for entries in PartitionedPages(query, client, elements):
+        for entry in entries:
+            yield entry['resource']
+
+def SearchPages(resource_type, params, client=None, elements=None):
+    """Yield the entries of each page of the search (a dict of name => """
+    """value). The searches differ only in their values, so their """
+    """projection stats are kept together"""
+    query = f"{resource_type}?{urlencode(params, safe=',|/:')}"
+    label = f"{resource_type}?{'&'.join(params)}"
+    for result in PageResults(query, client, elements, label):
+        yield result.entries
+
+def SearchResources(resource_type, params, client=None, elements=None):
+    """Yield each resource matching the search parameters (see SearchPages)"""
+    for entries in Prefetch(SearchPages(resource_type, params, client, elements)):
+        for entry in entries:
+            yield entry['resource']
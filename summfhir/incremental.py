@@ -0,0 +1,253 @@
+"""
+Incremental re-summarization.
+
+After a run, the state of each population's summaries is saved along with
+the time the run started. What each resource contributed to them is kept in
+an SQLite database beside the state (see ContributionStore), so that it
+needn't be held in memory. The next incremental run restores that state and
+only pulls resources updated since then. Each changed resource's previous
+contribution is retracted before its current version is summarized, as is
+that of any resource the study's searches no longer return (deleted, or no
+longer tagged for the study). Only the summaries whose content changed are
+loaded.
+
+If anything that shapes the summaries themselves has changed (enrollment
+Groups, ActivityDefinitions, ObservationDefinitions, or the summaries
+requested), we fall back to summarizing everything. If any search fails, the
+run is abandoned (IncompleteSearch) and the saved state is left as it was,
+since whatever the search didn't return would otherwise be retracted.
+"""
+
+from summfhir import GetInputClient
+from summfhir.fetch import IncompleteSearch
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from hashlib import sha1
+import sqlite3
+import pickle
+import os
+
+# Bump this whenever the pickled summaries change shape
+STATE_VERSION = 9
+
+# Resources updated shortly before we start may not be visible to the searches
+# yet. Since changed resources have their old contribution retracted first,
+# seeing a resource twice is harmless, so we err on the side of overlap
+CHECKPOINT_MARGIN = timedelta(minutes=10)
+
+def Checkpoint():
+    """The instant to use as _lastUpdated for the next incremental run"""
+    checkpoint = datetime.now(timezone.utc) - CHECKPOINT_MARGIN
+    return checkpoint.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def MembershipHash(population):
+    return sha1("\n".join(sorted(population.members)).encode()).hexdigest()
+
+def StateFilename(state_dir, study):
+    return Path(state_dir) / f"{study.id}.pickle"
+
+def ContributionsFilename(state_dir, study):
+    return Path(state_dir) / f"{study.id}.contributions.sqlite"
+
+class ContributionStore:
+    """What each resource (Patient/id, etc) contributed to the summaries, """
+    """keyed by reference. Nothing is committed until save, so a run which """
+    """doesn't finish leaves the previous run's contributions in place"""
+    def __init__(self, filename, new=False):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+
+        # New stores are built under a temporary name and only replace the
+        # previous one once saved
+        self.path = self.filename
+        if new:
+            self.path = self.filename.with_suffix(f".{os.getpid()}.tmp")
+            if self.path.exists():
+                self.path.unlink()
+
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute("CREATE TABLE IF NOT EXISTS contributions "
+                        "(reference TEXT PRIMARY KEY, resource_type TEXT, contribution BLOB)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS saved (checkpoint TEXT)")
+
+    def __setitem__(self, reference, contributions):
+        self.db.execute("INSERT OR REPLACE INTO contributions VALUES (?, ?, ?)",
+                        (reference, reference.split("/")[0],
+                         pickle.dumps(contributions, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def pop(self, reference, default=None):
+        row = self.db.execute("SELECT contribution FROM contributions WHERE reference = ?",
+                                (reference,)).fetchone()
+        if row is None:
+            return default
+        self.db.execute("DELETE FROM contributions WHERE reference = ?", (reference,))
+        return pickle.loads(row[0])
+
+    def checkpoint(self):
+        """The checkpoint of the run which saved the store (see save)"""
+        row = self.db.execute("SELECT checkpoint FROM saved").fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def missing(self, resource_type, references):
+        """The references of the type with recorded contributions that """
+        """aren't among references (an iterable, which is consumed)"""
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS current (reference TEXT PRIMARY KEY)")
+        self.db.execute("DELETE FROM current")
+        self.db.executemany("INSERT OR IGNORE INTO current VALUES (?)",
+                            ((reference,) for reference in references))
+        rows = self.db.execute("SELECT reference FROM contributions WHERE resource_type = ? "
+                            "AND reference NOT IN (SELECT reference FROM current) ORDER BY reference",
+                            (resource_type,)).fetchall()
+        self.db.execute("DELETE FROM current")
+        return [row[0] for row in rows]
+
+    def save(self, checkpoint):
+        """Commit everything along with the checkpoint of the state saved """
+        """with it, which is how we know the two belong together"""
+        self.db.execute("DELETE FROM saved")
+        self.db.execute("INSERT INTO saved VALUES (?)", (checkpoint,))
+        self.db.commit()
+        self.db.close()
+        if self.path != self.filename:
+            os.replace(self.path, self.filename)
+
+    def close(self):
+        """Discard any changes"""
+        self.db.close()
+        if self.path != self.filename:
+            self.path.unlink()
+
+def SaveStudyState(state_dir, study, summarized):
+    """summarized is a dict indicating which kinds of summary were run"""
+    filename = StateFilename(state_dir, study)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+
+    # The contributions go first. Should we fail before the state is saved,
+    # their checkpoint won't match the old state's and the next run will
+    # summarize everything
+    study.contributions.save(study.checkpoint)
+
+    state = {
+        "version": STATE_VERSION,
+        "checkpoint": study.checkpoint,
+        "summarized": summarized,
+        "members": dict([(pop.id, MembershipHash(pop)) for pop in study.enrollment]),
+        "summaries": dict([(pop.id, pop.summaries) for pop in study.enrollment]),
+        "hashes": study.summary_hashes
+    }
+
+    tmpname = filename.with_suffix(f".{os.getpid()}.tmp")
+    with tmpname.open('wb') as outf:
+        pickle.dump(state, outf, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpname, filename)
+    print(f"Summary state saved to {filename}")
+
+def LoadStudyState(state_dir, study):
+    filename = StateFilename(state_dir, study)
+    if not filename.exists():
+        return None
+
+    try:
+        with filename.open('rb') as inf:
+            state = pickle.load(inf)
+    except Exception as e:
+        print(f"Unable to load the previous state from {filename}: {e}")
+        return None
+
+    if state.get('version') != STATE_VERSION:
+        return None
+    return state
+
+def ChangedSince(resource_type, tag, since, client=None):
+    if client is None:
+        client = GetInputClient()
+
+    result = client.get(f"{resource_type}?_tag={tag}&_lastUpdated=gt{since}&_summary=count")
+    if not result.success():
+        # If we can't tell, we have to assume the worst
+        return True
+    return result.response.get('total', 1) > 0
+
+def RestoreStudyState(study, state, summarized, state_dir):
+    """Put the previous run's summaries back in place, returning False """
+    """if they can't be used as the starting point for this run"""
+    if state is None:
+        return False
+
+    filename = ContributionsFilename(state_dir, study)
+    if not filename.exists():
+        print(f"{filename} is missing. Summarizing everything.")
+        return False
+
+    if state['summarized'] != summarized:
+        print("Different summaries were requested last time. Summarizing everything.")
+        return False
+
+    for pop in study.enrollment:
+        if state['members'].get(pop.id) != MembershipHash(pop):
+            print(f"Membership for {pop.id} has changed. Summarizing everything.")
+            return False
+
+    since = state['checkpoint']
+    resource_types = ["Group"]
+    if summarized['source']:
+        resource_types += ["ActivityDefinition", "ObservationDefinition"]
+    for resource_type in resource_types:
+        if ChangedSince(resource_type, study.tag, since):
+            print(f"{resource_type} resources have changed. Summarizing everything.")
+            return False
+
+    contributions = ContributionStore(filename)
+    if contributions.checkpoint() != state['checkpoint']:
+        print(f"{filename} doesn't belong with the saved state. Summarizing everything.")
+        contributions.close()
+        return False
+
+    for pop in study.enrollment:
+        pop.summaries = state['summaries'][pop.id]
+    study.contributions = contributions
+    study.summary_hashes = state['hashes']
+    return True
+
+def SummarizeIncremental(study, state_dir, patients=True, conditions=True, source=True):
+    """Summarize only what has changed since the previous run if we can, """
+    """otherwise summarize everything while tracking contributions so that """
+    """the next run can be incremental"""
+    summarized = {
+        "patients": patients,
+        "conditions": conditions,
+        "source": source
+    }
+
+    if not study.shared_scan:
+        print("Incremental runs scan each resource type once for the whole study")
+        study.shared_scan = True
+
+    state = LoadStudyState(state_dir, study)
+    study.checkpoint = Checkpoint()
+
+    try:
+        if RestoreStudyState(study, state, summarized, state_dir):
+            print(f"Summarizing changes since {state['checkpoint']}")
+            study.summarize_changes(state['checkpoint'], patients, conditions, source)
+        else:
+            study.track_contributions(ContributionStore(ContributionsFilename(state_dir, study), new=True))
+            study.summary_hashes = {}
+            if patients:
+                study.summarize_patients()
+            if conditions:
+                study.summarize_conditions()
+            if source:
+                study.summarize_source()
+    except IncompleteSearch as e:
+        # Whatever a search didn't return would be retracted (or left out), 
+        # so the run goes no further and the previous state stays as it was
+        print(f"Incremental run abandoned ({e}). The previous state is unchanged.")
+        if study.contributions is not None:
+            study.contributions.close()
+            study.contributions = None
+        raise
+
+    return summarized
@@ -0,0 +1,201 @@
+"""
+Compact storage for the Condition summaries.
+
+A study (or several) may have hundreds of thousands of distinct condition
+codes, and each population's Condition summary used to hold a dict of counts
+and a deep copy of the CodeableConcept for every one of them. Instead, each
+summary keeps its counts in arrays indexed by the position at which it first
+saw the code, and the CodeableConcepts are packed into compact JSON strings 
+which are shared between every summary that observed an identical one.
+
+The shared concepts are only useful within a study, so StudySummary clears
+them (see ResetInterning) before each study begins.
+"""
+
+from array import array
+import json
+
+from summfhir.summary import ResetCodeChoices
+
+class CountRow:
+    """One domain's counts within a CountMatrix, which behaves like the """
+    """defaultdict(int) it replaces"""
+    __slots__ = ['matrix', 'position']
+
+    def __init__(self, matrix, position):
+        self.matrix = matrix
+        self.position = position
+
+    def __getitem__(self, value):
+        return self.matrix.get_count(self.position, value)
+
+    def __setitem__(self, value, count):
+        self.matrix.set_count(self.position, value, count)
+
+    def __delitem__(self, value):
+        self[value] = 0
+
+    def __contains__(self, value):
+        return self[value] != 0
+
+    def get(self, value, default=None):
+        count = self[value]
+        if count == 0:
+            return default
+        return count
+
+    def keys(self):
+        return [value for value, column in self.matrix.columns.items()
+                    if self.position < len(column) and column[self.position] != 0]
+
+    def items(self):
+        return [(value, self[value]) for value in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.matrix.cell_count(self.position)
+
+class CountMatrix:
+    """domain => value => count, as defaultdict(CodeCounts) would be, """
+    """except that each value's counts are an array indexed by the """
+    """position of the domain within this matrix. That's 8 bytes per code """
+    """for each distinct value (verification status) plus the code's """
+    """position, rather than a dict per code"""
+    __slots__ = ['positions', 'domains', 'columns', 'cells']
+
+    def __init__(self):
+        # domain => position, and position => domain
+        self.positions = {}
+        self.domains = []
+
+        # value => counts indexed by domain position
+        self.columns = {}
+
+        # domain position => the number of values with a count for the domain
+        self.cells = array('q')
+
+    def position(self, domain):
+        position = self.positions.get(domain)
+        if position is None:
+            position = len(self.domains)
+            self.positions[domain] = position
+            self.domains.append(domain)
+        return position
+
+    def get_count(self, position, value):
+        column = self.columns.get(value)
+        if column is None or position >= len(column):
+            return 0
+        return column[position]
+
+    def set_count(self, position, value, count):
+        column = self.columns.get(value)
+        if column is None:
+            if count == 0:
+                return
+            column = array('q')
+            self.columns[value] = column
+        if position >= len(column):
+            if count == 0:
+                return
+            column.extend([0] * (position + 1 - len(column)))
+        if position >= len(self.cells):
+            self.cells.extend([0] * (position + 1 - len(self.cells)))
+
+        if column[position] == 0 and count != 0:
+            self.cells[position] += 1
+        elif column[position] != 0 and count == 0:
+            self.cells[position] -= 1
+        column[position] = count
+
+    def cell_count(self, position):
+        if position >= len(self.cells):
+            return 0
+        return self.cells[position]
+
+    def __getitem__(self, domain):
+        return CountRow(self, self.position(domain))
+
+    def __contains__(self, domain):
+        position = self.positions.get(domain)
+        return position is not None and self.cell_count(position) > 0
+
+    def __delitem__(self, domain):
+        row = self[domain]
+        for value in row.keys():
+            del row[value]
+
+    def keys(self):
+        domains = self.domains
+        return [domains[position] for position, cells in enumerate(self.cells) if cells > 0]
+
+    def items(self):
+        return [(domain, self[domain]) for domain in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(1 for cells in self.cells if cells > 0)
+
+    def __getstate__(self):
+        return dict([(domain, dict(row.items())) for domain, row in self.items()])
+
+    def __setstate__(self, counts):
+        self.__init__()
+        for domain, row_counts in counts.items():
+            row = self[domain]
+            for value, count in row_counts.items():
+                row[value] = count
+
+# code => the packed CodeableConcept first observed with that code, and 
+# code => any others observed with the same code (which is rare)
+_codeable_concepts = {}
+_other_concepts = {}
+
+def ResetInterning():
+    """Forget the concepts (and code choices) shared by the last study's """
+    """summaries. The summaries keep whatever they already hold"""
+    _codeable_concepts.clear()
+    _other_concepts.clear()
+    _last_packed[:] = [None, None]
+    ResetCodeChoices()
+
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+def PackCodeableConcept(concept):
+    return _encoder.encode(concept)
+
+def UnpackCodeableConcept(packed):
+    return json.loads(packed)
+
+def InternPackedConcept(code, packed):
+    """The packed concept shared with every other summary that observed """
+    """an identical one"""
+    shared = _codeable_concepts.get(code)
+    if shared is None:
+        _codeable_concepts[code] = packed
+        return packed
+    if shared == packed:
+        return shared
+
+    others = _other_concepts.setdefault(code, [])
+    for shared in others:
+        if shared == packed:
+            return shared
+    others.append(packed)
+    return packed
+
+# The concept most recently packed, and its packing. A study hands the same
+# resource to each population it belongs to, so this saves packing it again
+_last_packed = [None, None]
+
+def InternCodeableConcept(code, concept):
+    if _last_packed[0] is concept:
+        packed = _last_packed[1]
+    else:
+        packed = PackCodeableConcept(concept)
+        _last_packed[:] = [concept, packed]
+    return InternPackedConcept(code, packed)
@@ -0,0 +1,437 @@
+"""
+Where the time goes during a run.
+
+Three things are measured:
+
+    * Every request made of a FHIR server, by method and URL template (ids
+      and parameter values removed, so Patient?_tag=x&_id=1,2 becomes
+      /Patient?_id&_tag): the count by status, bytes received and a latency
+      histogram. Where the client doesn't say how large a response was, the
+      size is estimated from one response in every PAYLOAD_SAMPLE
+    * Each summarization phase (patients, conditions, source rows, text
+      report, upload, ...) along with the number of records it handled
+    * Any other counts worth keeping (summaries loaded, failed, ...)
+
+At the end of the run these are written out as a JSON report and, optionally,
+a Prometheus textfile (for node_exporter's textfile collector).
+"""
+
+from summfhir.fetch import PayloadSize, PAYLOAD_SAMPLE
+from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+from time import perf_counter, time
+import threading
+import json
+import os
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+def IsResourceType(segment):
+    return segment[0:1].isupper() and segment.isalpha()
+
+def UrlTemplate(url):
+    """The URL without the server's base, ids or parameter values, so """
+    """that requests of the same kind are counted together"""
+    parsed = urlparse(url)
+    segments = parsed.path.strip("/").split("/")
+
+    # Everything before the first resource type is the server's base
+    for i, segment in enumerate(segments):
+        if IsResourceType(segment):
+            segments = segments[i:]
+            break
+    else:
+        segments = []
+
+    template = []
+    for segment in segments:
+        if IsResourceType(segment) or segment[0:1] in ["$", "_"]:
+            template.append(segment)
+        else:
+            template.append("{id}")
+
+    template = "/" + "/".join(template)
+    params = sorted(parse_qs(parsed.query, keep_blank_values=True).keys())
+    if len(params) > 0:
+        template += "?" + "&".join(params)
+    return template
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge_cumulative(self, cumulative, sum):
+        """Add the counts from another histogram's cumulative(), with the """
+        """same buckets"""
+        total = 0
+        for i, (bound, count) in enumerate(cumulative):
+            self.counts[i] += count - total
+            total = count
+        self.sum += sum
+        self.count += total
+
+    def cumulative(self):
+        """(upper bound, count of values <= bound), ending with +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class RequestStats:
+    def __init__(self):
+        self.statuses = defaultdict(int)
+        self.latency = Histogram()
+
+        # Bytes in responses whose size was known
+        self.bytes = 0
+
+        # Responses whose size wasn't known, and the total size of those we
+        # measured
+        self.unsized = 0
+        self.samples = 0
+        self.sampled_bytes = 0
+
+    def estimated_bytes(self):
+        if self.samples == 0:
+            return self.bytes
+        return self.bytes + round(self.sampled_bytes * self.unsized / self.samples)
+
+class PhaseTimer:
+    """Time spent on one phase, and the records it handled. Returned by """
+    """Metrics.phase for use in a with statement"""
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.records = 0
+        self.seconds = 0.0
+        self.start = None
+
+    def add(self, count=1):
+        self.records += count
+
+    def __enter__(self):
+        if self.metrics.profiler is not None:
+            self.metrics.profiler.begin(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = perf_counter() - self.start
+        if self.metrics.profiler is not None:
+            self.metrics.profiler.end(self)
+        self.metrics.end_phase(self)
+
+class Metrics:
+    def __init__(self):
+        self.started = time()
+        self.clock = perf_counter()
+
+        # (method, template) => RequestStats
+        self.requests = {}
+
+        # Completed phases, in the order they finished
+        self.phases = []
+
+        # name => count
+        self.counters = defaultdict(int)
+
+        # If set, profiles each phase (see profiling.py)
+        self.profiler = None
+
+        self.lock = threading.Lock()
+
+    def record_request(self, method, url, status, size, seconds, response=None):
+        """size is None if the client didn't say, in which case one """
+        """response in every PAYLOAD_SAMPLE is serialized to estimate it"""
+        key = (method, UrlTemplate(url))
+        with self.lock:
+            stats = self.requests.get(key)
+            if stats is None:
+                stats = RequestStats()
+                self.requests[key] = stats
+            stats.statuses[status] += 1
+            stats.latency.observe(seconds)
+
+            if size is not None:
+                stats.bytes += size
+                return
+            if response is None:
+                return
+            sample = stats.unsized % PAYLOAD_SAMPLE == 0
+            stats.unsized += 1
+
+        # Serializing is the expensive part, so it happens outside the lock
+        if sample:
+            size = PayloadSize(response)
+            with self.lock:
+                stats.samples += 1
+                stats.sampled_bytes += size
+
+    def phase(self, name, **labels):
+        return PhaseTimer(self, name, labels)
+
+    def end_phase(self, phase):
+        with self.lock:
+            self.phases.append(phase)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def merge(self, report):
+        """Fold in the report (see report) of work done in another process"""
+        with self.lock:
+            for phase in report['phases']:
+                timer = PhaseTimer(self, phase['phase'], phase['labels'])
+                timer.seconds = phase['seconds']
+                timer.records = phase['records']
+                self.phases.append(timer)
+
+            for request in report['requests']:
+                key = (request['method'], request['template'])
+                stats = self.requests.get(key)
+                if stats is None:
+                    stats = RequestStats()
+                    self.requests[key] = stats
+                for status, count in request['statuses'].items():
+                    stats.statuses[int(status)] += count
+                stats.bytes += request['bytes']
+                stats.latency.merge_cumulative([(bucket['le'], bucket['count']) 
+                                                for bucket in request['latency_buckets']],
+                                                request['seconds'])
+
+            for name, value in report['counters'].items():
+                self.counters[name] += value
+
+    def report(self):
+        """Everything measured so far as plain data, suitable for JSON"""
+        elapsed = perf_counter() - self.clock
+        with self.lock:
+            phases = []
+            for phase in self.phases:
+                rate = None
+                if phase.seconds > 0:
+                    rate = phase.records / phase.seconds
+                phases.append({
+                    "phase": phase.name,
+                    "labels": phase.labels,
+                    "seconds": phase.seconds,
+                    "records": phase.records,
+                    "records_per_second": rate
+                })
+
+            requests = []
+            for (method, template), stats in sorted(self.requests.items()):
+                requests.append({
+                    "method": method,
+                    "template": template,
+                    "count": stats.latency.count,
+                    "statuses": dict([(str(k), v) for k, v in sorted(stats.statuses.items())]),
+                    "bytes": stats.estimated_bytes(),
+                    "seconds": stats.latency.sum,
+                    "latency_buckets": [{"le": "+Inf" if bound == float('inf') else bound, "count": count}
+                                            for bound, count in stats.latency.cumulative()]
+                })
+
+            return {
+                "started": self.started,
+                "seconds": elapsed,
+                "phases": phases,
+                "requests": requests,
+                "counters": dict(self.counters)
+            }
+
+    def summary(self):
+        """A few lines for the console"""
+        report = self.report()
+        lines = [f"Run took {report['seconds']:.1f}s"]
+        for phase in report['phases']:
+            labels = " ".join([f"{v}" for v in phase['labels'].values()])
+            rate = ""
+            if phase['records_per_second'] is not None and phase['records'] > 0:
+                rate = f" ({phase['records_per_second']:.0f}/s)"
+            lines.append(f"  {phase['phase']:<20} {labels:<24} {phase['seconds']:8.2f}s "
+                f"{phase['records']:>10} records{rate}")
+        for request in report['requests']:
+            lines.append(f"  {request['method']:<6} {request['template']:<44} {request['count']:>6} requests "
+                f"{request['seconds']:8.2f}s {request['bytes'] / 1048576.0:8.1f}MB")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """The metrics in Prometheus' text exposition format"""
+        report = self.report()
+        lines = []
+
+        def Labels(**labels):
+            return "{" + ",".join([f'{k}="{EscapeLabel(v)}"' for k, v in labels.items()]) + "}"
+
+        lines.append("# HELP summfhir_run_seconds Duration of the run")
+        lines.append("# TYPE summfhir_run_seconds gauge")
+        lines.append(f"summfhir_run_seconds {report['seconds']}")
+        lines.append("# HELP summfhir_run_start_time_seconds When the run started")
+        lines.append("# TYPE summfhir_run_start_time_seconds gauge")
+        lines.append(f"summfhir_run_start_time_seconds {report['started']}")
+
+        # A phase may run more than once (once per population, for instance)
+        phases = defaultdict(lambda: [0.0, 0])
+        for phase in report['phases']:
+            key = (phase['phase'],) + tuple(sorted(phase['labels'].items()))
+            phases[key][0] += phase['seconds']
+            phases[key][1] += phase['records']
+
+        for metric, help, index in [("summfhir_phase_seconds", "Time spent in each phase", 0),
+                                    ("summfhir_phase_records", "Records handled by each phase", 1)]:
+            lines.append(f"# HELP {metric} {help}")
+            lines.append(f"# TYPE {metric} gauge")
+            for key, values in sorted(phases.items()):
+                lines.append(f"{metric}{Labels(phase=key[0], **dict(key[1:]))} {values[index]}")
+
+        lines.append("# HELP summfhir_phase_records_per_second Throughput of each phase")
+        lines.append("# TYPE summfhir_phase_records_per_second gauge")
+        for key, (seconds, records) in sorted(phases.items()):
+            if seconds > 0:
+                lines.append(f"summfhir_phase_records_per_second{Labels(phase=key[0], **dict(key[1:]))} {records / seconds}")
+
+        lines.append("# HELP summfhir_requests_total FHIR requests by status")
+        lines.append("# TYPE summfhir_requests_total counter")
+        for request in report['requests']:
+            for status, count in request['statuses'].items():
+                lines.append(f"summfhir_requests_total{Labels(method=request['method'], template=request['template'], status=status)} {count}")
+
+        lines.append("# HELP summfhir_response_bytes_total Bytes received in FHIR responses")
+        lines.append("# TYPE summfhir_response_bytes_total counter")
+        for request in report['requests']:
+            lines.append(f"summfhir_response_bytes_total{Labels(method=request['method'], template=request['template'])} {request['bytes']}")
+
+        lines.append("# HELP summfhir_request_duration_seconds FHIR request latency")
+        lines.append("# TYPE summfhir_request_duration_seconds histogram")
+        for request in report['requests']:
+            for bucket in request['latency_buckets']:
+                lines.append(f"summfhir_request_duration_seconds_bucket{Labels(method=request['method'], template=request['template'], le=bucket['le'])} {bucket['count']}")
+            lines.append(f"summfhir_request_duration_seconds_sum{Labels(method=request['method'], template=request['template'])} {request['seconds']}")
+            lines.append(f"summfhir_request_duration_seconds_count{Labels(method=request['method'], template=request['template'])} {request['count']}")
+
+        lines.append("# HELP summfhir_events_total Other counts kept during the run")
+        lines.append("# TYPE summfhir_events_total counter")
+        for name, value in sorted(report['counters'].items()):
+            lines.append(f"summfhir_events_total{Labels(event=name)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+def EscapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def WriteAtomically(filename, content):
+    # The textfile collector may read the file at any moment, so it is
+    # written elsewhere and renamed into place
+    filename = Path(filename)
+    filename.parent.mkdir(parents=True, exist_ok=True)
+    tmpname = filename.with_name(f".{filename.name}.{os.getpid()}.tmp")
+    with tmpname.open('wt') as outf:
+        outf.write(content)
+    os.replace(tmpname, filename)
+
+_metrics = Metrics()
+
+def GetMetrics():
+    return _metrics
+
+def ResetMetrics():
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+def SetProfiler(profiler):
+    _metrics.profiler = profiler
+
+def Phase(name, **labels):
+    """with Phase("patients", study=id) as phase: ... phase.add()"""
+    return _metrics.phase(name, **labels)
+
+def CountEvent(name, value=1):
+    _metrics.count(name, value)
+
+def WriteRunReport(filename=None, prometheus=None, studies=None):
+    """studies, if provided, is the report on each study from a """
+    """StudyScheduler"""
+    if filename is not None:
+        report = _metrics.report()
+        if studies is not None:
+            report['studies'] = studies
+        WriteAtomically(filename, json.dumps(report, indent=2))
+        print(f"Run report written to {filename}")
+    if prometheus is not None:
+        WriteAtomically(prometheus, _metrics.prometheus())
+        print(f"Prometheus metrics written to {prometheus}")
+
+def ResponseLength(result):
+    """The size of the response as it came over the wire, if the client """
+    """kept hold of it"""
+    if type(result) is dict:
+        return None
+    headers = getattr(result, 'headers', None)
+    if headers is not None and 'Content-Length' in headers:
+        return int(headers['Content-Length'])
+    content = getattr(result, 'content', None)
+    if type(content) in [bytes, str]:
+        return len(content)
+    return None
+
+def ResultStatus(result):
+    if type(result) is dict:
+        return result.get('status_code', 0), result.get('response')
+    return getattr(result, 'status_code', 0), getattr(result, 'response', None)
+
+class InstrumentedClient:
+    """Wraps a FHIR client, recording each request it makes. Anything else """
+    """is passed straight through to the client"""
+    def __init__(self, client, metrics=None):
+        self.client = client
+        self.metrics = metrics
+
+    def record(self, method, url, start, result):
+        seconds = perf_counter() - start
+        status, response = ResultStatus(result)
+        if type(response) not in [dict, list]:
+            response = None
+        metrics = self.metrics if self.metrics is not None else _metrics
+        metrics.record_request(method, url, status, ResponseLength(result), seconds, response)
+
+    def get(self, query, *args, **kwargs):
+        start = perf_counter()
+        result = self.client.get(query, *args, **kwargs)
+        self.record("GET", query, start, result)
+        return result
+
+    def post(self, resource, data, *args, **kwargs):
+        start = perf_counter()
+        result = self.client.post(resource, data, *args, **kwargs)
+        self.record("POST", resource, start, result)
+        return result
+
+    def put(self, resource, data, *args, **kwargs):
+        start = perf_counter()
+        result = self.client.put(resource, data, *args, **kwargs)
+        self.record("PUT", resource, start, result)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
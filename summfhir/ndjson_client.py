@@ -0,0 +1,360 @@
+"""
+Offline input source which answers the queries we make of a FHIR server from
+a directory of NDJSON files, such as those produced by a bulk $export.
+
+Each resource type lives in one or more files named after the type
+(Patient.ndjson, Patient.000.ndjson, Patient-2.ndjson.gz, etc). Plain files
+are read through a memory map and gzipped files are decompressed as they are
+read, so only a single line is ever parsed at a time.
+
+Only the subset of the search API that summarization relies on is supported:
+
+    Type?_tag=[system|]code&code=[system|]code&subject=...&_id=a,b&url=...
+    Type/id
+    ValueSet/id/$expand (or {canonical url}/$expand, ValueSet/$expand?url=)
+"""
+
+from urllib.parse import urlparse, parse_qs, urlencode
+from pathlib import Path
+import gzip
+import json
+import mmap
+import os
+import re
+
+# Page size used when the caller asks for one page at a time
+DEFAULT_PAGE_SIZE = 1000
+
+# Parameters which affect paging and presentation rather than matching
+CONTROL_PARAMS = set(["_count", "_offset", "_cursor", "_summary", "_elements", "_sort", "_total"])
+
+def ReadLines(path, offset=0):
+    """Yield (start, end, line) for each non-blank line in the file, """
+    """beginning at offset. end is where the following line starts"""
+    path = Path(path)
+    if path.suffix == ".gz":
+        with gzip.open(path, 'rb') as inf:
+            if offset > 0:
+                inf.seek(offset)
+            pos = offset
+            for line in inf:
+                start = pos
+                pos += len(line)
+                line = line.strip()
+                if line:
+                    yield start, pos, line
+        return
+
+    with path.open('rb') as inf:
+        size = os.fstat(inf.fileno()).st_size
+        if size == 0:
+            return
+
+        with mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = offset
+            while pos < size:
+                end = mm.find(b"\n", pos)
+                if end < 0:
+                    end = size
+                line = mm[pos:end].strip()
+                start = pos
+                pos = end + 1
+                if line:
+                    yield start, pos, line
+
+class NdjsonResult:
+    """Looks enough like the FHIR client's result for our purposes"""
+    def __init__(self, response, status_code=200, request_url=None):
+        self.response = response
+        self.status_code = status_code
+        self.request_url = request_url
+
+        if response.get('resourceType') == "Bundle":
+            self.entries = response.get('entry', [])
+        else:
+            self.entries = [response]
+
+    def success(self):
+        return self.status_code < 300
+
+def OperationOutcome(message, code="not-found"):
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{
+            "severity": "error",
+            "code": code,
+            "diagnostics": message
+        }]
+    }
+
+def MatchToken(codings, value):
+    """value may be code or system|code (or |code for no system) and """
+    """several options may be separated by commas"""
+    for option in value.split(","):
+        if "|" in option:
+            system, code = option.split("|", 1)
+        else:
+            system, code = None, option
+
+        for coding in codings:
+            if code != "" and coding.get('code') != code:
+                continue
+            if system is not None and system != "" and coding.get('system') != system:
+                continue
+            return True
+    return False
+
+def CompareDate(value, criterion):
+    """Criteria such as gt2023-01-01 or le2023-01-01T00:00:00Z. We compare """
+    """the strings directly, which is correct for consistently formatted """
+    """instants"""
+    prefix = criterion[0:2]
+    if prefix not in ["eq", "ne", "gt", "ge", "lt", "le", "sa", "eb"]:
+        prefix = "eq"
+    else:
+        criterion = criterion[2:]
+
+    if value is None:
+        return False
+    if prefix in ["gt", "sa"]:
+        return value > criterion
+    if prefix == "ge":
+        return value >= criterion
+    if prefix in ["lt", "eb"]:
+        return value < criterion
+    if prefix == "le":
+        return value <= criterion
+    if prefix == "ne":
+        return not value.startswith(criterion)
+    return value.startswith(criterion)
+
+def ReferenceValue(resource, key):
+    ref = resource.get(key)
+    if type(ref) is dict:
+        return ref.get('reference')
+    return None
+
+def BuildMatcher(params, ignored_params=None):
+    """Returns a function which checks a resource against the search """
+    """parameters (as returned by parse_qs)"""
+    if ignored_params is None:
+        ignored_params = set()
+
+    checks = []
+    for param, values in params.items():
+        if param in CONTROL_PARAMS:
+            continue
+
+        for value in values:
+            if param == "_tag":
+                checks.append(lambda r, v=value: MatchToken(r.get('meta', {}).get('tag', []), v))
+            elif param == "code":
+                checks.append(lambda r, v=value: MatchToken(r.get('code', {}).get('coding', []), v))
+            elif param == "identifier":
+                checks.append(lambda r, v=value: MatchToken(
+                        [{"system": x.get('system'), "code": x.get('value')} for x in r.get('identifier', [])], v))
+            elif param == "_id":
+                ids = set(value.split(","))
+                checks.append(lambda r, ids=ids: r.get('id') in ids)
+            elif param in ["subject", "patient"]:
+                refs = set(value.split(","))
+                checks.append(lambda r, refs=refs: ReferenceValue(r, 'subject') in refs)
+            elif param == "url":
+                checks.append(lambda r, v=value: r.get('url') == v.split("|")[0])
+            elif param == "_lastUpdated":
+                checks.append(lambda r, v=value: CompareDate(r.get('meta', {}).get('lastUpdated'), v))
+            elif param not in ignored_params:
+                print(f"NDJSON input ignores the search parameter, {param}")
+                ignored_params.add(param)
+
+    def matches(resource):
+        for check in checks:
+            if not check(resource):
+                return False
+        return True
+    return matches
+
+def ExpandValueSetResource(valueset):
+    """The ValueSet with an expansion built from its compose (unless it """
+    """already has one). Only explicitly listed concepts are included"""
+    if 'expansion' in valueset:
+        return valueset
+
+    contains = []
+    for include in valueset.get('compose', {}).get('include', []):
+        for concept in include.get('concept', []):
+            coding = {
+                "system": include.get('system'),
+                "code": concept['code']
+            }
+            if 'display' in concept:
+                coding['display'] = concept['display']
+            contains.append(coding)
+
+    expanded = dict(valueset)
+    expanded['expansion'] = {
+        "total": len(contains),
+        "contains": contains
+    }
+    return expanded
+
+class NdjsonClient:
+    regex_files = "^{}([.\-_][^/]*)?\.ndjson(\.gz)?$"
+
+    def __init__(self, directory, page_size=DEFAULT_PAGE_SIZE):
+        self.directory = Path(directory)
+        self.page_size = page_size
+
+        # Resource Type => id => (file index, offset)
+        self.id_index = {}
+
+        # Parameters we've already complained about
+        self.ignored_params = set()
+
+        if not self.directory.is_dir():
+            raise FileNotFoundError(f"NDJSON input directory, {directory}, not found")
+
+    @property
+    def target_service_url(self):
+        return self.directory.resolve().as_uri()
+
+    def files(self, resource_type):
+        matcher = re.compile(NdjsonClient.regex_files.format(re.escape(resource_type)))
+        return sorted([x for x in self.directory.iterdir() if matcher.match(x.name)])
+
+    def read_type(self, resource_type, cursor=(0, 0)):
+        """Yield (start, next, resource) for every resource of the type, """
+        """beginning at cursor. start and next are (file index, offset) """
+        """cursors for the resource and the one following it"""
+        file_index, offset = cursor
+        files = self.files(resource_type)
+
+        while file_index < len(files):
+            for start, end, line in ReadLines(files[file_index], offset):
+                yield (file_index, start), (file_index, end), json.loads(line)
+            file_index += 1
+            offset = 0
+
+    def build_matcher(self, params):
+        return BuildMatcher(params, self.ignored_params)
+
+    def parse_query(self, query):
+        url = urlparse(query)
+        path = url.path
+        if url.scheme != "" and path.startswith(self.directory.as_uri()):
+            path = path[len(self.directory.as_uri()):]
+        return path.strip("/"), parse_qs(url.query)
+
+    def stream_resources(self, query):
+        """Yield every matching resource for a search, one at a time"""
+        resource_type, params = self.parse_query(query)
+        matches = self.build_matcher(params)
+        for start, next, resource in self.read_type(resource_type):
+            if matches(resource):
+                yield resource
+
+    def search(self, resource_type, params, recurse=True):
+        matches = self.build_matcher(params)
+
+        if "_summary" in params and params['_summary'][0] == "count":
+            total = sum(1 for s, n, r in self.read_type(resource_type) if matches(r))
+            return {"resourceType": "Bundle", "type": "searchset", "total": total}
+
+        cursor = (0, 0)
+        if "_cursor" in params:
+            cursor = tuple([int(x) for x in params['_cursor'][0].split(".")])
+
+        page_size = self.page_size
+        if "_count" in params:
+            page_size = int(params['_count'][0])
+
+        skip = 0
+        if "_offset" in params:
+            skip = int(params['_offset'][0])
+
+        entries = []
+        next_cursor = None
+        for start, next, resource in self.read_type(resource_type, cursor):
+            if matches(resource):
+                if skip > 0:
+                    skip -= 1
+                    continue
+                entries.append({"resource": resource})
+                if not recurse and len(entries) >= page_size:
+                    next_cursor = next
+                    break
+
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": entries
+        }
+
+        if next_cursor is not None:
+            next_params = dict([(k, v[0]) for k, v in params.items() if k not in ["_cursor", "_offset"]])
+            next_params['_cursor'] = f"{next_cursor[0]}.{next_cursor[1]}"
+            bundle['link'] = [{
+                "relation": "next",
+                "url": f"{resource_type}?{urlencode(next_params)}"
+            }]
+        return bundle
+
+    def read(self, resource_type, id):
+        # The first read for a type builds an index of where each resource 
+        # starts so that we can jump straight to it from then on
+        if resource_type not in self.id_index:
+            index = {}
+            for start, next, resource in self.read_type(resource_type):
+                index[resource['id']] = start
+            self.id_index[resource_type] = index
+
+        start = self.id_index[resource_type].get(id)
+        if start is not None:
+            for start, next, resource in self.read_type(resource_type, start):
+                return resource
+        return None
+
+    def valueset(self, reference):
+        """Find the ValueSet by id (ValueSet/x) or canonical url"""
+        reference = reference.split("|")[0]
+        match = re.search("ValueSet/([^/]+)$", reference)
+        if match and not reference.startswith("http"):
+            return self.read("ValueSet", match.group(1))
+
+        for start, next, resource in self.read_type("ValueSet"):
+            if resource.get('url') == reference:
+                return resource
+        if match:
+            return self.read("ValueSet", match.group(1))
+        return None
+
+    def get(self, query, recurse=True, **kwargs):
+        resource_type, params = self.parse_query(query)
+
+        if resource_type.endswith("$expand"):
+            reference = resource_type[:-len("/$expand")]
+            if "url" in params:
+                reference = params['url'][0]
+            valueset = self.valueset(reference)
+            if valueset is None:
+                return NdjsonResult(OperationOutcome(f"{reference} not found"), 404, query)
+            return NdjsonResult(ExpandValueSetResource(valueset), 200, query)
+
+        if "/" in resource_type:
+            resource_type, id = resource_type.split("/", 1)
+            resource = self.read(resource_type, id)
+            if resource is None:
+                return NdjsonResult(OperationOutcome(f"{resource_type}/{id} not found"), 404, query)
+            return NdjsonResult(resource, 200, query)
+
+        return NdjsonResult(self.search(resource_type, params, recurse), 200, query)
+
+    def post(self, resource, data, **kwargs):
+        return {
+            "status_code": 405,
+            "request_url": resource,
+            "response": OperationOutcome("NDJSON input is read only", "not-supported")
+        }
+
+    def put(self, resource, data, **kwargs):
+        return self.post(resource, data)
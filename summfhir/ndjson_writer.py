@@ -0,0 +1,104 @@
+"""
+Write summaries out as they are built, one NDJSON file per population, rather
+than collecting every summary for the study and dumping them all at once.
+
+Serialization goes through orjson when it is installed (it is several times
+quicker than the json module and produces bytes directly). Files may be
+compressed with gzip or, if zstandard is installed, zstd.
+"""
+
+from pathlib import Path
+import gzip
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SERIALIZERS = ["auto", "orjson", "json"]
+COMPRESSION = ["none", "gzip", "zstd"]
+
+SUFFIXES = {
+    "none": ".ndjson",
+    "gzip": ".ndjson.gz",
+    "zstd": ".ndjson.zst"
+}
+
+def JsonDumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def OrjsonDumps(obj):
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        # orjson is stricter than json (integers beyond 64 bits, non-string
+        # keys), so anything it refuses goes the slow way
+        return JsonDumps(obj)
+
+_dumps = JsonDumps if orjson is None else OrjsonDumps
+
+def SetSerializer(name="auto"):
+    global _dumps
+    assert name in SERIALIZERS, f"Unknown serializer, {name}"
+
+    if name == "json" or (name == "auto" and orjson is None):
+        _dumps = JsonDumps
+    elif orjson is None:
+        print("orjson isn't installed. Continuing with the json module.")
+        _dumps = JsonDumps
+    else:
+        _dumps = OrjsonDumps
+
+def Dumps(obj):
+    """The object as compact JSON (bytes)"""
+    return _dumps(obj)
+
+def OpenCompressed(filename, compression):
+    if compression == "gzip":
+        return gzip.open(filename, 'wb')
+    if compression == "zstd":
+        return zstandard.open(filename, 'wb')
+    return open(filename, 'wb')
+
+class SummaryFile:
+    """One population's summaries, written a line at a time. The file is """
+    """written under a temporary name and moved into place when closed, so """
+    """a failed run never leaves a partial file behind"""
+    def __init__(self, outdir, name, compression="none"):
+        assert compression in COMPRESSION, f"Unknown compression, {compression}"
+        if compression == "zstd" and zstandard is None:
+            print("zstd compression requires zstandard, which isn't installed. "
+                "Continuing with gzip.")
+            compression = "gzip"
+
+        dir = Path(outdir)
+        dir.mkdir(parents=True, exist_ok=True)
+        self.filename = dir / f"{name}{SUFFIXES[compression]}"
+        self.tmpname = dir / f".{self.filename.name}.{os.getpid()}.tmp"
+        self.outf = OpenCompressed(self.tmpname, compression)
+        self.count = 0
+
+    def write(self, summary):
+        self.outf.write(Dumps(summary))
+        self.outf.write(b"\n")
+        self.count += 1
+
+    def close(self, keep=True):
+        self.outf.close()
+        if keep:
+            os.replace(self.tmpname, self.filename)
+        else:
+            self.tmpname.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(keep=exc_type is None)
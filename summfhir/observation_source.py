@@ -11,18 +11,32 @@ from summfhir import (AddCoding,
                     MetaTag)
 
 from summfhir.summary import Summary
+from summfhir.fetch import StreamResources
+from summfhir.metrics import CountEvent
+from summfhir.terminology import ExpandValueSet
+from summfhir.columnar import RawColumn, CategoryColumn, QuantityColumn, ColumnarTable, ColumnarEnabled
+from summfhir.stats import (Moments, QuantileSketch, HyperLogLog, SpaceSaving,
+                            DistinctThreshold, TopValues)
 
 import sys
-import pdb 
 from collections import defaultdict
 
-from summfhir.terms import VAR_SUM_CC, MISSING, COUNT, MEAN
+from summfhir.terms import (VAR_SUM_CC, MISSING, COUNT, MEAN, STD_DEV, 
+                            MINIMUM, MAXIMUM, MEDIAN)
 from copy import deepcopy
 
 
 source_data_code = "74468-0"
 
+def SourceDataQuery(meta_tag):
+    """Search for all of the source data rows associated with a study's tag"""
+    return f"Observation?_tag={meta_tag}&code={source_data_code}"
+
 class ComponentDataParser:
+    # There is a parser per variable per table per population, so we keep 
+    # them as small as we can
+    __slots__ = ['n', 'coding', 'identifier', 'observed', 'mismatched_keys']
+
     def __init__(self, resource):
         """Initialize the parser with the expected number of observations """
         """so that we can properly account for the number of missing"""
@@ -33,7 +47,9 @@ class ComponentDataParser:
         coding = resource['code']
         self.coding = coding
 
-        self.identifier = resource['identifier'][0]
+        # The ObservationDefinitions are shared by every population's tables, 
+        # so we need our own copy of anything we modify
+        self.identifier = deepcopy(resource['identifier'][0])
         self.identifier['system'] = self.identifier['system'].replace("/observationdefinition", "/summary/observation")
 
         # The number of records we've encountered along the way associated
@@ -49,35 +65,169 @@ class ComponentDataParser:
         sys.stderr.write(f"No ParseData function found for {self.__class__.__name__}")
         sys.exit(1)
 
+    def column(self):
+        """The column used to summarize this variable a batch at a time """
+        """(see columnar.py)"""
+        return RawColumn()
+
     def note_mismatched(self, code):
         self.mismatched_keys[code] += 1
 
+    def retract_mismatched(self, code):
+        self.mismatched_keys[code] -= 1
+        if self.mismatched_keys[code] <= 0:
+            del self.mismatched_keys[code]
+
+    def track_retractions(self):
+        """Keep whatever extra state is required to retract values later"""
+        pass
+
+    def retract(self, contribution):
+        """Remove a value previously returned by ParseData"""
+        sys.stderr.write(f"No retract function found for {self.__class__.__name__}")
+        sys.exit(1)
+
+    def merge(self, other):
+        """Add the observations from another parser for the same variable"""
+        self.observed += other.observed
+        for key, count in other.mismatched_keys.items():
+            self.mismatched_keys[key] += count
+
     def list_mismatched_counts(self):
         if len(self.mismatched_keys) > 0:
             counts = "      Not in DD:\n"
 
-            for key in self.mismatched_keys:
+            for key in sorted(self.mismatched_keys):
                 counts += f"        {key}: {self.mismatched_keys[key]}\n"
             return counts
         return ""
 
 class ComponentStringParser(ComponentDataParser):
+    __slots__ = ['unique_values', 'threshold', 'sketch', 'top_values', 'value_refs']
+
     def __init__(self, resource):
         super().__init__(resource)
 
         self.unique_values = set()
 
+        # Once there are more distinct values than this, they are estimated
+        # by the sketch rather than kept in unique_values
+        self.threshold = DistinctThreshold()
+        self.sketch = None
+
+        # The most frequent values, if they were asked for
+        self.top_values = None
+        k, capacity = TopValues()
+        if k > 0:
+            self.top_values = SpaceSaving(k, capacity)
+
+        # value => number of rows with that value. This is only needed when 
+        # values may be retracted, so it isn't kept by default
+        self.value_refs = None
+
     def ParseData(self, component):
-        self.unique_values.add(component['valueString'])
+        value = component['valueString']
+        if self.sketch is not None:
+            self.sketch.add(value)
+        else:
+            self.unique_values.add(value)
+            if len(self.unique_values) > self.threshold:
+                self.switch_to_sketch()
+
+        if self.top_values is not None:
+            self.top_values.add(value)
+
+        if self.value_refs is not None:
+            self.value_refs[value] += 1
         self.observed += 1
+        return value
+
+    def switch_to_sketch(self):
+        # Retracting values requires every one of them, so there's no point 
+        # in trading them for a sketch
+        if self.value_refs is None:
+            self.sketch = HyperLogLog()
+            self.sketch.add_many(self.unique_values)
+            self.unique_values = set()
+
+    def distinct(self):
+        """(count, relative standard error) of the distinct values. The """
+        """error is None when the count is exact"""
+        sketch = self.sketch
+        if sketch is None and len(self.unique_values) > self.threshold:
+            # Tracking retractions keeps every value, but we report the 
+            # estimate anyway so that the results match those of a normal run
+            sketch = HyperLogLog()
+            sketch.add_many(self.unique_values)
+
+        if sketch is None:
+            return len(self.unique_values), None
+        return round(sketch.estimate()), sketch.error()
+
+    def merge(self, other):
+        super().merge(other)
+        if self.sketch is None and other.sketch is None:
+            self.unique_values |= other.unique_values
+            if len(self.unique_values) > self.threshold:
+                self.switch_to_sketch()
+        else:
+            if self.sketch is None:
+                self.switch_to_sketch()
+            if other.sketch is not None:
+                self.sketch.merge(other.sketch)
+            else:
+                self.sketch.add_many(other.unique_values)
+
+        if self.top_values is not None and other.top_values is not None:
+            self.top_values.merge(other.top_values)
+
+        if self.value_refs is not None and other.value_refs is not None:
+            for value, count in other.value_refs.items():
+                self.value_refs[value] += count
+
+    def track_retractions(self):
+        if self.value_refs is None:
+            assert self.observed == 0, "Retractions must be tracked from the start"
+            self.value_refs = defaultdict(int)
+
+    def retract(self, value):
+        self.observed -= 1
+        self.value_refs[value] -= 1
+        if self.value_refs[value] <= 0:
+            del self.value_refs[value]
+            self.unique_values.discard(value)
+
+    def most_frequent(self):
+        """[(value, count, error)] for the most frequent values, if tracked"""
+        if self.top_values is None:
+            return []
+
+        if self.value_refs is not None:
+            # Tracking retractions gives us exact counts for everything. The
+            # sketch's counts can't be retracted, so these are what we use
+            values = sorted(self.value_refs, key=lambda value: (-self.value_refs[value], value))
+            return [(value, self.value_refs[value], 0) for value in values[0:self.top_values.k]]
+        return self.top_values.top()
 
     def return_text_results(self):       
-        unique_count = len(self.unique_values)
-        return f"""      Unique Values: {unique_count}
-      missing: {self.n - self.observed}\n"""
+        unique_count, error = self.distinct()
+        if error is not None:
+            unique_count = f"~{unique_count} (±{200 * error:.1f}%)"
+
+        top = ""
+        most_frequent = self.most_frequent()
+        if len(most_frequent) > 0:
+            top = "      Top Values:\n"
+            for value, count, error in most_frequent:
+                if error > 0:
+                    count = f"{count} (overcounted by at most {error})"
+                top += f"        {value}: {count}\n"
+
+        return f"""      Unique Values: {unique_count}\n""" + top + \
+f"""      missing: {self.n - self.observed}\n"""
 
     def BuildComponents(self):
-        unique_count = len(self.unique_values)
+        unique_count, error = self.distinct()
         component = [{
             "code": COUNT.as_coding(),
             "valueInteger": unique_count,
@@ -89,30 +239,59 @@ class ComponentStringParser(ComponentDataParser):
 
         component[0]["code"]["text"] = "Unique Values"
 
+        if error is not None:
+            # The bounds are two standard errors either side of the estimate
+            margin = round(2 * error * unique_count)
+            component[0]["referenceRange"] = [{
+                "low": { "value": unique_count - margin },
+                "high": { "value": unique_count + margin },
+                "text": "Unique Values is a HyperLogLog estimate, within "
+                        "these bounds with 95% confidence"
+            }]
+
+        for value, count, error in self.most_frequent():
+            top = {
+                "code": {
+                    "text": value
+                },
+                "valueInteger": count
+            }
+            if error > 0:
+                top["referenceRange"] = [{
+                    "low": { "value": count - error },
+                    "high": { "value": count },
+                    "text": "Approximate count of a frequent value"
+                }]
+            component.append(top)
+
         return component
 
 
 class ComponentValueSetParser(ComponentDataParser):
+    __slots__ = ['valid_values', 'value_counts', 'vsref']
+
     def __init__(self, resource):
         super().__init__(resource)
 
         self.valid_values = {}
         self.value_counts = {}
-        client = GetInputClient()
 
         self.vsref = resource['validCodedValueSet']['reference']
-        result = client.get(f"{self.vsref}/$expand")
+        expansion = ExpandValueSet(self.vsref)
 
-        if result.success():
+        if expansion is not None:
             # We know ahead of time every possible category that might be 
             # encountered, based on the VS. So, we'll set each to zero
             # just to provide a comprehensive report including those that
             # are never encountered
-            for newcoding in result.entries[0]['expansion']['contains']:
+            for newcoding in expansion:
                 coding = Coding(resource=newcoding)
                 self.valid_values[coding.code] = coding
                 self.value_counts[coding.code] = 0
 
+    def column(self):
+        return CategoryColumn(self.valid_values)
+
     def extract_code_from_component(self, component):
         for coding in component['valueCodeableConcept']['coding']:
             code = coding['code']
@@ -123,20 +302,37 @@ class ComponentValueSetParser(ComponentDataParser):
     def ParseData(self, component):
         if 'valueString' in component:
             self.note_mismatched(component['valueString'])
+            return ("mismatch", component['valueString'])
         elif 'valueCodeableConcept' in component:
             try:
-                self.value_counts[self.extract_code_from_component(component)['code']] += 1
+                code = self.extract_code_from_component(component)['code']
+                self.value_counts[code] += 1
+                return ("code", code)
             except:
                 if 'text' in component['valueCodeableConcept']:
                     self.note_mismatched(component['valueCodeableConcept']['text'])
+                    return ("mismatch", component['valueCodeableConcept']['text'])
                 else:
-                    print(component)
-                    print(", ".join(sorted(self.value_counts.keys())))
-                    pdb.set_trace()
+                    print(f"{self.code}: no coding matches the value set, skipping it:")
+                    print(component['valueCodeableConcept'])
+                    CountEvent("source values unparsed")
         else:
-            print("Not sure what to do with this one:")
+            print(f"{self.code}: not sure what to do with this one, skipping it:")
             print(component)
-            pdb.set_trace()
+            CountEvent("source values unparsed")
+        return (None, None)
+
+    def merge(self, other):
+        super().merge(other)
+        for code, count in other.value_counts.items():
+            self.value_counts[code] += count
+
+    def retract(self, contribution):
+        kind, value = contribution
+        if kind == "code":
+            self.value_counts[value] -= 1
+        elif kind == "mismatch":
+            self.retract_mismatched(value)
 
     def return_text_results(self):        
         result = f""
@@ -173,6 +369,8 @@ class ComponentValueSetParser(ComponentDataParser):
 
 
 class ComponentQuantityParser(ComponentDataParser):
+    __slots__ = ['min', 'max', 'units', 'moments', 'quantiles', 'count']
+
     def __init__(self, resource):
         super().__init__(resource)
 
@@ -194,17 +392,59 @@ class ComponentQuantityParser(ComponentDataParser):
             if units is not None:
                 self.units = GetValue(units, 'code')
 
-        # We'll capture sum and count to produce a mean
-        self.sum = 0.0
+        # The moments give us the mean and standard deviation and the sketch 
+        # the quantiles and extremes. Neither holds on to the values 
+        # themselves and neither cares what order the values arrive in
+        self.moments = Moments()
+        self.quantiles = QuantileSketch()
         self.count = 0
 
+    def column(self):
+        return QuantityColumn()
+
     def ParseData(self, component):
+        self.count += 1
         if 'valueQuantity' in component:
-            self.sum += component['valueQuantity']['value']
+            value = component['valueQuantity']['value']
+            self.moments.add(value)
+            self.quantiles.add(value)
+            return ("value", value)
         elif 'valueString' in component:
             self.note_mismatched(component['valueString'])
-        self.count += 1
-
+            return ("mismatch", component['valueString'])
+        return (None, None)
+
+    def merge(self, other):
+        super().merge(other)
+        self.moments.merge(other.moments)
+        self.quantiles.merge(other.quantiles)
+        self.count += other.count
+
+    def retract(self, contribution):
+        kind, value = contribution
+        self.count -= 1
+        if kind == "value":
+            # The sums are exact, so this leaves them just as if we had never
+            # seen the value
+            self.moments.remove(value)
+            self.quantiles.remove(value)
+        elif kind == "mismatch":
+            self.retract_mismatched(value)
+
+
+    def mean(self):
+        # Values that weren't quantities (those not in the DD) have no part
+        # in the mean
+        return self.moments.mean()
+
+    def statistics(self):
+        """(coding, value) for each of the distribution's statistics"""
+        return [
+            (STD_DEV, self.moments.std_dev()),
+            (MINIMUM, self.quantiles.min),
+            (MEDIAN, self.quantiles.quantile(0.5)),
+            (MAXIMUM, self.quantiles.max)
+        ]
 
     def BuildComponents(self):
         component = [{
@@ -218,22 +458,40 @@ class ComponentQuantityParser(ComponentDataParser):
         }
         ]
 
-        try:
-            component[1]["valueQuantity"] = { "value": self.sum/float(self.count) }
-        except:
+        mean = self.mean()
+        if mean is not None:
+            component[1]["valueQuantity"] = { "value": mean }
+        else:
             component[1]["valueString"] = "NaN"
 
+        for coding, value in self.statistics():
+            if value is not None:
+                component.append({
+                    "code": coding.as_coding(),
+                    "valueQuantity": { "value": value }
+                })
+            else:
+                component.append({
+                    "code": coding.as_coding(),
+                    "valueString": "NaN"
+                })
+
         return component
 
     def return_text_results(self):       
-        mean = "NaN"
-        try:
-            mean = self.sum/float(self.count)
-        except:
+        mean = self.mean()
+        if mean is None:
             mean = "NaN"
+
+        stats = ""
+        for coding, value in self.statistics():
+            if value is None:
+                value = "NaN"
+            stats += f"      {coding.display.lower()}: {value}\n"
+
         return f"""      N: {self.count}\n""" + self.list_mismatched_counts() + \
-f"""      mean: {mean}
-      missing: {self.n - self.count}\n"""
+f"""      mean: {mean}\n""" + stats + \
+f"""      missing: {self.n - self.count}\n"""
 
 def SelectKeyCode(coding):
     # For now, just take the first
@@ -244,7 +502,14 @@ def SelectKeyCode(coding):
     # to finalize a solution to this problem for everything to work correctly. 
     return f"{coding['coding'][0]['system'].split('/')[-1]}|{coding['coding'][0]['code']}"
 
+def GetObservationTable(resource):
+    """Return the code for the table a source data row belongs to"""
+    return resource['code']['coding'][1]['code']
+
 class SourceTable(Summary):
+    # The only elements we look at, so there's no reason to pull the rest
+    ELEMENTS = ["id", "code", "component"]
+
     def __init__(self, activitydef, observationdefs):
 
         meta_tag = activitydef['meta']['tag'][0]
@@ -253,6 +518,14 @@ class SourceTable(Summary):
         self.title = GetValue(activitydef, "title")
         self.observation_definitions = {}
 
+        # (system, code) of a component's first coding => (variable code, 
+        # parser), so that rows needn't build each component's variable code
+        self.variables = {}
+
+        # Component codes which aren't among the table's variables. Each is 
+        # reported the first time it turns up
+        self.skipped_codes = set()
+
         self.n = 0
 
         odids = set([req['reference'].split("/")[-1] for req in activitydef['observationResultRequirement']])
@@ -279,48 +552,97 @@ class SourceTable(Summary):
             print(f"What do we do with these? {','.join(permitted_data_types)}")
             sys.exit(1)
 
-        self.observation_definitions[parser.code] = parser
+        code = parser.code
+        self.observation_definitions[code] = parser
+
+        coding = parser.coding['coding'][0]
+        self.variables[(coding['system'], coding['code'])] = (code, parser)
 
     def load_source_data(self):
         # Load all of the observations associated with this study and
         # the source data code
         
-        client = GetInputClient()
         print(f"Pulling observations for tag: {self.meta_tag}")
 
-        result = client.get(f"Observation?_tag={self.meta_tag}&code={source_data_code}")
-        if result.success():
-            for entry in result.entries:
-                self.ParseData(entry['resource'])
+        for resource in StreamResources(SourceDataQuery(self.meta_tag), elements=SourceTable.ELEMENTS):
+            self.ParseData(resource)
     
     def get_observation_table(self, resource):
-        return resource['code']['coding'][1]['code']
+        return GetObservationTable(resource)
 
     def ParseData(self, resource):
         # Make sure we are looking at the right table
         resource_table = self.get_observation_table(resource)
 
         if resource_table == self.table_name:
-            self.n += 1
-            for component in resource['component']:
-                coding = component['code']
-                try:
-                    code = SelectKeyCode(coding)
-                except:
-                    print(f"There was a problem getting the code from the following")
-                    print(coding)
-                    pdb.set_trace()
-
-                # If there are more than one table in the dataset, then not all 
-                # variables can be expected to be present in this table's row
-                if code in self.observation_definitions:
-                    self.observation_definitions[code].ParseData(component)
-                else:
-                    print("\t" + "\n\t".join(sorted(self.observation_definitions.keys())))
-                    print(f"{self.table_name} skipping {code}")
+            self.ParseRow(resource)
+
+    def variable_code(self, coding):
+        return SelectKeyCode(coding)
+
+    def ParseRow(self, resource):
+        """Summarize a row which is already known to belong to this table. """
+        """Returns the row's contribution to the table which can be passed """
+        """to retract in order to remove it again"""
+        contribution = []
+        self.n += 1
+        variables = self.variables
+        for component in resource['component']:
+            try:
+                coding = component['code']['coding'][0]
+                variable = variables.get((coding['system'], coding['code']))
+            except:
+                variable = None
 
-                    pdb.set_trace()
+            if variable is None:
+                variable = self.add_variable(component['code'])
+                if variable is None:
+                    continue
 
+            code, parser = variable
+            contribution.append((code, parser.ParseData(component)))
+        return contribution
+
+    def add_variable(self, coding):
+        """Look up a component code that isn't in variables yet. Its system """
+        """may differ from the ObservationDefinition's in all but the last """
+        """part, which is all SelectKeyCode considers"""
+        try:
+            code = SelectKeyCode(coding)
+        except:
+            print(f"There was a problem getting the code from the following")
+            print(coding)
+            CountEvent("source components skipped")
+            return None
+
+        # If there are more than one table in the dataset, then not all 
+        # variables can be expected to be present in this table's row
+        if code not in self.observation_definitions:
+            if code not in self.skipped_codes:
+                self.skipped_codes.add(code)
+                print("\t" + "\n\t".join(sorted(self.observation_definitions.keys())))
+                print(f"{self.table_name} skipping {code}")
+            CountEvent("source components skipped")
+            return None
+
+        variable = (code, self.observation_definitions[code])
+        self.variables[(coding['coding'][0]['system'], coding['coding'][0]['code'])] = variable
+        return variable
+
+    def track_retractions(self):
+        for parser in self.observation_definitions.values():
+            parser.track_retractions()
+
+    def retract(self, contribution):
+        self.n -= 1
+        for code, value in contribution:
+            self.observation_definitions[code].retract(value)
+
+    def merge(self, other):
+        """Add the rows summarized by another copy of this table"""
+        self.n += other.n
+        for code, parser in other.observation_definitions.items():
+            self.observation_definitions[code].merge(parser)
 
     def BuildSummaryObservations(self, population):
         # There will be one observation per code
@@ -345,7 +667,7 @@ class SourceTable(Summary):
             obsdef = self.observation_definitions[od]
             obsdef.n = self.n
 
-            summary['identifier'] = [obsdef.identifier]
+            summary['identifier'] = [deepcopy(obsdef.identifier)]
             # Let's inject our population ID into this value just to permit 
             # multiple consent IDs
             summary['identifier'][0]['value'] = f"{population.id}.{summary['identifier'][0]['value']}"
@@ -366,4 +688,85 @@ class SourceTable(Summary):
             result += f"    {od}:\n"
             result += self.observation_definitions[od].return_text_results()
 
-        return result
\ No newline at end of file
+        return result
+
+class SourceRouter:
+    """Pull the source data rows for a study once and hand each row to the """
+    """table(s) it belongs to, rather than having every table pull every row"""
+    def __init__(self, meta_tag, tables=None):
+        self.meta_tag = meta_tag
+
+        # table code => SourceTables (one per population) for that table
+        self.tables = defaultdict(list)
+
+        # Rows whose table code doesn't match any of our tables
+        self.unrouted = defaultdict(int)
+
+        # Rows pulled by load_source_data
+        self.rows = 0
+
+        if tables is not None:
+            for table in tables:
+                self.add_table(table)
+
+    def add_table(self, table):
+        self.tables[table.table_name].append(table)
+
+    def route(self, resource):
+        """Summarize the row in each of its tables, returning the table code """
+        """and the row's contribution (which is the same for every copy of """
+        """the table)"""
+        table_code = GetObservationTable(resource)
+
+        tables = self.tables.get(table_code)
+        if tables is None:
+            self.unrouted[table_code] += 1
+            return table_code, None
+
+        for table in tables:
+            contribution = table.ParseRow(resource)
+        return table_code, contribution
+
+    def route_columns(self, resource, columns):
+        table_code = GetObservationTable(resource)
+
+        table = columns.get(table_code)
+        if table is None:
+            self.unrouted[table_code] += 1
+        else:
+            table.add_row(resource)
+
+    def retract(self, table_code, contribution):
+        for table in self.tables.get(table_code, []):
+            table.retract(contribution)
+
+    def load_source_data(self, query=None, record=None):
+        """Summarize every row returned by query (all of the study's source """
+        """rows by default). If provided, record is called with each row, """
+        """its table code and its contribution"""
+        if query is None:
+            query = SourceDataQuery(self.meta_tag)
+        print(f"Pulling observations for tag: {self.meta_tag}")
+
+        # The columnar engine doesn't report each row's contribution, so it's
+        # only an option when nobody is recording them
+        columns = None
+        if record is None and ColumnarEnabled():
+            columns = dict([(code, ColumnarTable(tables)) for code, tables in self.tables.items()])
+
+        for resource in StreamResources(query, elements=SourceTable.ELEMENTS):
+            self.rows += 1
+            if columns is not None:
+                self.route_columns(resource, columns)
+            else:
+                table_code, contribution = self.route(resource)
+                if record is not None and contribution is not None:
+                    record(resource, table_code, contribution)
+
+        if columns is not None:
+            for table in columns.values():
+                table.flush()
+
+        for table_code in sorted(self.unrouted):
+            print(f"{self.unrouted[table_code]} rows found for table, "
+                    f"{table_code}, which has no ActivityDefinition")
@@ -0,0 +1,203 @@
+"""
+Summarize NDJSON input across a pool of processes.
+
+The input files are split into shards (line aligned byte ranges of the plain
+files, whole files for gzipped ones) and each worker process summarizes its
+shards into fresh Patient, Condition and SourceTable accumulators. The
+partial accumulators are sent back and merged, in shard order, into the
+populations' summaries. Every accumulator's merge() produces the same state
+we'd have gotten by feeding it the shards' resources one after another, so
+the results match the serial path. The one exception is the approximate most
+frequent values (--top-values, see stats.SpaceSaving), whose merged counts
+carry larger errors, so fewer or different values may be reported once a
+variable has more distinct values than counters.
+"""
+
+from summfhir.ndjson_client import NdjsonClient, ReadLines, BuildMatcher
+from summfhir.observation_source import GetObservationTable
+from summfhir.columnar import ColumnarTable, ColumnarEnabled, UseColumnar
+from summfhir.patient import Patient
+from summfhir.condition import Condition
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from pathlib import Path
+from copy import deepcopy
+import json
+import os
+
+# Plain NDJSON files are broken up into pieces of roughly this size
+DEFAULT_SHARD_SIZE = 64 * 1024 * 1024
+
+# Whatever the worker needs beyond the shard itself. This is set once per
+# process by the pool's initializer rather than being sent with every shard
+_context = None
+
+def CanParallelize(client):
+    return isinstance(client, NdjsonClient)
+
+def ShardFile(path, shard_size=DEFAULT_SHARD_SIZE):
+    """Split a file into line aligned (path, start, end) byte ranges. An """
+    """end of None means the rest of the file"""
+    path = Path(path)
+    if path.suffix == ".gz":
+        return [(str(path), 0, None)]
+
+    size = path.stat().st_size
+    shards = []
+    start = 0
+    with path.open('rb') as inf:
+        while start < size:
+            end = start + shard_size
+            if end >= size:
+                shards.append((str(path), start, None))
+                break
+
+            # Move the boundary forward to the start of the next line
+            inf.seek(end)
+            inf.readline()
+            end = inf.tell()
+            shards.append((str(path), start, end))
+            start = end
+    return shards
+
+def ReadShard(path, start, end):
+    for line_start, line_end, line in ReadLines(path, start):
+        if end is not None and line_start >= end:
+            break
+        yield json.loads(line)
+
+def _init_worker(context):
+    global _context
+    _context = context
+    UseColumnar(context.get('columnar', False))
+
+def _summarize_shard(shard):
+    """Runs inside the worker: build partial summaries for one shard. """
+    """Returns the number of matching resources and the partials"""
+    path, start, end = shard
+    kind = _context['kind']
+    matches = BuildMatcher(_context['params'])
+    matched = 0
+
+    if kind == "Patient":
+        # population index => Patient
+        partials = {}
+        for resource in ReadShard(path, start, end):
+            if matches(resource):
+                matched += 1
+                for index in _context['member_index'].get(f"Patient/{resource['id']}", []):
+                    if index not in partials:
+                        partials[index] = Patient()
+                    partials[index].add_resource(resource)
+        return matched, partials
+
+    if kind == "Condition":
+        partials = {}
+        for resource in ReadShard(path, start, end):
+            if matches(resource) and 'subject' in resource:
+                matched += 1
+                for index in _context['member_index'].get(resource['subject']['reference'], []):
+                    if index not in partials:
+                        partials[index] = Condition()
+                    partials[index].add_resource(resource)
+        return matched, partials
+
+    # Source tables start out as (pickled) empty copies of the real tables
+    tables = deepcopy(_context['tables'])
+    if ColumnarEnabled():
+        columns = dict([(code, ColumnarTable([table])) for code, table in tables.items()])
+        for resource in ReadShard(path, start, end):
+            if matches(resource):
+                matched += 1
+                table = columns.get(GetObservationTable(resource))
+                if table is not None:
+                    table.add_row(resource)
+        for table in columns.values():
+            table.flush()
+        return matched, tables
+
+    for resource in ReadShard(path, start, end):
+        if matches(resource):
+            matched += 1
+            table = tables.get(GetObservationTable(resource))
+            if table is not None:
+                table.ParseRow(resource)
+    return matched, tables
+
+class ParallelSummarizer:
+    def __init__(self, client, workers=None, shard_size=DEFAULT_SHARD_SIZE):
+        self.client = client
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.shard_size = shard_size
+
+        # The number of resources the workers have matched so far
+        self.records = 0
+
+    def shards(self, resource_type):
+        shards = []
+        for filename in self.client.files(resource_type):
+            shards += ShardFile(filename, self.shard_size)
+        return shards
+
+    def run(self, query, context):
+        """Yield the partial summaries for each shard, in shard order"""
+        resource_type, params = self.client.parse_query(query)
+        context['kind'] = resource_type
+        context['params'] = params
+
+        shards = self.shards(resource_type)
+        if len(shards) == 0:
+            return
+
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(shards)),
+                                 initializer=_init_worker,
+                                 initargs=(context,)) as executor:
+            for matched, partials in executor.map(_summarize_shard, shards):
+                self.records += matched
+                yield partials
+
+    def member_index(self, populations):
+        """Patient reference => indices of the populations it belongs to"""
+        index = {}
+        for pop_index, population in enumerate(populations):
+            for member in population.members:
+                index.setdefault(member, []).append(pop_index)
+        return index
+
+    def summarize_patients(self, populations, tag):
+        for population in populations:
+            population.init_patients()
+
+        context = {"member_index": self.member_index(populations)}
+        for partials in self.run(f"Patient?_tag={tag}", context):
+            for index, partial in partials.items():
+                populations[index].summaries['Demographics'].merge(partial)
+
+    def summarize_conditions(self, populations, tag):
+        for population in populations:
+            population.init_conditions()
+
+        context = {"member_index": self.member_index(populations)}
+        for partials in self.run(f"Condition?_tag={tag}", context):
+            for index, partial in partials.items():
+                populations[index].summaries['Conditions'].merge(partial)
+
+    def summarize_source(self, query, tables):
+        """tables is a list of all populations' SourceTables. Since every """
+        """population's copy of a table sees the same rows, the workers only """
+        """summarize one copy of each and the result is merged into all """
+        """of them"""
+        templates = {}
+        for table in tables:
+            if table.table_name not in templates:
+                templates[table.table_name] = table
+
+        context = {
+            "tables": templates,
+            "columnar": ColumnarEnabled()
+        }
+        for partials in self.run(query, context):
+            for table in tables:
+                table.merge(partials[table.table_name])
@@ -11,7 +11,6 @@ from summfhir import AddCoding, MetaTag
 from summfhir.summary import Summary, ChooseCode
 from summfhir.terms import VAR_SUM_CC, MISSING, ETHNICITY, RACE, SEX
 from copy import deepcopy
-import pdb 
 
 System = {
     "race": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
@@ -38,18 +37,30 @@ def GetProperExtension(extensions, url):
     return text_option
 
 class Patient(Summary):
-    def __init__(self, resources):
+    # The only elements we look at, so there's no reason to pull the rest
+    ELEMENTS = ["id", "identifier", "extension", "gender"]
+
+    def __init__(self, resources=None):
         super().__init__()
 
+        # This gets set from the first resource we see, which allows patients
+        # to be streamed in one at a time rather than handed over as a list
+        self.identifier_system = None
+
+        if resources is not None:
+            for resource in resources:
+                self.add_resource(resource)
+
+    def add_resource(self, resource):
         # Let's grab some identifier details from the first resource as a 
         # starting point for a system to use inside each of our summary objects
-        self.identifier_system = resources[0]['identifier'][0]['system'] + "/summary"
+        if self.identifier_system is None:
+            self.identifier_system = resource['identifier'][0]['system'] + "/summary"
 
-        self.resource_count = len(resources)
-        for resource in resources:
-            self.add_resource(resource)
+        # (domain, value) for each count this patient contributes to
+        contribution = []
 
-    def add_resource(self, resource):
+        self.resource_count += 1
         for extn in resource['extension']:
             if extn['url'] == System['race']:
                 
@@ -61,24 +72,26 @@ class Patient(Summary):
                     race = race_ext['valueString']
                     race_coding = race_ext
                     
-                if race not in self.observed_codes:
+                if race not in self.observed_codes['race']:
                     self.observed_codes['race'][race] = race_coding
 
                 self.counts['race'][race] += 1
+                contribution.append(('race', race))
 
             elif extn['url'] == System['ethnicity']:
                 eth_ext = GetProperExtension(extn['extension'], "ombCategory")
-                if 'valueCoding' in race_ext:
+                if 'valueCoding' in eth_ext:
                     eth = eth_ext['valueCoding']['display']
                     eth_coding = eth_ext['valueCoding']
                 else:
                     eth = eth_ext['valueString']
                     eth_coding = eth_ext
 
-                if eth not in self.observed_codes:
+                if eth not in self.observed_codes['ethnicity']:
                     self.observed_codes['ethnicity'][eth] = eth_coding
 
                 self.counts['ethnicity'][eth] += 1
+                contribution.append(('ethnicity', eth))
         
         if 'gender' in resource:
             gender = resource['gender']
@@ -87,6 +100,9 @@ class Patient(Summary):
                 self.observed_codes['gender'][gender] = AddCoding(gender, gender.capitalize(), "http://hl7.org/fhir/administrative-gender")
 
             self.counts['gender'][resource['gender']] += 1
+            contribution.append(('gender', gender))
+
+        return contribution
 
     def return_text_results(self):        
         result = ""
@@ -0,0 +1,132 @@
+"""
+Decide how to pull the Patients and Conditions belonging to a set of members.
+
+Scanning everything with the study tag is a handful of large pages, which is
+the right call when the members make up most of the study. When a small
+group sits inside a large study, it is far cheaper to look up the members
+directly, in chunks of _id (Patients) or subject (Conditions) values. We
+estimate the cost of each from the tag's _summary=count and pick the lower.
+"""
+
+from summfhir import GetInputClient
+from summfhir.fetch import StreamResources, SearchPages, Prefetch
+from math import ceil
+
+SCAN = "tag scan"
+LOOKUP = "member lookup"
+
+# Number of ids (or subject references) sent in a single lookup
+CHUNK_SIZE = 100
+
+# The ids have to fit into the URL
+MAX_QUERY_LENGTH = 1800
+
+# The page size we assume the server uses for the tag scan
+SCAN_PAGE_SIZE = 50
+
+# Roughly how many resources we could have transferred in the time it takes
+# to make one more request
+REQUEST_COST = 20
+
+def TagCount(resource_type, tag, client=None):
+    """The number of resources of the type with the tag, or None if the """
+    """server won't tell us"""
+    if client is None:
+        client = GetInputClient()
+
+    result = client.get(f"{resource_type}?_tag={tag}&_summary=count", recurse=False)
+    if not result.success():
+        return None
+    return result.response.get('total')
+
+def Chunks(values, chunk_size=CHUNK_SIZE, max_length=None):
+    """Break the values into lists of no more than chunk_size whose comma """
+    """separated length stays within max_length (if provided)"""
+    chunk = []
+    length = 0
+    for value in values:
+        if len(chunk) > 0 and (len(chunk) >= chunk_size or
+                (max_length is not None and length + len(value) + 1 > max_length)):
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(value)
+        length += len(value) + 1
+
+    if len(chunk) > 0:
+        yield chunk
+
+def SearchCost(requests, resources):
+    return requests * REQUEST_COST + resources
+
+def PlanMembershipFetch(resource_type, tag, members, client=None):
+    """Returns (SCAN or LOOKUP, reason) for pulling the resources of the """
+    """type which belong to the members (Patient references)"""
+    if client is None:
+        client = GetInputClient()
+
+    # Local input gets read in full no matter which we choose
+    if hasattr(client, 'stream_resources'):
+        return SCAN, "input is read locally"
+
+    if len(members) == 0:
+        return LOOKUP, "there are no members"
+
+    total = TagCount(resource_type, tag, client)
+    if total is None:
+        return SCAN, f"the server couldn't count the {resource_type} resources"
+
+    # Patients are one to one with the members. For everything else, we
+    # assume the members have their share of the tagged resources
+    expected = min(len(members), total)
+    if resource_type != "Patient":
+        patients = TagCount("Patient", tag, client)
+        expected = total
+        if patients:
+            expected = min(total, ceil(total * len(members) / patients))
+
+    scan_cost = SearchCost(ceil(total / SCAN_PAGE_SIZE), total)
+    lookup_cost = SearchCost(max(ceil(len(members) / CHUNK_SIZE),
+                                 ceil(expected / SCAN_PAGE_SIZE)), expected)
+
+    reason = f"{len(members)} members, {total} tagged {resource_type} " + \
+            f"resources; estimated cost {scan_cost} to scan, {lookup_cost} to look up"
+    if lookup_cost < scan_cost:
+        return LOOKUP, reason
+    return SCAN, reason
+
+def MemberResources(resource_type, tag, members, label, client=None, elements=None):
+    """Yield the resources of the type (Patient or Condition) with the tag """
+    """which may belong to the members, using whichever plan is cheaper. """
+    """The tag scan returns non-members as well, so callers must still """
+    """check membership"""
+    if client is None:
+        client = GetInputClient()
+
+    plan, reason = PlanMembershipFetch(resource_type, tag, members, client)
+    print(f"{label} {resource_type}: {plan} ({reason})")
+
+    if plan == SCAN:
+        yield from StreamResources(f"{resource_type}?_tag={tag}", client, elements)
+        return
+
+    if resource_type == "Patient":
+        param = "_id"
+        values = [x.split("/")[-1] for x in sorted(members)]
+    else:
+        param = "subject"
+        values = sorted(members)
+
+    # The chunks are prefetched as one stream of pages so that the next 
+    # chunk's search is underway while the last page of this one is summarized
+    def pages():
+        for chunk in Chunks(values, CHUNK_SIZE, MAX_QUERY_LENGTH):
+            params = {
+                "_tag": tag,
+                param: ",".join(chunk)
+            }
+            yield from SearchPages(resource_type, params, client, elements)
+
+    for entries in Prefetch(pages()):
+        for entry in entries:
+            yield entry['resource']
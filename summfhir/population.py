@@ -3,11 +3,16 @@ The population associated with a group of research subjects for which summaries
 will be produced
 """
 
-from summfhir import GetInputClient, OfficialIdentifier
+from summfhir import OfficialIdentifier
 from summfhir.patient import Patient
 from summfhir.condition import Condition
-from summfhir.observation_source import SourceTable
+from summfhir.observation_source import SourceTable, SourceRouter
+from summfhir.fetch import StreamResources
+from summfhir.planner import MemberResources
+from summfhir.terminology import PrefetchValueSets
+from summfhir.metrics import Phase
 from collections import defaultdict 
+from concurrent.futures import ThreadPoolExecutor
 from re import compile
 import sys
 
@@ -19,6 +24,30 @@ class NoTableFound(Exception):
     def msg(self):
         return f"The summary data for '{self.identifier}' has no table code "
 
+def LoadSourceDefinitions(tag):
+    """Pull the ActivityDefinitions and ObservationDefinitions describing """
+    """the source tables for the study"""
+    # The two searches don't depend on one another, so they run side by side
+    with Phase("source definitions", tag=tag) as phase:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            activity_definitions, observation_definitions = executor.map(
+                    lambda query: list(StreamResources(query)),
+                    [f"ActivityDefinition?_tag={tag}", f"ObservationDefinition?_tag={tag}"])
+        phase.add(len(activity_definitions) + len(observation_definitions))
+
+    if len(activity_definitions) * len(observation_definitions) < 1:
+        print(f"{len(activity_definitions)} Activity definitions and "
+        f"{len(observation_definitions)} Observation definitions. Unable to "
+        "proceed with summarization. ")
+        sys.exit(1)
+
+    # Expand the ValueSets up front and all at once rather than one at a time
+    # as each of the parsers is built
+    with Phase("expand valuesets", tag=tag) as phase:
+        phase.add(PrefetchValueSets(observation_definitions))
+
+    return activity_definitions, observation_definitions
+
 class Population:
     regex_data_table = compile("CodeSystem/[\w\-/]*/dataset")
     def __init__(self, resource):
@@ -34,37 +63,42 @@ class Population:
     def is_member(self, patient_ref):
         return patient_ref in self.members
 
-    # This definitely could use the references in self.members, but if we can
-    # take advantage of this feature, then this should be faster
     def summarize_patients(self):
-        all_patients = []
-
-        client = GetInputClient()
-        result = client.get(f"Patient?_tag={self.tag}")
-        if result.success():
-            for entry in result.entries:
-                patient = entry['resource']
+        self.init_patients()
+
+        # Patients are fed to the summary as each page arrives, so we never
+        # hold more than a single page of them
+        with Phase("patients", population=self.id) as phase:
+            for patient in MemberResources("Patient", self.tag, self.members, self.id, 
+                                            elements=Patient.ELEMENTS):
+                phase.add()
                 if self.is_member(f"Patient/{patient['id']}"):
-                    all_patients.append(patient)
-        
+                    self.add_patient(patient)
+
+    def init_patients(self):
         # At some point, we'll handle no tag options 
-        self.summaries['Demographics'] = Patient(all_patients)
+        self.summaries['Demographics'] = Patient()
 
-    def summarize_conditions(self):
-        all_conditions = []
+    def add_patient(self, patient):
+        return self.summaries['Demographics'].add_resource(patient)
 
-        client = GetInputClient()
-        result = client.get(f"Condition?_tag={self.tag}")
-        if result.success():
-            for entry in result.entries:
-                condition = entry['resource']
+    def summarize_conditions(self):
+        self.init_conditions()
 
+        with Phase("conditions", population=self.id) as phase:
+            for condition in MemberResources("Condition", self.tag, self.members, self.id,
+                                            elements=Condition.ELEMENTS):
+                phase.add()
                 if 'subject' in condition:
                     if self.is_member(condition['subject']['reference']):
-                        all_conditions.append(condition)
-        
+                        self.add_condition(condition)
+
+    def init_conditions(self):
         # At some point, we'll handle no tag options 
-        self.summaries['Conditions'] = Condition(all_conditions)
+        self.summaries['Conditions'] = Condition()
+
+    def add_condition(self, condition):
+        return self.summaries['Conditions'].add_resource(condition)
 
     def source_table(self, coding):
         for code in coding:
@@ -73,28 +107,23 @@ class Population:
         return None
 
     def summarize_source(self):
-        activity_definitions = []
-        observation_definitions = []
-
-        client = GetInputClient()
-        result = client.get(f"ActivityDefinition?_tag={self.tag}")
-        if result.success():
-            activity_definitions = [entity['resource'] for entity in result.entries]
-
-        result = client.get(f"ObservationDefinition?_tag={self.tag}")
-        if result.success():
-            observation_definitions = [entity['resource'] for entity in result.entries]
-
-        if len(activity_definitions) * len(observation_definitions) < 1:
-            print(f"{len(activity_definitions)} Activity definitions and "
-            "{len(observation_definitions). Unable to proceed with "
-            "summarization. ")
-            sys.exit(1)
-
+        activity_definitions, observation_definitions = LoadSourceDefinitions(self.tag)
+
+        tables = self.init_source_tables(activity_definitions, observation_definitions)
+        if len(tables) > 0:
+            router = SourceRouter(tables[0].meta_tag, tables)
+            with Phase("source rows", population=self.id) as phase:
+                router.load_source_data()
+                phase.add(router.rows)
+
+    def init_source_tables(self, activity_definitions, observation_definitions):
+        """Build (empty) SourceTables for each of the activity definitions"""
+        tables = []
         for ad in activity_definitions:
             table = SourceTable(ad, observation_definitions)
-            table.load_source_data()
             self.summaries[table.table_name] = table
+            tables.append(table)
+        return tables
 
     def return_text_results(self):
         results = f""
@@ -104,8 +133,12 @@ class Population:
 
         return results
 
-    def return_summaries(self):
-        summaries = []
+    def iter_summaries(self):
+        """Yield the summary Observations of each summary (Patient, Condition """
+        """and each SourceTable) in turn, so that only one summary's """
+        """Observations are built and held at a time"""
         for header in self.summaries:
-            summaries += self.summaries[header].BuildSummaryObservations(self)
-        return summaries
\ No newline at end of file
+            yield from self.summaries[header].BuildSummaryObservations(self)
+
+    def return_summaries(self):
+        return list(self.iter_summaries())
\ No newline at end of file
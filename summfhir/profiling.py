@@ -0,0 +1,142 @@
+"""
+CPU and memory profiles for each phase of a run (see metrics.py), turned on
+from the command line with --profile-cpu and --profile-mem.
+
+CPU: each phase gets its own cProfile, written as {phase}.prof (for snakeviz,
+pstats, etc) along with {phase}.txt listing the functions that took the most
+time. Within a phase, fetching, parsing, building and uploading show up as
+their own functions.
+
+Memory: tracemalloc runs for the entire run. Each phase reports the peak
+traced memory while it ran and the source lines that allocated the most
+memory still held when it finished, all written to memory.txt.
+
+Phases may be nested, in which case the outer phase's profile pauses while
+the inner one runs. Only the main process is profiled, so the work done by
+--workers processes shows up as waiting on them. With --concurrent-studies,
+each study's process profiles that study into {profile-dir}/{study id}.
+"""
+
+from pathlib import Path
+import cProfile
+import pstats
+import tracemalloc
+import io
+import re
+
+# The number of functions and allocation sites listed for each phase
+TOP_ENTRIES = 30
+
+def PhaseFilename(phase, counts):
+    """A file name for the phase which is unique within the run"""
+    name = "-".join([phase.name] + [str(x) for x in phase.labels.values()])
+    name = re.sub("[^A-Za-z0-9\-\.]+", "_", name)
+    counts[name] = counts.get(name, 0) + 1
+    if counts[name] > 1:
+        name = f"{name}-{counts[name]}"
+    return name
+
+def Snapshot():
+    """The traced allocations, leaving out the profilers' own"""
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, cProfile.__file__),
+        tracemalloc.Filter(False, pstats.__file__),
+        tracemalloc.Filter(False, __file__)
+    ])
+
+class Profiler:
+    def __init__(self, outdir, cpu=False, memory=False):
+        self.outdir = Path(outdir)
+        self.cpu = cpu
+        self.memory = memory
+
+        # Phases currently running, innermost last, with their cProfile and
+        # the snapshot and peak memory at their start
+        self.stack = []
+
+        # file name => the number of phases which have used it
+        self.names = {}
+
+        # Memory report for each phase as it finishes
+        self.memory_report = []
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def begin(self, phase):
+        if len(self.stack) > 0:
+            outer = self.stack[-1]
+            if outer['profile'] is not None:
+                outer['profile'].disable()
+            if self.memory:
+                outer['peak'] = max(outer['peak'], tracemalloc.get_traced_memory()[1])
+
+        entry = {
+            "phase": phase,
+            "profile": None,
+            "snapshot": None,
+            "peak": 0
+        }
+        if self.memory:
+            entry['snapshot'] = Snapshot()
+            tracemalloc.reset_peak()
+        if self.cpu:
+            entry['profile'] = cProfile.Profile()
+            entry['profile'].enable()
+        self.stack.append(entry)
+
+    def end(self, phase):
+        entry = self.stack.pop()
+        name = PhaseFilename(phase, self.names)
+        self.outdir.mkdir(parents=True, exist_ok=True)
+
+        if entry['profile'] is not None:
+            entry['profile'].disable()
+            self.write_cpu(name, phase, entry['profile'])
+
+        if self.memory:
+            peak = max(entry['peak'], tracemalloc.get_traced_memory()[1])
+            snapshot = Snapshot()
+            self.record_memory(name, phase, peak, snapshot.compare_to(entry['snapshot'], 'lineno'))
+
+        if len(self.stack) > 0:
+            outer = self.stack[-1]
+            if self.memory:
+                outer['peak'] = max(outer['peak'], peak)
+            if outer['profile'] is not None:
+                outer['profile'].enable()
+
+    def write_cpu(self, name, phase, profile):
+        profile.dump_stats(str(self.outdir / f"{name}.prof"))
+
+        text = io.StringIO()
+        stats = pstats.Stats(profile, stream=text)
+        text.write(f"{phase.name} {phase.labels}: {phase.seconds:.2f}s, {phase.records} records\n")
+        stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+        stats.sort_stats("tottime").print_stats(TOP_ENTRIES)
+        with (self.outdir / f"{name}.txt").open('wt') as outf:
+            outf.write(text.getvalue())
+
+    def record_memory(self, name, phase, peak, differences):
+        lines = [f"{name}: {peak / 1048576.0:.1f}MB peak, {phase.records} records"]
+        for stat in differences[0:TOP_ENTRIES]:
+            if stat.size_diff <= 0:
+                break
+            frame = stat.traceback[0]
+            lines.append(f"    {stat.size_diff / 1048576.0:9.2f}MB {stat.count_diff:>10} blocks  "
+                f"{frame.filename}:{frame.lineno}")
+        self.memory_report.append("\n".join(lines))
+
+        # Rewritten after each phase so that it is there even if the run
+        # doesn't finish
+        with (self.outdir / "memory.txt").open('wt') as outf:
+            outf.write("\n\n".join(self.memory_report) + "\n")
+
+    def report(self):
+        files = []
+        if self.cpu:
+            files.append("{phase}.prof and {phase}.txt")
+        if self.memory:
+            files.append("memory.txt")
+        return f"Profiles written to {self.outdir} ({', '.join(files)})"
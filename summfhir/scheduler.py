@@ -0,0 +1,302 @@
+"""
+Summarize many studies at once, each in its own process.
+
+Every ResearchStudy matching a config's tag becomes a job of its own (as does
+every ResearchStudy on the server with --all-studies). Jobs are started
+largest first, by the number of resources carrying the study's tag, so that
+the largest study isn't left running by itself at the end. No more than
+host_limit jobs read from or load into any one server at a time.
+
+The processes share what they can through the file system: the on-disk
+terminology cache (whose writes are atomic), the incremental state (a file per
+study) and the summaries (a file per population). Each job's console output
+goes to its own log and its own directory of profiles (if profiling), and its
+metrics and projection stats are sent back and folded into those of the run,
+which ends with a summary of every study.
+"""
+
+from summfhir import SetInputClient, SetOutputClient
+from summfhir.study import StudySummary
+from summfhir.fetch import (StreamResources, GetProjectionStats, ResetProjectionStats, 
+                            MergeProjectionStats)
+from summfhir.ndjson_client import NdjsonClient
+from summfhir.incremental import SummarizeIncremental, SaveStudyState
+from summfhir.metrics import GetMetrics, ResetMetrics, SetProfiler
+from summfhir.profiling import Profiler
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import defaultdict
+from pathlib import Path
+from time import perf_counter, time
+import traceback
+import sys
+
+# The resources counted to decide which studies to start first
+SIZED_TYPES = ["Patient", "Condition", "Observation"]
+
+# Counters reported for each study (see StudySummary.load_observations)
+SUMMARY_COUNTERS = ["summaries created", "summaries updated",
+                    "summaries unchanged", "summaries loaded", "summaries failed"]
+
+class StudyJob:
+    """A ResearchStudy to summarize, along with where its resources come """
+    """from and where its summaries go"""
+    def __init__(self, resource, host=None, input_dir=None, source=None):
+        self.resource = resource
+        self.id = resource['id']
+        self.title = resource.get('title', "")
+
+        meta_tag = resource['meta']['tag'][0]
+        self.meta_tag = f"{meta_tag['system']}|{meta_tag['code']}"
+
+        # The server (a key in the host config) which we read from, unless
+        # there is an input_dir, and load into. None for neither
+        self.host = host
+        self.input_dir = input_dir
+
+        # The config file (or host) that named the study, for the report
+        self.source = source
+
+        # Resources carrying the study's tag (see StudySize)
+        self.size = 0
+
+def FindStudies(client, tag=""):
+    """The ResearchStudies with the tag, or every one on the server if """
+    """there is no tag"""
+    query = "ResearchStudy"
+    if tag != "":
+        query = f"ResearchStudy?_tag={tag}"
+    return list(StreamResources(query, client))
+
+def StudySize(client, meta_tag):
+    size = 0
+    for resource_type in SIZED_TYPES:
+        result = client.get(f"{resource_type}?_tag={meta_tag}&_summary=count")
+        if result.success():
+            size += result.response.get('total', 0)
+    return size
+
+def SummarizeStudy(job, settings, upload=True):
+    """Summarize the study, write its reports and load its summaries, """
+    """using the input and output clients already set"""
+    study = StudySummary(job.resource,
+                            shared_scan=settings['shared_scan'],
+                            workers=settings['workers'])
+
+    state_dir = settings['state_dir']
+    if state_dir is not None:
+        # Incremental runs start from the previous run's summaries
+        study.summarized = SummarizeIncremental(study,
+                            state_dir,
+                            settings['summarize_patients'],
+                            settings['summarize_conditions'],
+                            settings['summarize_source'])
+    else:
+        if settings['summarize_patients']:
+            study.summarize_patients()
+        if settings['summarize_conditions']:
+            study.summarize_conditions()
+        if settings['summarize_source']:
+            study.summarize_source()
+
+    study.build_text_report()
+    study.load_observations(upload_mode=settings['upload_mode'],
+                            batch_size=settings['batch_size'],
+                            upload=upload,
+                            compression=settings['compression'],
+                            skip_unchanged=settings['skip_unchanged'])
+    if state_dir is not None:
+        SaveStudyState(state_dir, study, study.summarized)
+    return study
+
+def RunJob(job, settings, connect, log_dir=None):
+    """Summarize one study, returning a report of how it went. connect """
+    """returns a client for a host. With a log_dir (as in the scheduler's """
+    """processes), the study's output goes to its own log, it is profiled """
+    """into a directory of its own and its metrics and projection stats """
+    """are returned with the report"""
+    stdout = sys.stdout
+    if log_dir is not None:
+        ResetMetrics()
+        ResetProjectionStats()
+
+        profile = settings.get('profile')
+        if profile is not None:
+            profiler = Profiler(Path(profile['dir']) / job.id, 
+                                cpu=profile['cpu'], 
+                                memory=profile['memory'])
+            SetProfiler(profiler)
+
+        log_filename = Path(log_dir) / f"{job.id}.log"
+        log_filename.parent.mkdir(parents=True, exist_ok=True)
+        sys.stdout = log_filename.open('wt', buffering=1)
+
+    counters = dict(GetMetrics().counters)
+    result = {
+        "study": job.id,
+        "title": job.title,
+        "tag": job.meta_tag,
+        "host": job.host,
+        "source": job.source,
+        "status": "ok",
+        "error": None,
+        "started": time()
+    }
+
+    start = perf_counter()
+    try:
+        output_client = None
+        if job.host is not None:
+            output_client = connect(job.host)
+            SetOutputClient(output_client)
+
+        if job.input_dir is not None:
+            SetInputClient(NdjsonClient(job.input_dir))
+        else:
+            SetInputClient(output_client)
+
+        SummarizeStudy(job, settings, upload=output_client is not None)
+    except (Exception, SystemExit) as e:
+        traceback.print_exc(file=sys.stdout)
+        result['status'] = "failed"
+        result['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        result['seconds'] = perf_counter() - start
+        if log_dir is not None:
+            sys.stdout.close()
+            sys.stdout = stdout
+            result['log'] = str(log_filename)
+
+    # Only this study's share of the counts
+    metrics = GetMetrics()
+    result['counters'] = dict([(name, metrics.counters[name] - counters.get(name, 0))
+                                    for name in SUMMARY_COUNTERS if name in metrics.counters])
+    if log_dir is not None:
+        result['metrics'] = metrics.report()
+        result['projection'] = dict(GetProjectionStats())
+        if profile is not None:
+            result['profiles'] = str(profiler.outdir)
+    return result
+
+def FailedJob(job, error):
+    return {
+        "study": job.id,
+        "title": job.title,
+        "tag": job.meta_tag,
+        "host": job.host,
+        "source": job.source,
+        "status": "failed",
+        "error": f"{type(error).__name__}: {error}",
+        "started": time(),
+        "seconds": 0.0,
+        "counters": {}
+    }
+
+class StudyScheduler:
+    def __init__(self,
+                settings,
+                connect,
+                concurrency=1,
+                host_limit=2,
+                log_dir="output/logs",
+                initializer=None,
+                initargs=()):
+        # Passed to SummarizeStudy
+        self.settings = settings
+
+        # Called with a host (config key) for a client to use. Must be
+        # picklable (a module level function)
+        self.connect = connect
+
+        self.concurrency = concurrency
+        self.host_limit = max(host_limit, 1)
+        self.log_dir = log_dir
+
+        # Run in each process before it starts on its jobs (to apply the
+        # run's settings, for instance)
+        self.initializer = initializer
+        self.initargs = initargs
+
+        self.results = []
+
+    def finished(self, result):
+        self.results.append(result)
+        error = ""
+        if result['error'] is not None:
+            error = f" ({result['error']})"
+        print(f"{result['study']}: {result['status']} in {result['seconds']:.1f}s{error} "
+            f"[{len(self.results)} studies finished]")
+
+    def run(self, jobs):
+        """Summarize every study, returning the report for each"""
+        self.results = []
+        if self.concurrency < 2 or len(jobs) < 2:
+            for job in jobs:
+                self.finished(RunJob(job, self.settings, self.connect))
+            return self.results
+
+        pending = sorted(jobs, key=lambda job: -job.size)
+        print(f"Summarizing {len(jobs)} studies, {self.concurrency} at a time "
+            f"(at most {self.host_limit} per host). Logs are in {self.log_dir}")
+
+        # future => job
+        running = {}
+        per_host = defaultdict(int)
+        with ProcessPoolExecutor(max_workers=self.concurrency,
+                                 initializer=self.initializer,
+                                 initargs=self.initargs) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for job in list(pending):
+                    if len(running) >= self.concurrency:
+                        break
+                    if job.host is not None and per_host[job.host] >= self.host_limit:
+                        continue
+
+                    pending.remove(job)
+                    try:
+                        future = executor.submit(RunJob, job, self.settings, self.connect, self.log_dir)
+                    except Exception as e:
+                        # The pool is broken, so none of the rest can run
+                        self.finished(FailedJob(job, e))
+                        continue
+                    running[future] = job
+                    per_host[job.host] += 1
+
+                if len(running) == 0:
+                    continue
+
+                done, not_done = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    per_host[job.host] -= 1
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = FailedJob(job, e)
+
+                    metrics = result.pop('metrics', None)
+                    if metrics is not None:
+                        GetMetrics().merge(metrics)
+                    projection = result.pop('projection', None)
+                    if projection is not None:
+                        MergeProjectionStats(projection)
+                    self.finished(result)
+        return self.results
+
+def RunSummary(results, seconds):
+    """A few lines for the console covering every study in the run"""
+    failed = [result for result in results if result['status'] != "ok"]
+    busy = sum(result['seconds'] for result in results)
+    lines = [f"{len(results)} studies summarized in {seconds:.1f}s ({busy:.1f}s "
+        f"across the studies), {len(failed)} failed"]
+    for result in sorted(results, key=lambda result: -result['seconds']):
+        counters = result['counters']
+        loaded = ""
+        if len(counters) > 0:
+            loaded = f" {counters.get('summaries loaded', 0)} loaded, " + \
+                f"{counters.get('summaries unchanged', 0)} unchanged, " + \
+                f"{counters.get('summaries failed', 0)} failed"
+        lines.append(f"  {result['study']:<32} {str(result['host']):<12} {result['status']:<7} "
+            f"{result['seconds']:8.1f}s{loaded}")
+    for result in failed:
+        lines.append(f"  {result['study']}: {result['error']}")
+    return "\n".join(lines)
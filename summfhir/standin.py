@@ -0,0 +1,624 @@
+"""
+A stand-in FHIR server, served over HTTP on localhost, so that complete runs
+of summarize (fetching as well as uploading) can be timed reproducibly without
+touching a shared server.
+
+Only the subset of the API that summarization uses is implemented:
+
+    GET  Type?_tag=...&code=...&subject=...&_id=...&_elements=...&_count=...
+    GET  Type?...&_summary=count
+    POST Type/_search
+    GET  Type/id
+    GET  Type/_history?_since=...          (deletions only)
+    GET  ValueSet/id/$expand, ValueSet/$expand?url=...
+    POST Type                              (If-None-Exist is honored)
+    PUT  Type/id, PUT Type?identifier=...  (conditional update)
+    DELETE Type/id
+    POST (batch or transaction Bundle)
+
+Searches page the way HAPI does: the first page runs the search and later
+pages are served from its results by way of the next link. The resources are
+held in memory, loaded from a directory of NDJSON such as that written by
+summarize-synthetic.
+
+Latency, page size, error rates (429 and 503) and bandwidth are all
+configurable, and the faults are drawn from a seeded generator so that runs
+are repeatable:
+
+    summarize-synthetic output/synthetic --patients 10000
+    summarize-standin output/synthetic --port 8000 --latency 0.05 --error-rate 0.01
+
+Then point a host in your fhir_hosts config at http://localhost:8000 and run
+summarize against it as usual.
+"""
+
+from summfhir.ndjson_client import (ReadLines, BuildMatcher, ExpandValueSetResource,
+                                    OperationOutcome, CONTROL_PARAMS)
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode, unquote
+from collections import defaultdict, OrderedDict
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from pathlib import Path
+import threading
+import random
+import json
+import time
+import uuid
+import sys
+import re
+
+# Parameters that control paging through a search's results
+PAGING_PARAMS = set(["_getpages", "_getpagesoffset"])
+
+# The number of searches whose results are kept for paging
+MAX_SEARCHES = 128
+
+def Now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def Project(resource, elements):
+    """The resource with only the requested elements, marked SUBSETTED as """
+    """a server would"""
+    projected = {"resourceType": resource['resourceType']}
+    for element in ["id", "meta"] + elements:
+        if element in resource:
+            projected[element] = resource[element]
+
+    meta = dict(projected.get('meta', {}))
+    meta['tag'] = meta.get('tag', []) + [{
+        "system": "http://terminology.hl7.org/CodeSystem/v3-ObservationValue",
+        "code": "SUBSETTED"
+    }]
+    projected['meta'] = meta
+    return projected
+
+class Settings:
+    def __init__(self,
+                latency=0.0,
+                jitter=0.0,
+                page_size=50,
+                max_page_size=1000,
+                error_rate=0.0,
+                throttle_rate=0.0,
+                entry_error_rate=0.0,
+                bandwidth=None,
+                seed=1):
+        # Seconds added to every response (plus up to jitter more)
+        self.latency = latency
+        self.jitter = jitter
+
+        # _count when none is provided, and the most we'll honor
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+        # Chance that a request fails outright with a 503 or a 429 and that
+        # an individual entry of a batch fails with a 503
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.entry_error_rate = entry_error_rate
+
+        # Bytes per second for each response, or None for no limit
+        self.bandwidth = bandwidth
+
+        self.seed = seed
+
+class FhirStore:
+    """The resources, by type and id, along with the searches being paged"""
+    def __init__(self):
+        # type => id => resource
+        self.resources = defaultdict(OrderedDict)
+
+        # type => [(reference, instant deleted)]
+        self.deleted = defaultdict(list)
+
+        # search id => [resource ids]
+        self.searches = OrderedDict()
+
+        # Search parameters we've already complained about
+        self.ignored_params = set()
+
+        self.lock = threading.RLock()
+
+    def load_ndjson(self, directory):
+        """Load every {Type}[...].ndjson[.gz] file in the directory. """
+        """Returns the number of resources loaded"""
+        count = 0
+        loaded = Now()
+        for path in sorted(Path(directory).iterdir()):
+            match = re.match("^([A-Za-z]+)([.\-_][^/]*)?\.ndjson(\.gz)?$", path.name)
+            if match is None:
+                continue
+            for start, end, line in ReadLines(path):
+                resource = json.loads(line)
+                meta = resource.setdefault('meta', {})
+                meta.setdefault('versionId', "1")
+                meta.setdefault('lastUpdated', loaded)
+                self.resources[resource['resourceType']][resource['id']] = resource
+                count += 1
+        return count
+
+    def read(self, resource_type, id):
+        with self.lock:
+            return self.resources[resource_type].get(id)
+
+    def match(self, resource_type, params):
+        matches = BuildMatcher(params, self.ignored_params)
+        with self.lock:
+            return [r for r in self.resources[resource_type].values() if matches(r)]
+
+    def begin_search(self, resource_type, params):
+        """Run the search, keeping the matching ids so that they can be paged"""
+        ids = [resource['id'] for resource in self.match(resource_type, params)]
+        search_id = uuid.uuid4().hex
+        with self.lock:
+            self.searches[search_id] = ids
+            while len(self.searches) > MAX_SEARCHES:
+                self.searches.popitem(last=False)
+        return search_id, ids
+
+    def page(self, search_id):
+        with self.lock:
+            ids = self.searches.get(search_id)
+            if ids is not None:
+                self.searches.move_to_end(search_id)
+            return ids
+
+    def write(self, resource, id=None):
+        """Create or update the resource, returning (status, resource)"""
+        resource_type = resource['resourceType']
+        with self.lock:
+            status = 200
+            current = None
+            if id is not None:
+                current = self.resources[resource_type].get(id)
+            if current is None:
+                status = 201
+                if id is None:
+                    id = uuid.uuid4().hex
+
+            resource = dict(resource)
+            resource['id'] = id
+            meta = dict(resource.get('meta', {}))
+            version = 1
+            if current is not None:
+                version = int(current.get('meta', {}).get('versionId', "1")) + 1
+            meta['versionId'] = str(version)
+            meta['lastUpdated'] = Now()
+            resource['meta'] = meta
+
+            self.resources[resource_type][id] = resource
+            return status, resource
+
+    def delete(self, resource_type, id):
+        with self.lock:
+            if self.resources[resource_type].pop(id, None) is None:
+                return 404
+            self.deleted[resource_type].append((f"{resource_type}/{id}", Now()))
+            return 204
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def store(self):
+        return self.server.store
+
+    @property
+    def settings(self):
+        return self.server.settings
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def base_url(self):
+        return f"http://{self.headers.get('Host', '%s:%s' % self.server.server_address[0:2])}"
+
+    def send(self, status, body, headers=None):
+        content = b""
+        if body is not None:
+            content = json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        # Write in chunks, pausing as needed to stay within the bandwidth
+        bandwidth = self.settings.bandwidth
+        chunk_size = len(content) if bandwidth is None else max(1024, int(bandwidth / 20))
+        for start in range(0, len(content), max(chunk_size, 1)):
+            chunk = content[start:start + chunk_size]
+            self.wfile.write(chunk)
+            if bandwidth is not None:
+                time.sleep(len(chunk) / bandwidth)
+        self.server.record(status, len(content))
+
+    def fault(self):
+        """Delay the response and perhaps fail it. Returns True if the """
+        """request has been answered with an error"""
+        settings = self.settings
+        delay = settings.latency
+        with self.server.random_lock:
+            if settings.jitter > 0:
+                delay += self.server.random.uniform(0, settings.jitter)
+            roll = self.server.random.random()
+        if delay > 0:
+            time.sleep(delay)
+
+        if roll < settings.throttle_rate:
+            self.send(429, OperationOutcome("Too many requests", "throttled"), {"Retry-After": "1"})
+            return True
+        if roll < settings.throttle_rate + settings.error_rate:
+            self.send(503, OperationOutcome("Service unavailable", "transient"))
+            return True
+        return False
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return None
+        return self.rfile.read(length)
+
+    def split_path(self):
+        url = urlparse(self.path)
+        parts = [unquote(x) for x in url.path.strip("/").split("/") if x != ""]
+        return parts, parse_qs(url.query)
+
+    def do_GET(self):
+        if self.fault():
+            return
+        parts, params = self.split_path()
+        status, body = self.get(parts, params)
+        self.send(status, body)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.fault():
+            return
+        parts, params = self.split_path()
+
+        if len(parts) == 2 and parts[1] == "_search":
+            if body is not None:
+                for name, values in parse_qs(body.decode('utf-8')).items():
+                    params.setdefault(name, []).extend(values)
+            self.send(*self.search(parts[0], params))
+            return
+
+        try:
+            resource = json.loads(body)
+        except (TypeError, ValueError):
+            self.send(400, OperationOutcome("The body isn't valid JSON", "invalid"))
+            return
+
+        if len(parts) == 0:
+            self.send(*self.bundle(resource))
+            return
+
+        status, body, headers = self.create(parts[0], resource, self.headers.get('If-None-Exist'))
+        self.send(status, body, headers)
+
+    def do_PUT(self):
+        body = self.read_body()
+        if self.fault():
+            return
+        parts, params = self.split_path()
+        try:
+            resource = json.loads(body)
+        except (TypeError, ValueError):
+            self.send(400, OperationOutcome("The body isn't valid JSON", "invalid"))
+            return
+
+        status, body, headers = self.update(parts, params, resource)
+        self.send(status, body, headers)
+
+    def do_DELETE(self):
+        if self.fault():
+            return
+        parts, params = self.split_path()
+        if len(parts) != 2:
+            self.send(400, OperationOutcome("Only Type/id may be deleted", "not-supported"))
+            return
+        self.send(self.store.delete(parts[0], parts[1]), None)
+
+    def get(self, parts, params):
+        if len(parts) == 0:
+            return 400, OperationOutcome("No resource type", "invalid")
+
+        if parts[-1] == "$expand":
+            if len(parts) == 3:
+                valueset = self.store.read("ValueSet", parts[1])
+            else:
+                url = params.get('url', [""])[0].split("|")[0]
+                matches = [r for r in self.store.match("ValueSet", {}) if r.get('url') == url]
+                valueset = matches[0] if len(matches) > 0 else None
+            if valueset is None:
+                return 404, OperationOutcome("ValueSet not found")
+            return 200, ExpandValueSetResource(valueset)
+
+        if len(parts) == 2 and parts[1] == "_history":
+            return 200, self.history(parts[0], params)
+
+        if len(parts) == 2:
+            resource = self.store.read(parts[0], parts[1])
+            if resource is None:
+                return 404, OperationOutcome(f"{parts[0]}/{parts[1]} not found")
+            return 200, resource
+
+        return self.search(parts[0], params)
+
+    def search(self, resource_type, params):
+        if "_summary" in params and params['_summary'][0] == "count":
+            total = len(self.store.match(resource_type, params))
+            return 200, {"resourceType": "Bundle", "type": "searchset", "total": total}
+
+        page_size = self.settings.page_size
+        if "_count" in params:
+            page_size = min(int(params['_count'][0]), self.settings.max_page_size)
+
+        elements = None
+        if "_elements" in params:
+            elements = ",".join(params['_elements']).split(",")
+
+        if "_getpages" in params:
+            search_id = params['_getpages'][0]
+            ids = self.store.page(search_id)
+            if ids is None:
+                return 410, OperationOutcome("The search has expired", "expired")
+        else:
+            search_id, ids = self.store.begin_search(resource_type, params)
+
+        offset = int(params.get('_getpagesoffset', ["0"])[0])
+        entries = []
+        for id in ids[offset:offset + page_size]:
+            resource = self.store.read(resource_type, id)
+            if resource is not None:
+                if elements is not None:
+                    resource = Project(resource, elements)
+                entries.append({
+                    "fullUrl": f"{self.base_url()}/{resource_type}/{id}",
+                    "resource": resource
+                })
+
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "total": len(ids),
+            "link": [{
+                "relation": "self",
+                "url": f"{self.base_url()}{self.path}"
+            }],
+            "entry": entries
+        }
+
+        if offset + page_size < len(ids):
+            next_params = {
+                "_getpages": search_id,
+                "_getpagesoffset": offset + page_size,
+                "_count": page_size
+            }
+            if elements is not None:
+                next_params['_elements'] = ",".join(elements)
+            bundle['link'].append({
+                "relation": "next",
+                "url": f"{self.base_url()}/{resource_type}?{urlencode(next_params)}"
+            })
+        return 200, bundle
+
+    def history(self, resource_type, params):
+        since = params.get('_since', [""])[0]
+        entries = []
+        for reference, deleted in self.store.deleted[resource_type]:
+            if deleted > since:
+                entries.append({
+                    "request": {
+                        "method": "DELETE",
+                        "url": reference
+                    }
+                })
+        return {
+            "resourceType": "Bundle",
+            "type": "history",
+            "total": len(entries),
+            "entry": entries
+        }
+
+    def create(self, resource_type, resource, if_none_exist=None):
+        """Returns (status, body, headers)"""
+        if resource.get('resourceType') != resource_type:
+            return 400, OperationOutcome("The resource type doesn't match the URL", "invalid"), {}
+
+        if if_none_exist is not None:
+            existing = self.store.match(resource_type, parse_qs(if_none_exist.split("?")[-1]))
+            if len(existing) == 1:
+                return 200, existing[0], {}
+            if len(existing) > 1:
+                return 412, OperationOutcome("Multiple matches for If-None-Exist", "multiple-matches"), {}
+
+        status, resource = self.store.write(resource)
+        return status, resource, {"Location": f"{resource_type}/{resource['id']}/_history/{resource['meta']['versionId']}"}
+
+    def update(self, parts, params, resource):
+        if len(parts) == 0 or resource.get('resourceType') != parts[0]:
+            return 400, OperationOutcome("The resource type doesn't match the URL", "invalid"), {}
+        resource_type = parts[0]
+
+        if len(parts) == 2:
+            id = parts[1]
+        else:
+            # Conditional update: create if there is no match, update the
+            # one that matches and refuse to guess between several
+            criteria = dict([(k, v) for k, v in params.items() if k not in CONTROL_PARAMS])
+            if len(criteria) == 0:
+                return 400, OperationOutcome("Conditional update without criteria", "invalid"), {}
+            existing = self.store.match(resource_type, criteria)
+            if len(existing) > 1:
+                return 412, OperationOutcome("Multiple matches for the update", "multiple-matches"), {}
+            id = existing[0]['id'] if len(existing) == 1 else None
+
+        status, resource = self.store.write(resource, id)
+        return status, resource, {"Location": f"{resource_type}/{resource['id']}/_history/{resource['meta']['versionId']}"}
+
+    def bundle(self, bundle):
+        """Process a batch or transaction Bundle"""
+        if bundle.get('resourceType') != "Bundle" or bundle.get('type') not in ["batch", "transaction"]:
+            return 400, OperationOutcome("Only batch and transaction Bundles may be posted", "not-supported")
+
+        transaction = bundle['type'] == "transaction"
+        responses = []
+        with self.store.lock:
+            # Transactions are all or nothing, so we keep what we change in
+            # case we need to put it back
+            snapshot = None
+            if transaction:
+                snapshot = dict([(t, OrderedDict(r)) for t, r in self.store.resources.items()])
+
+            for entry in bundle.get('entry', []):
+                status, body = self.entry(entry)
+                if transaction and status >= 300:
+                    self.store.resources.clear()
+                    self.store.resources.update(snapshot)
+                    return status, body
+
+                response = {"status": str(status)}
+                if status < 300:
+                    response['location'] = f"{body['resourceType']}/{body['id']}/_history/{body['meta']['versionId']}"
+                else:
+                    response['outcome'] = body
+                responses.append({"response": response})
+
+        return 200, {
+            "resourceType": "Bundle",
+            "type": f"{bundle['type']}-response",
+            "entry": responses
+        }
+
+    def entry(self, entry):
+        request = entry.get('request', {})
+        method = request.get('method')
+        url = urlparse(request.get('url', ""))
+        parts = [unquote(x) for x in url.path.strip("/").split("/") if x != ""]
+        params = parse_qs(url.query)
+
+        if self.settings.entry_error_rate > 0:
+            with self.server.random_lock:
+                roll = self.server.random.random()
+            if roll < self.settings.entry_error_rate:
+                return 503, OperationOutcome("Service unavailable", "transient")
+
+        if method == "PUT":
+            status, body, headers = self.update(parts, params, entry.get('resource', {}))
+        elif method == "POST" and len(parts) == 1:
+            status, body, headers = self.create(parts[0], entry.get('resource', {}), request.get('ifNoneExist'))
+        elif method == "GET":
+            status, body = self.get(parts, params)
+        elif method == "DELETE" and len(parts) == 2:
+            status, body = self.store.delete(parts[0], parts[1]), None
+        else:
+            status, body = 400, OperationOutcome(f"Unsupported request, {method} {request.get('url')}", "not-supported")
+        return status, body
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, store, settings=None, host="127.0.0.1", port=0, verbose=False):
+        super().__init__((host, port), StandinHandler)
+        self.store = store
+        if settings is None:
+            settings = Settings()
+        self.settings = settings
+        self.verbose = verbose
+
+        self.random = random.Random(settings.seed)
+        self.random_lock = threading.Lock()
+
+        # status => count, and the number of bytes sent
+        self.statuses = defaultdict(int)
+        self.bytes_sent = 0
+        self.stats_lock = threading.Lock()
+
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[0:2]
+        return f"http://{host}:{port}"
+
+    def record(self, status, size):
+        with self.stats_lock:
+            self.statuses[status] += 1
+            self.bytes_sent += size
+
+    def start(self):
+        """Serve from a background thread, returning the base URL"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def report(self):
+        requests = sum(self.statuses.values())
+        statuses = ", ".join([f"{status}: {count}" for status, count in sorted(self.statuses.items())])
+        return f"{requests} requests ({statuses}), {self.bytes_sent / 1048576.0:.1f}MB sent"
+
+def exec(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description="Serve a directory of NDJSON (such as "
+                    "summarize-synthetic writes) as a stand-in FHIR server")
+    parser.add_argument("directory", help="Directory of {ResourceType}.ndjson files")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0,
+        help="Up to this many more seconds, at random, added to each response")
+    parser.add_argument("--page-size", type=int, default=50,
+        help="Search page size when _count isn't provided")
+    parser.add_argument("--max-page-size", type=int, default=1000)
+    parser.add_argument("--error-rate", type=float, default=0.0,
+        help="Chance that a request fails with a 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+        help="Chance that a request is refused with a 429")
+    parser.add_argument("--entry-error-rate", type=float, default=0.0,
+        help="Chance that an entry in a batch Bundle fails with a 503")
+    parser.add_argument("--bandwidth", type=float, default=None,
+        help="Response bandwidth limit in bytes per second")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-v", "--verbose", action='store_true',
+        help="Log each request")
+    args = parser.parse_args(args)
+
+    store = FhirStore()
+    count = store.load_ndjson(args.directory)
+    settings = Settings(latency=args.latency,
+                        jitter=args.jitter,
+                        page_size=args.page_size,
+                        max_page_size=args.max_page_size,
+                        error_rate=args.error_rate,
+                        throttle_rate=args.throttle_rate,
+                        entry_error_rate=args.entry_error_rate,
+                        bandwidth=args.bandwidth,
+                        seed=args.seed)
+    server = StandinServer(store, settings, args.host, args.port, args.verbose)
+    print(f"Serving {count} resources from {args.directory} at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.report())
+
+if __name__ == "__main__":
+    exec()
@@ -0,0 +1,456 @@
+"""
+Numeric accumulators used by the summaries.
+
+These can all be merged, which allows partial summaries built from different
+parts of the data (by separate processes, for instance) to be combined into
+the same result we would have gotten by reading everything in one place.
+"""
+
+from hashlib import blake2b
+import math
+
+class ExactSum:
+    """Floating point sum with no rounding error, kept as a list of """
+    """non-overlapping partials (Shewchuk's algorithm, as used by """
+    """math.fsum). Because the sum is exact, the order values are added """
+    """in (or partial sums are merged in) doesn't affect the result"""
+    __slots__ = ['partials']
+
+    def __init__(self):
+        self.partials = []
+
+    def add(self, x):
+        partials = self.partials
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i:] = [x]
+
+    def add_many(self, values):
+        for x in values:
+            self.add(x)
+
+    def merge(self, other):
+        self.add_many(other.partials)
+
+    def value(self):
+        return math.fsum(self.partials)
+
+    def __getstate__(self):
+        return self.partials
+
+    def __setstate__(self, state):
+        self.partials = state
+
+# Veltkamp's constant for splitting a double into two 26 bit halves
+SPLITTER = 134217729.0
+
+def TwoProduct(a, b):
+    """Returns (p, e) such that p + e is exactly a * b (Dekker)"""
+    p = a * b
+    c = SPLITTER * a
+    ahi = c - (c - a)
+    alo = a - ahi
+    c = SPLITTER * b
+    bhi = c - (c - b)
+    blo = b - bhi
+    return p, ((ahi * bhi - p) + ahi * blo + alo * bhi) + alo * blo
+
+class Moments:
+    """Count, sum and sum of squares, all kept exactly. The variance is """
+    """computed from the exact sums in a single step at the end, so it is """
+    """as accurate as a two pass calculation (and unlike Welford's running """
+    """update, the result doesn't depend on the order values were added """
+    """or merged in). Values can also be removed exactly"""
+    __slots__ = ['count', 'sum', 'squares']
+
+    def __init__(self):
+        self.count = 0
+        self.sum = ExactSum()
+        self.squares = ExactSum()
+
+    def add(self, x):
+        self.count += 1
+        self.sum.add(x)
+        self.squares.add_many(TwoProduct(x, x))
+
+    def remove(self, x):
+        self.count -= 1
+        self.sum.add(-x)
+        for term in TwoProduct(x, x):
+            self.squares.add(-term)
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum.merge(other.sum)
+        self.squares.merge(other.squares)
+
+    def mean(self):
+        if self.count < 1:
+            return None
+        return self.sum.value() / self.count
+
+    def variance(self):
+        """Sample variance, (n * sum(x^2) - sum(x)^2) / (n * (n - 1))"""
+        n = self.count
+        if n < 2:
+            return None
+
+        numerator = ExactSum()
+        for partial in self.squares.partials:
+            numerator.add_many(TwoProduct(float(n), partial))
+        for a in self.sum.partials:
+            for b in self.sum.partials:
+                for term in TwoProduct(a, b):
+                    numerator.add(-term)
+        return max(numerator.value(), 0.0) / (n * (n - 1.0))
+
+    def std_dev(self):
+        variance = self.variance()
+        if variance is None:
+            return None
+        return math.sqrt(variance)
+
+    def __getstate__(self):
+        return (self.count, self.sum, self.squares)
+
+    def __setstate__(self, state):
+        self.count, self.sum, self.squares = state
+
+# Relative accuracy of the quantiles for sketches created without one
+DEFAULT_QUANTILE_ACCURACY = 0.01
+
+def SetQuantileAccuracy(accuracy):
+    global DEFAULT_QUANTILE_ACCURACY
+    if not 0.0 < accuracy < 1.0:
+        raise ValueError(f"Quantile accuracy must be between 0 and 1, not {accuracy}")
+    DEFAULT_QUANTILE_ACCURACY = accuracy
+
+class QuantileSketch:
+    """Approximate quantiles with a bounded relative error (DDSketch). """
+    """Values are counted in logarithmically sized buckets, so any """
+    """quantile it reports is within accuracy (relative) of the true one. """
+    """The number of buckets depends only on the range of the values, """
+    """about 115 per factor of ten at 1% accuracy, never on how many """
+    """values there are. Since each bucket is just a count, sketches merge """
+    """and values can be removed without regard to order. The observed """
+    """minimum and maximum are exact"""
+    __slots__ = ['accuracy', 'gamma', 'log_gamma', 'positive', 'negative', 
+                 'zeros', 'count', 'min', 'max']
+
+    def __init__(self, accuracy=None):
+        if accuracy is None:
+            accuracy = DEFAULT_QUANTILE_ACCURACY
+        self.accuracy = accuracy
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        # bucket key => count. Negative values are bucketed by magnitude
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+        self.min = None
+        self.max = None
+
+    def key(self, x):
+        return math.ceil(math.log(x) / self.log_gamma)
+
+    def bucket_value(self, key):
+        """The value which is within accuracy of everything in the bucket"""
+        return 2.0 * self.gamma ** key / (self.gamma + 1.0)
+
+    def buckets(self, x):
+        if x > 0:
+            return self.positive, self.key(x)
+        return self.negative, self.key(-x)
+
+    def add(self, x):
+        self.count += 1
+        if x == 0:
+            self.zeros += 1
+        else:
+            buckets, key = self.buckets(x)
+            buckets[key] = buckets.get(key, 0) + 1
+
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    def remove(self, x):
+        self.count -= 1
+        if x == 0:
+            self.zeros -= 1
+        else:
+            buckets, key = self.buckets(x)
+            buckets[key] -= 1
+            if buckets[key] == 0:
+                del buckets[key]
+
+        # The exact extremes can't be recovered once one of them is removed,
+        # so we fall back on the buckets, which are within accuracy of them
+        if self.count == 0:
+            self.min = None
+            self.max = None
+        else:
+            if x == self.min:
+                self.min = self.quantile(0.0, clamp=False)
+            if x == self.max:
+                self.max = self.quantile(1.0, clamp=False)
+
+    def merge(self, other):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Unable to merge quantile sketches with different accuracy")
+
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q, clamp=True):
+        if self.count < 1:
+            return None
+        if clamp and q <= 0.0:
+            return self.min
+        if clamp and q >= 1.0:
+            return self.max
+
+        rank = q * (self.count - 1)
+        seen = 0
+        value = None
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                value = -self.bucket_value(key)
+                break
+
+        if value is None:
+            seen += self.zeros
+            if seen > rank:
+                value = 0.0
+
+        if value is None:
+            for key in sorted(self.positive):
+                seen += self.positive[key]
+                if seen > rank:
+                    value = self.bucket_value(key)
+                    break
+
+        if clamp:
+            value = min(max(value, self.min), self.max)
+        return value
+
+# Distinct values are counted exactly up to this many, after which we switch
+# over to a HyperLogLog estimate
+DEFAULT_DISTINCT_THRESHOLD = 100000
+
+def SetDistinctThreshold(threshold):
+    global DEFAULT_DISTINCT_THRESHOLD
+    DEFAULT_DISTINCT_THRESHOLD = threshold
+
+def DistinctThreshold():
+    return DEFAULT_DISTINCT_THRESHOLD
+
+class HyperLogLog:
+    """Estimates the number of distinct values in a fixed 2^precision bytes. """
+    """The relative standard error is 1.04/sqrt(2^precision), 0.8% at the """
+    """default precision. Values are hashed with blake2b rather than hash(), """
+    """which is salted per process, so sketches built by different """
+    """processes can be merged. Merging takes the maximum of each register, """
+    """so the result doesn't depend on order (or on how many times a value """
+    """was seen)"""
+    __slots__ = ['precision', 'registers']
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        hashed = int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        bits = 64 - self.precision
+        index = hashed >> bits
+        rank = bits - (hashed & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add_many(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Unable to merge HyperLogLog sketches with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1.0 + 1.079 / m)
+        raw = alpha * m * m / math.fsum(2.0 ** -r for r in self.registers)
+
+        # Linear counting is more accurate while many registers are empty
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros > 0:
+            return m * math.log(m / zeros)
+        return raw
+
+    def error(self):
+        """Relative standard error of the estimate"""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def __getstate__(self):
+        return (self.precision, bytes(self.registers))
+
+    def __setstate__(self, state):
+        self.precision = state[0]
+        self.registers = bytearray(state[1])
+
+# The number of most frequent string values to report (0 for none) and how
+# many counters to keep while finding them
+DEFAULT_TOP_VALUES = 0
+DEFAULT_TOP_CAPACITY = 0
+
+def SetTopValues(k, capacity=None):
+    """More counters than values reported tightens the error bounds. By """
+    """default, we keep ten for every value reported"""
+    global DEFAULT_TOP_VALUES, DEFAULT_TOP_CAPACITY
+    if capacity is None:
+        capacity = 10 * k
+    DEFAULT_TOP_VALUES = k
+    DEFAULT_TOP_CAPACITY = max(k, capacity)
+
+def TopValues():
+    return DEFAULT_TOP_VALUES, DEFAULT_TOP_CAPACITY
+
+class SpaceSaving:
+    """Approximate counts of the most frequent values in a fixed number of """
+    """counters (Metwally's Space-Saving). When a new value arrives and """
+    """every counter is taken, it replaces the smallest one and inherits """
+    """that counter's count as its error. Any value seen more than """
+    """N/capacity times is guaranteed to be among the counters, and each """
+    """count is high by no more than its error. While there are no more """
+    """distinct values than counters, the counts are exact. Counters are """
+    """grouped by count (the stream-summary structure), so finding the """
+    """smallest takes constant time. Merged counters (see merge) carry """
+    """larger errors than a single pass over the same values, so the top """
+    """values of sharded input can differ from those of a serial run"""
+    __slots__ = ['k', 'capacity', 'counts', 'errors', 'buckets', 'smallest']
+
+    def __init__(self, k, capacity=None):
+        if capacity is None:
+            capacity = 10 * k
+        self.k = k
+        self.capacity = max(k, capacity)
+
+        # value => count and value => the most the count might be over by
+        self.counts = {}
+        self.errors = {}
+
+        # count => the values with that count, in the order they got there
+        # (a dict, used as an ordered set). The first value in the smallest
+        # count's bucket is the one replaced
+        self.buckets = {}
+        self.smallest = 0
+
+    def place(self, value, count):
+        self.counts[value] = count
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = {}
+        bucket[value] = None
+
+    def displace(self, value, count):
+        """Take the value out of its bucket, returning True if that left """
+        """the bucket empty"""
+        bucket = self.buckets[count]
+        del bucket[value]
+        if len(bucket) == 0:
+            del self.buckets[count]
+            return True
+        return False
+
+    def add(self, value):
+        count = self.counts.get(value)
+        if count is not None:
+            if self.displace(value, count) and count == self.smallest:
+                self.smallest = count + 1
+            self.place(value, count + 1)
+        elif len(self.counts) < self.capacity:
+            self.place(value, 1)
+            self.errors[value] = 0
+            self.smallest = 1
+        else:
+            count = self.smallest
+            replaced = next(iter(self.buckets[count]))
+            emptied = self.displace(replaced, count)
+            del self.counts[replaced]
+            del self.errors[replaced]
+
+            self.place(value, count + 1)
+            self.errors[value] = count
+            if emptied:
+                self.smallest = count + 1
+
+    def floor(self):
+        """The most any value not being counted could have been seen"""
+        if len(self.counts) < self.capacity:
+            return 0
+        return self.smallest
+
+    def rebuild(self, counts, errors):
+        """Replace the counters with these (value => count and error)"""
+        self.counts = {}
+        self.errors = dict(errors)
+        self.buckets = {}
+        for value, count in counts.items():
+            self.place(value, count)
+        self.smallest = min(self.buckets) if len(self.buckets) > 0 else 0
+
+    def merge(self, other):
+        """Combine the counters (Agarwal et al., Mergeable Summaries). A """
+        """value missing from one side may have been seen as many times as """
+        """that side's floor, so that is added to its count and error"""
+        floor = self.floor()
+        other_floor = other.floor()
+
+        counts = {}
+        errors = {}
+        for value in set(self.counts) | set(other.counts):
+            counts[value] = self.counts.get(value, floor) + other.counts.get(value, other_floor)
+            errors[value] = self.errors.get(value, floor) + other.errors.get(value, other_floor)
+
+        keep = sorted(counts, key=lambda value: (-counts[value], value))[0:self.capacity]
+        self.rebuild(dict([(value, counts[value]) for value in keep]),
+                     dict([(value, errors[value]) for value in keep]))
+
+    def top(self):
+        """[(value, count, error)] for up to k of the most frequent values. """
+        """Only values certain to be more frequent than any value that """
+        """isn't counted (count - error > floor) are reported, so values """
+        """with no clear favourites may report none"""
+        floor = self.floor()
+        values = sorted([value for value in self.counts if self.counts[value] - self.errors[value] > floor],
+                        key=lambda value: (-self.counts[value], value))
+        return [(value, self.counts[value], self.errors[value]) for value in values[0:self.k]]
+
+    def __getstate__(self):
+        return (self.k, self.capacity, self.counts, self.errors)
+
+    def __setstate__(self, state):
+        self.k, self.capacity, counts, errors = state
+        self.rebuild(counts, errors)
@@ -2,96 +2,369 @@
 aggregate all of the study details for a single study into one place.
 """
 
-from summfhir import GetInputClient, GetOutputClient, InitMetaTag
-from summfhir.population import Population
+from summfhir import GetInputClient, InitMetaTag
+from summfhir.population import Population, LoadSourceDefinitions
+from summfhir.patient import Patient
+from summfhir.condition import Condition
+from summfhir.interning import ResetInterning
+from summfhir.observation_source import SourceRouter, SourceDataQuery, SourceTable
+from summfhir.parallel import ParallelSummarizer, CanParallelize
+from summfhir.fetch import StreamResources
+from summfhir.planner import MemberResources
+from summfhir.upload import (BuildUploader, SummaryIdentifier, SummaryHash, 
+                            ContentHash, ExistingSummaries)
+from summfhir.ndjson_writer import SummaryFile
+from summfhir.metrics import Phase, CountEvent
 from pathlib import Path
-import json
-import pdb
-from time import sleep
-
-from pprint import pformat
+from collections import defaultdict
 
 class StudySummary:
-    def __init__(self, resource):
+    def __init__(self, resource, shared_scan=True, workers=1):
         meta_tag = resource['meta']['tag'][0]
         self.id = resource['id']
         self.tag = meta_tag['code']
+        self.meta_tag = f"{meta_tag['system']}|{meta_tag['code']}"
         self.title = resource['title']
         self.enrollment = []
 
+        # When True, each resource type is pulled from the server once for
+        # the entire study and handed to every population the subject belongs
+        # to. Otherwise, each population runs its own queries
+        self.shared_scan = shared_scan
+
+        # Patient reference => populations that patient is a member of
+        self.member_index = defaultdict(list)
+
+        # Resource reference => [(population id, summary, contribution)]. This
+        # is only kept for incremental runs (see track_contributions and
+        # incremental.ContributionStore)
+        self.contributions = None
+
+        # Identifier => hash of each summary most recently loaded. Also only
+        # used by incremental runs
+        self.summary_hashes = None
+
+        self.router = None
+
+        # When this run started, for the benefit of the next incremental run
+        self.checkpoint = None
+
         InitMetaTag(meta_tag['system'], meta_tag['code'])
 
+        # Nothing the previous study's summaries shared is of use to this one
+        ResetInterning()
+
         client = GetInputClient()
+
+        # Input that can be split into shards can be summarized by a pool of
+        # processes, which only makes sense when scanning for the whole study
+        self.parallel = None
+        if workers > 1 and shared_scan:
+            if CanParallelize(client):
+                self.parallel = ParallelSummarizer(client, workers)
+            else:
+                print("Parallel summarization requires NDJSON input. "
+                    "Continuing with a single process.")
+
         for group in resource['enrollment']:
             result = client.get(group['reference'])
             if result.success():
-                self.enrollment.append(Population(result.entries[0]))
+                population = Population(result.entries[0])
+                self.enrollment.append(population)
+
+                for member in population.members:
+                    self.member_index[member].append(population)
+
+    def populations_for(self, patient_ref):
+        return self.member_index.get(patient_ref, [])
+
+    def population(self, id):
+        for pop in self.enrollment:
+            if pop.id == id:
+                return pop
+        return None
+
+    def track_contributions(self, contributions):
+        """Remember what each resource contributed to the summaries (in """
+        """contributions, a ContributionStore) so that it can be retracted """
+        """when the resource changes. Must be called before summarizing """
+        """anything"""
+        self.contributions = contributions
+        if self.parallel is not None:
+            print("Contributions can't be tracked by parallel summarization. "
+                "Continuing with a single process.")
+            self.parallel = None
+
+    def record(self, key, contributions):
+        if self.contributions is not None:
+            self.contributions[key] = contributions
+
+    def retract(self, key):
+        """Remove everything the resource (Patient/id, etc) contributed"""
+        if self.contributions is None:
+            return
+
+        for pop_id, header, contribution in self.contributions.pop(key, []):
+            if pop_id is None:
+                # Source rows contribute the same to every population
+                self.router.retract(header, contribution)
+            else:
+                self.population(pop_id).summaries[header].retract(contribution)
+
+    def add_patient(self, patient):
+        ref = f"Patient/{patient['id']}"
+        contributions = []
+        for pop in self.populations_for(ref):
+            contributions.append((pop.id, 'Demographics', pop.add_patient(patient)))
+        self.record(ref, contributions)
+
+    def add_condition(self, condition):
+        contributions = []
+        if 'subject' in condition:
+            for pop in self.populations_for(condition['subject']['reference']):
+                contributions.append((pop.id, 'Conditions', pop.add_condition(condition)))
+        self.record(f"Condition/{condition['id']}", contributions)
+
+    def record_source_row(self, resource, table_code, contribution):
+        self.record(f"Observation/{resource['id']}", [(None, table_code, contribution)])
 
     def summarize_patients(self):
+        if not self.shared_scan:
+            for pop in self.enrollment:
+                pop.summarize_patients()
+            return
+
+        if self.parallel is not None:
+            with Phase("patients", study=self.id) as phase:
+                records = self.parallel.records
+                self.parallel.summarize_patients(self.enrollment, self.tag)
+                phase.add(self.parallel.records - records)
+            return
+
         for pop in self.enrollment:
-            pop.summarize_patients()
+            pop.init_patients()
+
+        with Phase("patients", study=self.id) as phase:
+            for patient in MemberResources("Patient", self.tag, self.member_index.keys(), 
+                                            self.id, elements=Patient.ELEMENTS):
+                self.add_patient(patient)
+                phase.add()
     
     def summarize_conditions(self):
+        if not self.shared_scan:
+            for pop in self.enrollment:
+                pop.summarize_conditions()
+            return
+
+        if self.parallel is not None:
+            with Phase("conditions", study=self.id) as phase:
+                records = self.parallel.records
+                self.parallel.summarize_conditions(self.enrollment, self.tag)
+                phase.add(self.parallel.records - records)
+            return
+
         for pop in self.enrollment:
-            pop.summarize_conditions()
+            pop.init_conditions()
+
+        with Phase("conditions", study=self.id) as phase:
+            for condition in MemberResources("Condition", self.tag, self.member_index.keys(), 
+                                            self.id, elements=Condition.ELEMENTS):
+                self.add_condition(condition)
+                phase.add()
 
     def summarize_source(self):
+        if not self.shared_scan:
+            for pop in self.enrollment:
+                pop.summarize_source()
+            return
+
+        activity_definitions, observation_definitions = LoadSourceDefinitions(self.tag)
+
         for pop in self.enrollment:
-            pop.summarize_source()
-    
+            for table in pop.init_source_tables(activity_definitions, observation_definitions):
+                if self.contributions is not None:
+                    table.track_retractions()
+        self.build_router()
+
+        with Phase("source rows", study=self.id) as phase:
+            if self.parallel is not None:
+                tables = [table for tables in self.router.tables.values() for table in tables]
+                records = self.parallel.records
+                self.parallel.summarize_source(SourceDataQuery(self.meta_tag), tables)
+                phase.add(self.parallel.records - records)
+            else:
+                # Recording each row's contribution rules out the columnar 
+                # engine, so we only do so when there's somewhere to keep them
+                record = None
+                if self.contributions is not None:
+                    record = self.record_source_row
+                self.router.load_source_data(record=record)
+                phase.add(self.router.rows)
+
+    def build_router(self):
+        # The source tables don't filter rows by membership, so every 
+        # population's copy of a table sees each of that table's rows
+        self.router = SourceRouter(self.meta_tag)
+        for pop in self.enrollment:
+            for summary in pop.summaries.values():
+                if isinstance(summary, SourceTable):
+                    self.router.add_table(summary)
+
+    def summarize_changes(self, since, patients=True, conditions=True, source=True):
+        """Apply only the resources which have changed since the previous """
+        """run (retracting whatever they contributed back then) to the """
+        """summaries restored from that run"""
+        updated = f"_lastUpdated=gt{since}"
+        if patients:
+            with Phase("changed patients", study=self.id) as phase:
+                for patient in StreamResources(f"Patient?_tag={self.tag}&{updated}", elements=Patient.ELEMENTS):
+                    self.retract(f"Patient/{patient['id']}")
+                    self.add_patient(patient)
+                    phase.add()
+                phase.add(self.retract_missing("Patient", f"Patient?_tag={self.tag}"))
+
+        if conditions:
+            with Phase("changed conditions", study=self.id) as phase:
+                for condition in StreamResources(f"Condition?_tag={self.tag}&{updated}", elements=Condition.ELEMENTS):
+                    self.retract(f"Condition/{condition['id']}")
+                    self.add_condition(condition)
+                    phase.add()
+                phase.add(self.retract_missing("Condition", f"Condition?_tag={self.tag}"))
+
+        if source:
+            self.build_router()
+
+            with Phase("changed source rows", study=self.id) as phase:
+                query = f"{SourceDataQuery(self.meta_tag)}&{updated}"
+                for resource in StreamResources(query, elements=SourceTable.ELEMENTS):
+                    self.retract(f"Observation/{resource['id']}")
+                    table_code, contribution = self.router.route(resource)
+                    if contribution is not None:
+                        self.record_source_row(resource, table_code, contribution)
+                    phase.add()
+                phase.add(self.retract_missing("Observation", SourceDataQuery(self.meta_tag)))
+
+    def retract_missing(self, resource_type, query):
+        """Retract the resources recorded last time which the search no """
+        """longer returns, whether deleted or no longer tagged for the study. """
+        """Returns the number retracted"""
+        current = (f"{resource_type}/{resource['id']}"
+                        for resource in StreamResources(query, elements=["id"]))
+        missing = self.contributions.missing(resource_type, current)
+        for ref in missing:
+            self.retract(ref)
+        return len(missing)
+
+    def output_name(self, population):
+        """The name of the population's files. Several studies may write """
+        """into the same directory, so each name starts with the study's id"""
+        return f"{self.id}-{population.population_id['value'].lower()}"
+
     def build_text_report(self, outdir="output/summaries"):
         dir = Path(outdir)
         dir.mkdir(parents=True, exist_ok=True)
 
-        for population in self.enrollment:
-            result_filename = dir / f"{population.population_id['value'].lower()}.yaml"
-            with result_filename.open('wt') as outf:
-                outf.write(population.return_text_results())
+        with Phase("text report", study=self.id) as phase:
+            for population in self.enrollment:
+                result_filename = dir / f"{self.output_name(population)}.yaml"
+                with result_filename.open('wt') as outf:
+                    outf.write(population.return_text_results())
+                phase.add()
 
-            print(result_filename)
+                print(result_filename)
 
-    def load_observations(self, outdir="output/summaries"):
-        dest_server = GetOutputClient()
+    def load_observations(self, 
+                        outdir="output/summaries", 
+                        upload_mode="single", 
+                        batch_size=250, 
+                        upload=True,
+                        compression="none",
+                        skip_unchanged=True):
+        """Write each population's summaries to its own NDJSON file (and """
+        """load them into the server) as they are built. Unless """
+        """skip_unchanged is False, summaries identical to those already on """
+        """the server aren't loaded again"""
+        uploader = None
+        existing = None
+        if upload:
+            if skip_unchanged:
+                with Phase("existing summaries", study=self.id) as phase:
+                    existing = ExistingSummaries(self.meta_tag)
+                    if existing is not None:
+                        phase.add(len(existing))
+                        print(f"{len(existing)} summaries already on the server")
 
-        summaries = []
-        for population in self.enrollment:
-            local_summaries = population.return_summaries()
+            print("Loading to server: ")
+            uploader = BuildUploader(upload_mode, batch_size=batch_size)
 
-            print(f"{population.tag} - {len(local_summaries)} summaries")
-            summaries += local_summaries
-        dir = Path(outdir)
-        dir.mkdir(parents=True, exist_ok=True)
-        result_filename = dir / f"{population.population_id['value'].lower()}.json"
-
-
-        with result_filename.open('wt') as outf:
-            json.dump(summaries, outf, indent=2)
-        print(result_filename)        
-
-        print("Loading to server: ")
-        for summary in summaries:
-            try:
-                system = summary['identifier'][0]['system']
-                value = summary['identifier'][0]['value']
-            except:
-                print(pformat(summary['identifier']))
-                pdb.set_trace()
-            identifier_type = "identifier"
-
-            retry_count = 5
-            while retry_count > 0:
-                retry_count -= 1
-                result = dest_server.post('Observation',
-                            summary,
-                            identifier=value,
-                            identifier_system=system,
-                            identifier_type=identifier_type)
-                if result['status_code'] < 300:
-                    retry_count = 0
-                elif retry_count < 0:
-                    print("\tToo many retries. Giving up on this one. ")
-                    pdb.set_trace()
-                else:
-                    print(pformat(result))
-                    print(f"\t{result['status_code']} : {result['request_url']}")
-                    sleep(5)
\ No newline at end of file
+        unchanged = 0
+        created = 0
+        updated = 0
+        with Phase("load summaries", study=self.id) as phase:
+            for population in self.enrollment:
+                with SummaryFile(outdir, self.output_name(population), compression) as outf:
+                    for summary in population.iter_summaries():
+                        outf.write(summary)
+                        phase.add()
+                        if uploader is None:
+                            continue
+
+                        try:
+                            system, value = SummaryIdentifier(summary)
+                        except (KeyError, IndexError):
+                            # The uploader reports it and counts it as failed
+                            uploader.add(summary)
+                            continue
+
+                        # Whether there may be an older copy on the server to replace
+                        key = f"{system}|{value}"
+                        update = False
+
+                        # Incremental runs only load the summaries that have changed 
+                        if self.summary_hashes is not None:
+                            digest = SummaryHash(summary)
+                            previous = self.summary_hashes.get(key)
+                            if previous == digest:
+                                unchanged += 1
+                                continue
+                            self.summary_hashes[key] = digest
+                            update = previous is not None
+
+                        # As do any others, so long as we know what's on the server
+                        if existing is not None:
+                            if key not in existing:
+                                created += 1
+                                update = False
+                            elif existing[key] == ContentHash(summary):
+                                unchanged += 1
+                                continue
+                            else:
+                                updated += 1
+                                update = True
+                        uploader.add(summary, update=update)
+
+                print(f"{population.tag} - {outf.count} summaries")
+                print(outf.filename)
+
+            if uploader is not None:
+                uploader.flush()
+
+        if uploader is None:
+            return
+        CountEvent("summaries loaded", uploader.loaded)
+        CountEvent("summaries failed", uploader.failed)
+        CountEvent("summaries unchanged", unchanged)
+        if existing is not None:
+            CountEvent("summaries created", created)
+            CountEvent("summaries updated", updated)
+
+        # We don't know which ones failed, so we'll start over next time
+        if uploader.failed > 0 and self.summary_hashes is not None:
+            self.summary_hashes = {}
+
+        if existing is not None:
+            print(f"\t{created} summaries created, {updated} updated, "
+                f"{unchanged} skipped as unchanged")
+        elif self.summary_hashes is not None:
+            print(f"\t{unchanged} summaries unchanged since the previous run")
+        print(f"\t{uploader.report()}")
@@ -18,37 +18,49 @@ Each study has one or more groups referenced by ResearchStudy.enrollment
 """
 
 import sys
-from argparse import ArgumentParser, FileType
+from argparse import ArgumentParser, FileType, Namespace
 
 import json
 from ncpi_fhir_client.fhir_client import FhirClient
 from yaml import safe_load
-from summfhir import SetInputClient
-from summfhir.study import StudySummary
+from summfhir.ndjson_client import NdjsonClient
+from summfhir.scheduler import StudyJob, StudyScheduler, FindStudies, StudySize, RunSummary
+from summfhir.upload import UPLOAD_MODES
+from summfhir.terminology import InitTerminologyCache
+from summfhir.fetch import (UseElements, ProjectionReport, SetPrefetchPages, 
+                            DEFAULT_PREFETCH_PAGES, SetSearchPartitions, 
+                            DEFAULT_SEARCH_PARTITIONS)
+from summfhir.stats import SetQuantileAccuracy, SetDistinctThreshold, SetTopValues
+from summfhir.columnar import UseColumnar
+from summfhir.ndjson_writer import SetSerializer, SERIALIZERS, COMPRESSION
+from summfhir.metrics import InstrumentedClient, GetMetrics, WriteRunReport, SetProfiler
+from summfhir.profiling import Profiler
 
 # This should probably get moved over to fhir_client so that this tool doesn't 
 # require whistler, since this really isn't specific to Whistler...only the 
 # model we are using in whistler
 from wstlr import get_host_config
 
-def BuildStudySummaries(study_tag, 
-                    fhirclient, 
-                    summarize_patients, 
-                    summarize_conditions, 
-                    summarize_source):
-    
-    result = fhirclient.get(f"ResearchStudy?_tag={study_tag}")
-    if result.success():
-        for entry in result.entries:
-            study = StudySummary(entry['resource'])
-            if summarize_patients:
-                study.summarize_patients()
-            if summarize_conditions:
-                study.summarize_conditions()
-            if summarize_source:
-                study.summarize_source()
-
-    return study
+def Connect(host):
+    """A client for the host (a key in the host config)"""
+    return InstrumentedClient(FhirClient(get_host_config()[host]))
+
+def ConfigureRun(args):
+    """Apply the settings which are kept in module globals. The scheduler's """
+    """processes call this again for themselves"""
+    cache_dir = args.terminology_cache
+    if cache_dir.lower() == "none":
+        cache_dir = None
+    InitTerminologyCache(cache_dir, args.terminology_cache_size * 1024 * 1024)
+
+    UseElements(not args.no_elements)
+    SetPrefetchPages(args.prefetch_pages)
+    SetSearchPartitions(args.search_partitions)
+    SetQuantileAccuracy(args.quantile_accuracy)
+    SetDistinctThreshold(args.distinct_threshold)
+    SetTopValues(args.top_values, args.top_values_capacity)
+    UseColumnar(args.columnar)
+    SetSerializer(args.json_serializer)
 
 def exec(args=None):
     if args is None:
@@ -116,6 +128,206 @@ def exec(args=None):
         action='store_true',
         help="Summarize source tables"
     )
+    parser.add_argument(
+        "--per-population-scan",
+        action='store_true',
+        help="Query the server separately for each enrollment group rather "
+            "than scanning each resource type once for the entire study"
+    )
+    parser.add_argument(
+        "--upload-mode",
+        choices=UPLOAD_MODES,
+        default="single",
+        help="Load summaries one at a time or packed into batch or "
+            "transaction Bundles"
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=250,
+        help="Number of summaries per Bundle when using batch or transaction "
+            "uploads"
+    )
+    parser.add_argument(
+        "--rewrite-unchanged",
+        action='store_true',
+        help="Load every summary, even those identical to the copy already on "
+            "the server. By default, the study's existing summaries are "
+            "fetched first and only new or changed summaries are loaded"
+    )
+    parser.add_argument(
+        "--terminology-cache",
+        type=str,
+        default="output/cache/terminology",
+        help="Directory where ValueSet expansions are kept between runs. Use "
+            "'none' to keep them in memory only"
+    )
+    parser.add_argument(
+        "--terminology-cache-size",
+        type=int,
+        default=64,
+        help="Maximum size, in MB, of the on-disk ValueSet expansion cache"
+    )
+    parser.add_argument(
+        "--quantile-accuracy",
+        type=float,
+        default=0.01,
+        help="Relative accuracy of the quantiles (median) reported for "
+            "numeric variables. Smaller is more accurate but uses more memory"
+    )
+    parser.add_argument(
+        "--distinct-threshold",
+        type=int,
+        default=100000,
+        help="Distinct string values are counted exactly up to this many, "
+            "after which the count is estimated (HyperLogLog)"
+    )
+    parser.add_argument(
+        "--top-values",
+        type=int,
+        default=0,
+        help="Report up to this many of the most frequent values for each "
+            "string variable, with approximate counts once there are many. Only "
+            "values certain to be among the most frequent are reported, and "
+            "with --workers these may differ from a single process's"
+    )
+    parser.add_argument(
+        "--top-values-capacity",
+        type=int,
+        default=None,
+        help="Counters to keep when finding the most frequent values. More "
+            "gives tighter counts (default: ten times --top-values)"
+    )
+    parser.add_argument(
+        "--columnar",
+        action='store_true',
+        help="Summarize source rows in batches with NumPy rather than one "
+            "row at a time. The summaries are the same either way"
+    )
+    parser.add_argument(
+        "--output-compression",
+        choices=COMPRESSION,
+        default="none",
+        help="Compress the NDJSON summary files written for each population. "
+            "zstd requires the zstandard package"
+    )
+    parser.add_argument(
+        "--json-serializer",
+        choices=SERIALIZERS,
+        default="auto",
+        help="JSON library used to write the summary files. auto uses orjson "
+            "when it is installed"
+    )
+    parser.add_argument(
+        "--input-dir",
+        type=str,
+        default=None,
+        help="Read the study's resources from a directory of NDJSON (or "
+            "gzipped NDJSON) files, one or more per resource type, rather "
+            "than from the FHIR server. Summaries are still loaded into the "
+            "configured server, if there is one."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to summarize NDJSON input (see "
+            "--input-dir)"
+    )
+    parser.add_argument(
+        "--all-studies",
+        action='store_true',
+        help="Summarize every ResearchStudy on the server (or in --input-dir) "
+            "rather than those with the study's tag"
+    )
+    parser.add_argument(
+        "--concurrent-studies",
+        type=int,
+        default=1,
+        help="Number of studies summarized at once, each in its own process. "
+            "The largest studies are started first"
+    )
+    parser.add_argument(
+        "--host-limit",
+        type=int,
+        default=2,
+        help="Most studies summarized at once against any one FHIR server "
+            "(see --concurrent-studies)"
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=str,
+        default="output/logs",
+        help="Where each study's output is written when studies are "
+            "summarized concurrently"
+    )
+    parser.add_argument(
+        "--incremental",
+        action='store_true',
+        help="Start from the summaries saved by the previous run and only "
+            "pull resources updated since then. Only summaries whose content "
+            "changed are loaded. The first run summarizes everything."
+    )
+    parser.add_argument(
+        "--state-dir",
+        type=str,
+        default="output/state",
+        help="Directory where summary state is kept between incremental runs"
+    )
+    parser.add_argument(
+        "--run-report",
+        type=str,
+        default="output/reports/run-report.json",
+        help="Where to write the JSON report of the time spent in each phase "
+            "and on each kind of request. Use 'none' to skip it"
+    )
+    parser.add_argument(
+        "--prometheus",
+        type=str,
+        default=None,
+        help="Also write the run's metrics to this file in Prometheus' text "
+            "format (for node_exporter's textfile collector)"
+    )
+    parser.add_argument(
+        "--profile-cpu",
+        action='store_true',
+        help="Write a CPU profile (cProfile) for each phase of the run"
+    )
+    parser.add_argument(
+        "--profile-mem",
+        action='store_true',
+        help="Trace memory allocations (tracemalloc), reporting the peak and "
+            "the largest allocation sites for each phase. This slows the run "
+            "down considerably"
+    )
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default="output/summaries/profiles",
+        help="Where the profiles are written (a directory per study with "
+            "--concurrent-studies)"
+    )
+    parser.add_argument(
+        "--prefetch-pages",
+        type=int,
+        default=DEFAULT_PREFETCH_PAGES,
+        help="Number of search pages fetched in the background while the "
+            "current page is summarized. 0 fetches one page at a time"
+    )
+    parser.add_argument(
+        "--search-partitions",
+        type=int,
+        default=DEFAULT_SEARCH_PARTITIONS,
+        help="Number of pages of a large search fetched at once, when the "
+            "server pages by offset (as HAPI does). 1 follows the next links "
+            "one page at a time"
+    )
+    parser.add_argument(
+        "--no-elements",
+        action='store_true',
+        help="Request complete resources rather than only the elements the "
+            "summaries use (_elements)"
+    )
 
  
     args = parser.parse_args(sys.argv[1:])
@@ -128,7 +340,67 @@ def exec(args=None):
     summarize_conditions = summarize_all or args.condition
     summarize_source = summarize_all or args.source
 
+    # Everything but the open config files, which the scheduler's processes
+    # have no use for (and can't be pickled)
+    options = Namespace(**dict([(k, v) for k, v in vars(args).items() if k != "config"]))
+    ConfigureRun(options)
+
+    profiler = None
+    if args.profile_cpu or args.profile_mem:
+        profiler = Profiler(args.profile_dir, cpu=args.profile_cpu, memory=args.profile_mem)
+        SetProfiler(profiler)
+
+    state_dir = None
+    if args.incremental:
+        state_dir = args.state_dir
+
+    settings = {
+        "summarize_patients": summarize_patients,
+        "summarize_conditions": summarize_conditions,
+        "summarize_source": summarize_source,
+        "shared_scan": not args.per_population_scan,
+        "workers": args.workers,
+        "state_dir": state_dir,
+        "upload_mode": args.upload_mode,
+        "batch_size": args.batch_size,
+        "compression": args.output_compression,
+        "skip_unchanged": not args.rewrite_unchanged,
+
+        # The scheduler's processes profile each study for themselves
+        "profile": None
+    }
+    if profiler is not None:
+        settings['profile'] = {
+            "dir": args.profile_dir,
+            "cpu": args.profile_cpu,
+            "memory": args.profile_mem
+        }
 
+    # Each ResearchStudy found (several may share a tag) is a job of its own
+    jobs = {}
+    def AddStudies(client, study_host, study_tag, source):
+        if study_tag == "" and not args.all_studies:
+            print(f"No study tag for {source}. Provide --meta-tag (or "
+                "study_id in the config) or use --all-studies")
+            return
+        if args.all_studies:
+            study_tag = ""
+
+        for resource in FindStudies(client, study_tag):
+            job = StudyJob(resource, host=study_host, input_dir=args.input_dir, source=source)
+            if (study_host, job.id) in jobs:
+                continue
+            if args.concurrent_studies > 1:
+                job.size = StudySize(client, job.meta_tag)
+            jobs[(study_host, job.id)] = job
+
+    if len(args.config) == 0:
+        # Without a config, there is no server to load into, so we'll just
+        # write the summaries out locally (unless a host was provided)
+        if args.input_dir is not None:
+            AddStudies(NdjsonClient(args.input_dir), host, tag, args.input_dir)
+        elif host is not None:
+            AddStudies(Connect(host), host, tag, host)
 
     for config_file in args.config:
         config = safe_load(config_file)
@@ -139,6 +411,7 @@ def exec(args=None):
             args.env = 'local'
             print("Defaulting to the local environment")
 
+        config_host = host
         if args.env is not None:
             if args.env not in environment:
                 print(f"The environment, {args.env}, is not configured in {config}.")
@@ -148,14 +421,41 @@ def exec(args=None):
                 print(f"Specifying both a host and and environment doesn't make sense. Please use only --env or --host")
                 sys.exit(1)
 
-            host = environment[args.env]
+            config_host = environment[args.env]
+
+        study_tag = tag
+        if "study_id" in config and tag == "":
+            study_tag = config["study_id"]
+
+        if args.input_dir is not None:
+            client = NdjsonClient(args.input_dir)
+        else:
+            client = Connect(config_host)
+        AddStudies(client, config_host, study_tag, config_file.name)
+
+    scheduler = StudyScheduler(settings,
+                                Connect,
+                                concurrency=args.concurrent_studies,
+                                host_limit=args.host_limit,
+                                log_dir=args.log_dir,
+                                initializer=ConfigureRun,
+                                initargs=(options,))
+    results = scheduler.run(list(jobs.values()))
 
-            if "study_id" in config and tag == "":
-                tag = config["study_id"]
-        fhirclient = FhirClient(host_config[host])
-        SetInputClient(fhirclient)
+    report = ProjectionReport()
+    if report != "":
+        print("Bytes saved by requesting only the elements we use:")
+        print(report)
 
-        study = BuildStudySummaries(tag, fhirclient, summarize_patients, summarize_conditions, summarize_source)
+    print(GetMetrics().summary())
+    if len(results) > 1:
+        print(RunSummary(results, GetMetrics().report()['seconds']))
+    run_report = args.run_report
+    if run_report is not None and run_report.lower() == "none":
+        run_report = None
+    WriteRunReport(run_report, args.prometheus, studies=results)
+    if profiler is not None:
+        print(profiler.report())
 
-        study.build_text_report()
-        study.load_observations()
+    if len([result for result in results if result['status'] != "ok"]) > 0:
+        sys.exit(1)
@@ -18,28 +18,43 @@ class NoValidCode(Exception):
         return "No valid code found"
 
 
+# (system, code, system, code...) => the index ChooseCode picks from those 
+# codings. Conditions with the same code nearly always have the same codings,
+# so there are about as many of these as there are distinct codes
+_code_choices = {}
+
+def ResetCodeChoices():
+    _code_choices.clear()
+
 def ChooseCode(coding):
     "Remove DD codes and sort by code, returning the first in case "
     "conditions with the same codes aren't ordered the same"
     if len(coding) == 1:
         return coding[0]
-    
-    valid_matches = {}
-    codes = []
-    for code in coding:
-        if dd_filter.search(code['system']) is None:
-            codes.append(code['code'])
-            valid_matches[code['code']] = code
 
-    if len(codes) > 0:
-        return valid_matches[sorted(codes)[0]]
+    key = tuple([value for code in coding for value in (code['system'], code['code'])])
+    index = _code_choices.get(key)
+    if index is None:
+        valid_matches = {}
+        for position, code in enumerate(coding):
+            if dd_filter.search(code['system']) is None:
+                valid_matches[code['code']] = position
+
+        if len(valid_matches) == 0:
+            raise NoValidCode()
+        index = valid_matches[min(valid_matches)]
+        _code_choices[key] = index
 
-    raise NoValidCode()
+    return coding[index]
+
+def CodeCounts():
+    # A named function rather than a lambda so that summaries can be pickled
+    return defaultdict(int)
 
 class Summary:
     def __init__(self):
         # domain => code => count
-        self.counts = defaultdict(lambda: defaultdict(lambda: 0))
+        self.counts = defaultdict(CodeCounts)
 
         # We'll need these observed codes to build the components
         # domain => code => coding
@@ -47,6 +62,40 @@ class Summary:
 
         self.resource_count = 0
 
+    def merge(self, other):
+        """Add the counts from another summary of the same kind. Where both """
+        """have observed a code, we keep our own coding, just as we would """
+        """if we had seen the other summary's resources after our own"""
+        for domain in other.counts:
+            counts = self.counts[domain]
+            for code, count in other.counts[domain].items():
+                counts[code] += count
+
+        self.merge_observed_codes(other)
+        self.resource_count += other.resource_count
+
+        if getattr(self, 'identifier_system', None) is None:
+            self.identifier_system = getattr(other, 'identifier_system', None)
+
+    def retract(self, contribution):
+        """Remove a resource's contribution (as returned by add_resource) """
+        """from the counts"""
+        self.resource_count -= 1
+        for domain, code in contribution:
+            counts = self.counts[domain]
+            counts[code] -= 1
+            if counts[code] <= 0:
+                del counts[code]
+                if len(counts) == 0:
+                    del self.counts[domain]
+
+    def merge_observed_codes(self, other):
+        for domain in other.observed_codes:
+            observed = self.observed_codes[domain]
+            for code, coding in other.observed_codes[domain].items():
+                if code not in observed:
+                    observed[code] = coding
+
     def BuildSummaryObservations(self, population):
         # The derived classes should have overridden this function
         assert(False)
@@ -0,0 +1,482 @@
+"""
+Synthetic study data, shaped the way the NCPI IG (and Whistle's output) shapes
+it, for benchmarking and for exercising the summaries at whatever scale is
+required without a real study on hand.
+
+A study has a ResearchStudy enrolling one or more Groups, the Patients and
+their Conditions, and a set of source tables: an ActivityDefinition per table,
+an ObservationDefinition per variable (string, Quantity or CodeableConcept,
+with a ValueSet for each of the latter) and a source data Observation (74468-0)
+per row. The scale and cardinality of each piece are configurable, and the
+resources are generated one at a time, so arbitrarily large studies can be
+streamed straight into the summaries or out to NDJSON (for --input-dir).
+
+    summarize-synthetic output/synthetic --patients 100000 --condition-codes 5000
+
+Everything is drawn from seeded generators, so the same settings always
+produce the same study.
+"""
+
+from argparse import ArgumentParser
+from itertools import accumulate
+from pathlib import Path
+import json
+import random
+import sys
+
+from summfhir.observation_source import source_data_code
+
+RACES = [
+    ("2106-3", "White"),
+    ("2054-5", "Black or African American"),
+    ("2028-9", "Asian"),
+    ("1002-5", "American Indian or Alaska Native"),
+    ("2076-8", "Native Hawaiian or Other Pacific Islander")
+]
+
+ETHNICITIES = [
+    ("2135-2", "Hispanic or Latino"),
+    ("2186-5", "Not Hispanic or Latino")
+]
+
+GENDERS = ["female", "male", "other", "unknown"]
+
+VERIFICATION_STATUS = ["confirmed", "confirmed", "confirmed", "refuted", "unconfirmed"]
+
+# The permittedDataType of each variable, in turn
+VARIABLE_TYPES = ["string", "Quantity", "CodeableConcept"]
+
+class SyntheticStudy:
+    def __init__(self,
+                tag="SYNTH",
+                patients=1000,
+                populations=2,
+                membership=0.6,
+                conditions_per_patient=3,
+                condition_codes=500,
+                code_skew=1.1,
+                tables=2,
+                variables=9,
+                rows_per_patient=2,
+                categories=5,
+                string_values=100,
+                missing=0.05,
+                mismatched=0.02,
+                seed=1):
+        self.tag = tag
+        self.tag_system = "https://example.org/fhir/study"
+        self.base = f"https://example.org/fhir/{tag.lower()}"
+
+        self.patients = patients
+        self.populations = populations
+
+        # The chance that a patient is a member of any given population
+        self.membership = membership
+
+        self.conditions_per_patient = conditions_per_patient
+        self.condition_codes = condition_codes
+
+        # Condition codes follow a Zipf distribution with this exponent, since
+        # a few conditions are common and most are rare
+        self.code_skew = code_skew
+
+        self.tables = tables
+        self.variables = variables
+        self.rows_per_patient = rows_per_patient
+        self.categories = categories
+        self.string_values = string_values
+
+        # The chance that a row has no value for a variable, and that the
+        # value it has doesn't match the data dictionary
+        self.missing = missing
+        self.mismatched = mismatched
+
+        self.seed = seed
+
+    def meta(self):
+        return {
+            "tag": [{
+                "system": self.tag_system,
+                "code": self.tag
+            }]
+        }
+
+    def random(self, stream):
+        """A generator for each kind of resource, so that each is the same """
+        """no matter which others are generated (or in which order)"""
+        return random.Random(f"{self.seed}-{stream}")
+
+    def table_code(self, table):
+        return f"table-{table}"
+
+    def variable_code(self, variable):
+        return f"var-{variable}"
+
+    def variable_type(self, variable):
+        return VARIABLE_TYPES[variable % len(VARIABLE_TYPES)]
+
+    def table_system(self, table):
+        return f"{self.base}/CodeSystem/data-dictionary/{self.table_code(table)}"
+
+    def category_system(self, table, variable):
+        return f"{self.table_system(table)}/{self.variable_code(variable)}"
+
+    def research_study(self):
+        return {
+            "resourceType": "ResearchStudy",
+            "id": f"{self.tag.lower()}-study",
+            "meta": self.meta(),
+            "identifier": [{
+                "system": f"{self.base}/researchstudy",
+                "value": self.tag
+            }],
+            "title": f"Synthetic Study {self.tag}",
+            "status": "completed",
+            "enrollment": [
+                {"reference": f"Group/{self.tag.lower()}-group-{i}"} for i in range(self.populations)
+            ]
+        }
+
+    def groups(self):
+        rnd = self.random("Group")
+        for i in range(self.populations):
+            members = [f"Patient/p{p}" for p in range(self.patients) if rnd.random() < self.membership]
+            yield {
+                "resourceType": "Group",
+                "id": f"{self.tag.lower()}-group-{i}",
+                "meta": self.meta(),
+                "identifier": [{
+                    "system": f"{self.base}/group",
+                    "value": f"{self.tag}-GROUP-{i}",
+                    "use": "official"
+                }],
+                "type": "person",
+                "actual": True,
+                "quantity": len(members),
+                "member": [{"entity": {"reference": ref}} for ref in members]
+            }
+
+    def patient_resources(self):
+        rnd = self.random("Patient")
+        for p in range(self.patients):
+            race = rnd.choice(RACES)
+            ethnicity = rnd.choice(ETHNICITIES)
+            patient = {
+                "resourceType": "Patient",
+                "id": f"p{p}",
+                "meta": self.meta(),
+                "identifier": [{
+                    "system": f"{self.base}/patient",
+                    "value": f"P{p}"
+                }],
+                "extension": [{
+                    "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-race",
+                    "extension": [{
+                        "url": "ombCategory",
+                        "valueCoding": {
+                            "system": "urn:oid:2.16.840.1.113883.6.238",
+                            "code": race[0],
+                            "display": race[1]
+                        }
+                    }, {
+                        "url": "text",
+                        "valueString": race[1]
+                    }]
+                }, {
+                    "url": "http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity",
+                    "extension": [{
+                        "url": "ombCategory",
+                        "valueCoding": {
+                            "system": "urn:oid:2.16.840.1.113883.6.238",
+                            "code": ethnicity[0],
+                            "display": ethnicity[1]
+                        }
+                    }, {
+                        "url": "text",
+                        "valueString": ethnicity[1]
+                    }]
+                }]
+            }
+            if rnd.random() >= self.missing:
+                patient['gender'] = rnd.choice(GENDERS)
+            yield patient
+
+    def condition_resources(self):
+        rnd = self.random("Condition")
+        weights = list(accumulate([1.0 / (i + 1) ** self.code_skew for i in range(self.condition_codes)]))
+        codes = range(self.condition_codes)
+
+        id = 0
+        for p in range(self.patients):
+            # Somewhere between none and twice the average per patient
+            for i in range(rnd.randint(0, 2 * self.conditions_per_patient)):
+                code = rnd.choices(codes, cum_weights=weights)[0]
+                ontology = "hp" if code % 2 == 0 else "mondo"
+                display = f"Synthetic condition {code}"
+                yield {
+                    "resourceType": "Condition",
+                    "id": f"c{id}",
+                    "meta": self.meta(),
+                    "identifier": [{
+                        "system": f"{self.base}/condition",
+                        "value": f"C{id}"
+                    }],
+                    "subject": {
+                        "reference": f"Patient/p{p}"
+                    },
+                    "verificationStatus": {
+                        "coding": [{
+                            "system": "http://terminology.hl7.org/CodeSystem/condition-ver-status",
+                            "code": rnd.choice(VERIFICATION_STATUS)
+                        }]
+                    },
+                    "code": {
+                        "coding": [{
+                            "system": f"{self.base}/CodeSystem/data-dictionary/conditions",
+                            "code": f"condition-{code}",
+                            "display": display
+                        }, {
+                            "system": f"http://purl.obolibrary.org/obo/{ontology}.owl",
+                            "code": f"{ontology.upper()}:{code:07d}",
+                            "display": display
+                        }],
+                        "text": display
+                    }
+                }
+                id += 1
+
+    def value_sets(self):
+        for table in range(self.tables):
+            for variable in range(self.variables):
+                if self.variable_type(variable) == "CodeableConcept":
+                    system = self.category_system(table, variable)
+                    yield {
+                        "resourceType": "ValueSet",
+                        "id": f"{self.table_code(table)}-{self.variable_code(variable)}",
+                        "meta": self.meta(),
+                        "url": f"{self.base}/ValueSet/{self.table_code(table)}-{self.variable_code(variable)}",
+                        "status": "active",
+                        "expansion": {
+                            "total": self.categories,
+                            "contains": [{
+                                "system": system,
+                                "code": f"cat-{c}",
+                                "display": f"Category {c}"
+                            } for c in range(self.categories)]
+                        }
+                    }
+
+    def observation_definitions(self):
+        for table in range(self.tables):
+            for variable in range(self.variables):
+                variable_type = self.variable_type(variable)
+                obsdef = {
+                    "resourceType": "ObservationDefinition",
+                    "id": f"{self.table_code(table)}-{self.variable_code(variable)}",
+                    "meta": self.meta(),
+                    "identifier": [{
+                        "system": f"{self.base}/observationdefinition",
+                        "value": f"{self.table_code(table)}.{self.variable_code(variable)}"
+                    }],
+                    "code": {
+                        "coding": [{
+                            "system": self.table_system(table),
+                            "code": self.variable_code(variable),
+                            "display": f"Variable {variable} of table {table}"
+                        }]
+                    },
+                    "permittedDataType": [variable_type]
+                }
+                if variable_type == "Quantity":
+                    obsdef['quantitativeDetails'] = {
+                        "unit": {
+                            "coding": [{"system": "http://unitsofmeasure.org", "code": "kg"}],
+                            "code": "kg"
+                        }
+                    }
+                elif variable_type == "CodeableConcept":
+                    obsdef['validCodedValueSet'] = {
+                        "reference": f"ValueSet/{obsdef['id']}"
+                    }
+                yield obsdef
+
+    def activity_definitions(self):
+        for table in range(self.tables):
+            yield {
+                "resourceType": "ActivityDefinition",
+                "id": self.table_code(table),
+                "meta": self.meta(),
+                "identifier": [{
+                    "system": f"{self.base}/activitydefinition",
+                    "value": self.table_code(table),
+                    "use": "official"
+                }],
+                "title": f"Synthetic Table {table}",
+                "status": "active",
+                "observationResultRequirement": [
+                    {"reference": f"ObservationDefinition/{self.table_code(table)}-{self.variable_code(v)}"}
+                        for v in range(self.variables)
+                ]
+            }
+
+    def component(self, rnd, table, variable):
+        component = {
+            "code": {
+                "coding": [{
+                    "system": self.table_system(table),
+                    "code": self.variable_code(variable)
+                }]
+            }
+        }
+
+        variable_type = self.variable_type(variable)
+        mismatched = rnd.random() < self.mismatched
+        if variable_type == "string":
+            component['valueString'] = f"value-{rnd.randrange(self.string_values)}"
+        elif variable_type == "Quantity":
+            if mismatched:
+                component['valueString'] = rnd.choice(["NA", "Unknown", "> 100"])
+            else:
+                component['valueQuantity'] = {
+                    "value": round(rnd.gauss(50 + 10 * variable, 15), 2),
+                    "unit": "kg",
+                    "system": "http://unitsofmeasure.org",
+                    "code": "kg"
+                }
+        elif mismatched:
+            component['valueCodeableConcept'] = {
+                "coding": [{
+                    "system": self.category_system(table, variable),
+                    "code": "not-in-dd"
+                }],
+                "text": "Not in DD"
+            }
+        else:
+            c = rnd.randrange(self.categories)
+            component['valueCodeableConcept'] = {
+                "coding": [{
+                    "system": self.category_system(table, variable),
+                    "code": f"cat-{c}",
+                    "display": f"Category {c}"
+                }]
+            }
+        return component
+
+    def source_rows(self):
+        rnd = self.random("Observation")
+        id = 0
+        for p in range(self.patients):
+            for i in range(self.rows_per_patient):
+                table = rnd.randrange(self.tables)
+                components = []
+                for variable in range(self.variables):
+                    if rnd.random() >= self.missing:
+                        components.append(self.component(rnd, table, variable))
+                yield {
+                    "resourceType": "Observation",
+                    "id": f"o{id}",
+                    "meta": self.meta(),
+                    "status": "final",
+                    "code": {
+                        "coding": [{
+                            "system": "http://loinc.org",
+                            "code": source_data_code,
+                            "display": "Source data row"
+                        }, {
+                            "system": f"{self.base}/CodeSystem/data-dictionary/dataset",
+                            "code": self.table_code(table)
+                        }]
+                    },
+                    "subject": {
+                        "reference": f"Patient/p{p}"
+                    },
+                    "component": components
+                }
+                id += 1
+
+    def resources(self):
+        """resource type => generator of that type's resources"""
+        return {
+            "ResearchStudy": iter([self.research_study()]),
+            "Group": self.groups(),
+            "Patient": self.patient_resources(),
+            "Condition": self.condition_resources(),
+            "ValueSet": self.value_sets(),
+            "ObservationDefinition": self.observation_definitions(),
+            "ActivityDefinition": self.activity_definitions(),
+            "Observation": self.source_rows()
+        }
+
+def WriteNdjson(study, directory):
+    """Write the study out as {ResourceType}.ndjson, which NdjsonClient """
+    """(--input-dir) can read. Returns resource type => count"""
+    dir = Path(directory)
+    dir.mkdir(parents=True, exist_ok=True)
+
+    counts = {}
+    for resource_type, resources in study.resources().items():
+        count = 0
+        with (dir / f"{resource_type}.ndjson").open('wt') as outf:
+            for resource in resources:
+                outf.write(json.dumps(resource, separators=(',', ':')))
+                outf.write("\n")
+                count += 1
+        counts[resource_type] = count
+    return counts
+
+def exec(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description="Write a synthetic study as NDJSON "
+                    "suitable for summarize --input-dir")
+    parser.add_argument("outdir", help="Directory to write the NDJSON files to")
+    parser.add_argument("-t", "--meta-tag", type=str, default="SYNTH",
+        help="Tag applied to every resource")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--populations", type=int, default=2,
+        help="Number of Groups enrolled in the study")
+    parser.add_argument("--membership", type=float, default=0.6,
+        help="Chance that a patient belongs to any given population")
+    parser.add_argument("--conditions-per-patient", type=int, default=3,
+        help="Average number of conditions for each patient")
+    parser.add_argument("--condition-codes", type=int, default=500,
+        help="Number of distinct condition codes")
+    parser.add_argument("--code-skew", type=float, default=1.1,
+        help="Zipf exponent for how often each condition code is used")
+    parser.add_argument("--tables", type=int, default=2)
+    parser.add_argument("--variables", type=int, default=9,
+        help="Variables per table (string, Quantity and CodeableConcept in turn)")
+    parser.add_argument("--rows-per-patient", type=int, default=2)
+    parser.add_argument("--categories", type=int, default=5,
+        help="Number of values in each categorical variable's ValueSet")
+    parser.add_argument("--string-values", type=int, default=100,
+        help="Number of distinct values of each string variable")
+    parser.add_argument("--missing", type=float, default=0.05,
+        help="Chance that a row has no value for a variable")
+    parser.add_argument("--mismatched", type=float, default=0.02,
+        help="Chance that a value isn't in the data dictionary")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(args)
+
+    study = SyntheticStudy(tag=args.meta_tag,
+                            patients=args.patients,
+                            populations=args.populations,
+                            membership=args.membership,
+                            conditions_per_patient=args.conditions_per_patient,
+                            condition_codes=args.condition_codes,
+                            code_skew=args.code_skew,
+                            tables=args.tables,
+                            variables=args.variables,
+                            rows_per_patient=args.rows_per_patient,
+                            categories=args.categories,
+                            string_values=args.string_values,
+                            missing=args.missing,
+                            mismatched=args.mismatched,
+                            seed=args.seed)
+
+    for resource_type, count in WriteNdjson(study, args.outdir).items():
+        print(f"{resource_type:<24} {count}")
+
+if __name__ == "__main__":
+    exec()
@@ -0,0 +1,226 @@
+"""
+Cache for ValueSet expansions.
+
+The same handful of ValueSets (yes/no, sex, units, etc) are referenced by many
+ObservationDefinitions, and each population used to expand them all over
+again. Expansions are kept in memory for the run and, when a cache directory
+is provided, on disk between runs. The on-disk cache is trimmed back to its
+size limit by discarding the least recently used expansions.
+
+A reference without a version (ValueSet/x) may be updated between runs, so
+on disk its expansion is also keyed by the server's meta.versionId (or
+lastUpdated), which is read once per run. Once a ValueSet changes, its old
+expansion is no longer used and is eventually evicted. If the server doesn't
+report either, the expansion is only cached for the run.
+"""
+
+from summfhir import GetInputClient
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from hashlib import sha1
+import threading
+import json
+import os
+
+# Default limit for the on-disk cache
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+_cache = None
+
+def SplitReference(vsref):
+    """Canonical references may carry a version as url|version"""
+    if "|" in vsref:
+        reference, version = vsref.split("|", 1)
+        return reference, version
+    return vsref, ""
+
+def CacheReference(reference, client):
+    """Relative references (ValueSet/id) only mean something on the server """
+    """they came from, so they are cached under the server's URL"""
+    if "://" in reference:
+        return reference
+    return f"{getattr(client, 'target_service_url', '')}/{reference}"
+
+def ValueSetVersion(reference, client):
+    """The server's version of the ValueSet, as versionId=n (or """
+    """lastUpdated=...), or None if it can't be found"""
+    query = reference
+    if "://" in reference:
+        query = f"ValueSet?url={reference}"
+
+    result = client.get(query, recurse=False)
+    if not result.success() or len(result.entries) == 0:
+        return None
+
+    # Searches return Bundle entries and reads the ValueSet itself
+    valueset = result.entries[0].get('resource', result.entries[0])
+    meta = valueset.get('meta', {})
+    for element in ["versionId", "lastUpdated"]:
+        if element in meta:
+            return f"{element}={meta[element]}"
+    return None
+
+class TerminologyCache:
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = Path(cache_dir)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        # (reference, version) => list of codings in the expansion
+        self.expansions = {}
+
+        # reference => the server's version of the ValueSet (ValueSetVersion)
+        # for references which carry no version of their own
+        self.server_versions = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def filename(self, reference, version):
+        key = sha1(f"{reference}|{version}".encode()).hexdigest()
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, reference, version="", persist=True):
+        key = (reference, version)
+        with self.lock:
+            if key in self.expansions:
+                self.hits += 1
+                return self.expansions[key]
+
+        if self.cache_dir is not None and persist:
+            filename = self.filename(reference, version)
+            try:
+                with filename.open('rt') as inf:
+                    contains = json.load(inf)['contains']
+                # Touch it so that eviction knows it is still in use
+                os.utime(filename)
+            except (OSError, ValueError, KeyError):
+                contains = None
+
+            if contains is not None:
+                with self.lock:
+                    self.hits += 1
+                    self.expansions[key] = contains
+                return contains
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, reference, version, contains, persist=True):
+        with self.lock:
+            self.expansions[(reference, version)] = contains
+
+        if self.cache_dir is not None and persist:
+            filename = self.filename(reference, version)
+
+            # Write to a temporary file and rename it into place so that other
+            # processes sharing the cache never see a partial expansion
+            tmpname = filename.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with tmpname.open('wt') as outf:
+                json.dump({
+                    "reference": reference,
+                    "version": version,
+                    "contains": contains
+                }, outf)
+            os.replace(tmpname, filename)
+
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used expansions until the cache fits """
+        """within max_bytes"""
+        entries = []
+        total = 0
+        for filename in self.cache_dir.glob("*.json"):
+            try:
+                stat = filename.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                filename.unlink()
+            except OSError:
+                pass
+            total -= size
+
+def InitTerminologyCache(cache_dir=None, max_bytes=DEFAULT_CACHE_SIZE):
+    global _cache
+    _cache = TerminologyCache(cache_dir, max_bytes)
+    return _cache
+
+def GetTerminologyCache():
+    global _cache
+    if _cache is None:
+        _cache = TerminologyCache()
+    return _cache
+
+def ExpandValueSet(vsref, client=None):
+    """Return the codings from the ValueSet's expansion, or None if it """
+    """couldn't be expanded"""
+    cache = GetTerminologyCache()
+    reference, version = SplitReference(vsref)
+    if client is None:
+        client = GetInputClient()
+
+    cached_reference = CacheReference(reference, client)
+    cached_version = version
+    persist = True
+    if version == "" and cache.cache_dir is not None:
+        if cached_reference not in cache.server_versions:
+            cache.server_versions[cached_reference] = ValueSetVersion(reference, client)
+        cached_version = cache.server_versions[cached_reference]
+        if cached_version is None:
+            cached_version = ""
+            persist = False
+
+    contains = cache.get(cached_reference, cached_version, persist)
+    if contains is not None:
+        return contains
+
+    query = f"{reference}/$expand"
+    if version != "":
+        query = f"ValueSet/$expand?url={reference}&valueSetVersion={version}"
+
+    result = client.get(query)
+    if not result.success():
+        return None
+
+    contains = result.entries[0]['expansion'].get('contains', [])
+    cache.put(cached_reference, cached_version, contains, persist)
+    return contains
+
+def ReferencedValueSets(observation_definitions):
+    vsrefs = set()
+    for obsdef in observation_definitions:
+        if 'validCodedValueSet' in obsdef:
+            vsrefs.add(obsdef['validCodedValueSet']['reference'])
+    return sorted(vsrefs)
+
+def PrefetchValueSets(observation_definitions, workers=8, client=None):
+    """Expand every distinct ValueSet referenced by the definitions """
+    """concurrently so that the parsers find them waiting in the cache. """
+    """Returns the number of ValueSets"""
+    if client is None:
+        client = GetInputClient()
+
+    vsrefs = ReferencedValueSets(observation_definitions)
+    if len(vsrefs) == 0:
+        return 0
+
+    cache = GetTerminologyCache()
+    misses = cache.misses
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda vsref: ExpandValueSet(vsref, client), vsrefs))
+
+    print(f"{len(vsrefs)} ValueSets prefetched ({cache.misses - misses} expanded)")
+    return len(vsrefs)
@@ -12,6 +12,10 @@ DISTINCT = BuildCoding('C3641802', "Distinct Product Count", NCIT)
 SUM = BuildCoding("C25697", "Sum", NCIT)
 MEAN = BuildCoding("C0444504", "Statistical Mean", NCIT)
 RANGE = BuildCoding("C2348147", "Sample Range", NCIT)
+STD_DEV = BuildCoding("C53322", "Standard Deviation", NCIT)
+MINIMUM = BuildCoding("C25564", "Minimum", NCIT)
+MAXIMUM = BuildCoding("C25565", "Maximum", NCIT)
+MEDIAN = BuildCoding("C28007", "Median", NCIT)
 SUMMARY_REPORT = BuildCoding("C0242482", "Summary Report", NCIT)
 GENDER = BuildCoding("C0079399", "Gender", NCIT)
 MISSING = BuildCoding("C142610", "Missing Data", NCIT)
@@ -0,0 +1,263 @@
+"""
+Load the summary Observations into the output server.
+
+Summaries can be loaded one at a time (a conditional POST per Observation, or
+a conditional PUT for those which may already be on the server) or packed into
+FHIR batch/transaction Bundles. Bundled summaries use a
+conditional PUT on the summary's identifier, so reloading a study updates the
+existing summaries rather than creating duplicates.
+
+Before loading, the study's summaries already on the server can be pulled in
+one search (see ExistingSummaries) so that those whose content hasn't changed
+aren't written again, which would only add another version to their history.
+"""
+
+from summfhir import GetOutputClient
+from summfhir.terms import SUMMARY_REPORT
+from summfhir.fetch import StreamResources, IncompleteSearch
+from urllib.parse import quote
+from hashlib import sha256
+import json
+from time import sleep
+from pprint import pformat
+
+UPLOAD_MODES = ["single", "batch", "transaction"]
+
+# These are worth trying again. Anything else is probably a problem with the
+# summary itself and resubmitting it won't change the outcome
+RETRYABLE_STATUS = set([408, 409, 412, 429, 500, 502, 503, 504])
+
+def SummaryIdentifier(summary):
+    identifier = summary['identifier'][0]
+    return identifier['system'], identifier['value']
+
+def SummaryHash(summary):
+    """Hash of the summary's content, which doesn't depend on key order"""
+    content = json.dumps(summary, sort_keys=True, separators=(',', ':'))
+    return sha256(content.encode()).hexdigest()
+
+# Elements the server manages, which aren't part of a summary's content
+SERVER_ELEMENTS = set(["id", "meta", "text"])
+
+def Canonical(value):
+    """The value as the server would return it: without empty elements, """
+    """which FHIR doesn't allow, and with whole decimals as integers"""
+    if type(value) is dict:
+        value = dict([(k, Canonical(v)) for k, v in value.items()])
+        return dict([(k, v) for k, v in value.items() if v not in (None, "", [], {})])
+    if type(value) is list:
+        return [x for x in [Canonical(v) for v in value] if x not in (None, "", [], {})]
+    if type(value) is float and value.is_integer():
+        return int(value)
+    return value
+
+def ContentHash(summary):
+    """Hash of what the summary says, so that the copy on the server can be """
+    """compared with a freshly built one"""
+    return SummaryHash(Canonical(dict([(k, v) for k, v in summary.items() 
+                                        if k not in SERVER_ELEMENTS])))
+
+def ExistingSummaries(meta_tag, client=None):
+    """The content hash of each of the study's summaries on the server, by """
+    """identifier (system|value). Identifiers found more than once map to """
+    """None, since they'll need updating regardless. Returns None if the """
+    """summaries couldn't be retrieved"""
+    if client is None:
+        client = GetOutputClient()
+
+    existing = {}
+    query = f"Observation?_tag={meta_tag}&code={SUMMARY_REPORT.system}|{SUMMARY_REPORT.code}"
+    try:
+        for summary in StreamResources(query, client):
+            try:
+                system, value = SummaryIdentifier(summary)
+            except (KeyError, IndexError):
+                continue
+            key = f"{system}|{value}"
+            if key in existing:
+                existing[key] = None
+            else:
+                existing[key] = ContentHash(summary)
+    except IncompleteSearch as e:
+        print(f"Unable to retrieve the existing summaries ({e}). Loading them all.")
+        return None
+    return existing
+
+def EntryStatus(entry_response):
+    """FHIR reports entry status as a string such as '201 Created'"""
+    try:
+        return int(str(entry_response['status']).split(" ")[0])
+    except:
+        return 500
+
+def BuildUploader(mode="single", batch_size=250, client=None):
+    if mode == "single":
+        return SingleUploader(client=client)
+    return BundleUploader(bundle_type=mode, batch_size=batch_size, client=client)
+
+def ConditionalUrl(system, value):
+    return f"Observation?identifier={quote(system, safe='')}|{quote(value, safe='')}"
+
+class SingleUploader:
+    """POST each summary individually, using the identifier to avoid """
+    """duplicating summaries which are already present. Summaries added """
+    """with update set replace the copy on the server with a conditional PUT"""
+    def __init__(self, client=None, retry_count=5, retry_delay=5):
+        if client is None:
+            client = GetOutputClient()
+        self.client = client
+        self.retry_count = retry_count
+        self.retry_delay = retry_delay
+
+        self.loaded = 0
+        self.failed = 0
+
+    def add(self, summary, update=False):
+        try:
+            system, value = SummaryIdentifier(summary)
+        except (KeyError, IndexError):
+            print(f"Skipping a summary with a malformed identifier: {pformat(summary.get('identifier'))}")
+            self.failed += 1
+            return
+        identifier_type = "identifier"
+
+        retry_count = self.retry_count
+        while retry_count > 0:
+            retry_count -= 1
+            if update:
+                result = self.client.put(ConditionalUrl(system, value), summary)
+            else:
+                result = self.client.post('Observation',
+                            summary,
+                            identifier=value,
+                            identifier_system=system,
+                            identifier_type=identifier_type)
+            if result['status_code'] < 300:
+                self.loaded += 1
+                return
+
+            print(pformat(result))
+            print(f"\t{result['status_code']} : {result['request_url']}")
+            if retry_count > 0:
+                sleep(self.retry_delay)
+
+        print("\tToo many retries. Giving up on this one. ")
+        self.failed += 1
+
+    def flush(self):
+        pass
+
+    def report(self):
+        return f"{self.loaded} summaries loaded, {self.failed} failed"
+
+class BundleUploader:
+    """Pack summaries into batch or transaction Bundles of batch_size """
+    """entries, resubmitting only those entries which failed"""
+    def __init__(self,
+                bundle_type="batch",
+                batch_size=250,
+                client=None,
+                retry_count=5,
+                retry_delay=2):
+        if client is None:
+            client = GetOutputClient()
+        self.client = client
+
+        assert bundle_type in ["batch", "transaction"], f"Unknown bundle type, {bundle_type}"
+        self.bundle_type = bundle_type
+        self.batch_size = batch_size
+        self.retry_count = retry_count
+
+        # Delay before the first resubmission. This doubles with each retry
+        self.retry_delay = retry_delay
+
+        self.pending = []
+        self.loaded = 0
+        self.failed = 0
+
+    def add(self, summary, update=True):
+        """Bundled summaries are always PUT, so update makes no difference"""
+        try:
+            system, value = SummaryIdentifier(summary)
+        except (KeyError, IndexError):
+            print(f"Skipping a summary with a malformed identifier: {pformat(summary.get('identifier'))}")
+            self.failed += 1
+            return
+
+        self.pending.append({
+            "resource": summary,
+            "request": {
+                "method": "PUT",
+                "url": ConditionalUrl(system, value)
+            }
+        })
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        entries = self.pending
+        self.pending = []
+
+        delay = self.retry_delay
+        attempt = 0
+        while len(entries) > 0:
+            entries, rejected = self.submit(entries)
+            self.failed += rejected
+
+            if len(entries) > 0:
+                attempt += 1
+                if attempt >= self.retry_count:
+                    print(f"\tToo many retries. Giving up on {len(entries)} summaries.")
+                    self.failed += len(entries)
+                    return
+
+                print(f"\tResubmitting {len(entries)} summaries in {delay}s")
+                sleep(delay)
+                delay *= 2
+
+    def submit(self, entries):
+        """Send a single bundle, returning the entries worth resubmitting """
+        """and the number that failed outright"""
+        bundle = {
+            "resourceType": "Bundle",
+            "type": self.bundle_type,
+            "entry": entries
+        }
+
+        result = self.client.post("", bundle)
+        status_code = result['status_code']
+        response = result.get('response')
+
+        responses = []
+        if type(response) is dict:
+            responses = response.get('entry', [])
+
+        # A transaction is all or nothing, and a batch whose response we
+        # can't line up with what we sent tells us nothing about the entries
+        if status_code >= 300 or len(responses) != len(entries):
+            print(f"\t{status_code} : {result.get('request_url')}")
+            if status_code < 300 or status_code in RETRYABLE_STATUS:
+                return entries, 0
+            print(pformat(response))
+            return [], len(entries)
+
+        retry = []
+        rejected = 0
+        for entry, entry_response in zip(entries, responses):
+            entry_status = EntryStatus(entry_response.get('response', {}))
+            if entry_status < 300:
+                self.loaded += 1
+            elif entry_status in RETRYABLE_STATUS:
+                retry.append(entry)
+            else:
+                rejected += 1
+                print(f"\t{entry_status} : {entry['request']['url']}")
+                outcome = entry_response['response'].get('outcome')
+                if outcome is not None:
+                    print(pformat(outcome))
+
+        return retry, rejected
+
+    def report(self):
+        return f"{self.loaded} summaries loaded, {self.failed} failed"
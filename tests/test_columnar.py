@@ -0,0 +1,167 @@
+"""
+The columnar engine must leave the parsers exactly as the row at a time path
+would, whatever the values: the sums down to the last bit and every value in
+the same quantile sketch bucket.
+"""
+
+from fractions import Fraction
+import json
+import math
+import random
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from summfhir import SetInputClient
+from summfhir.ndjson_client import NdjsonClient
+from summfhir.columnar import ExactPartials, SketchKeys, QuantityColumn, UseColumnar
+from summfhir.stats import ExactSum, Moments, QuantileSketch
+from summfhir.study import StudySummary
+from summfhir.synthetic import SyntheticStudy
+
+SUBNORMAL = 5e-324
+
+def Exact(values):
+    return sum([Fraction(x) for x in values], Fraction(0))
+
+def AssertExact(values):
+    partials = ExactPartials(np.array(values, dtype=np.float64))
+    assert Exact(partials) == Exact(values)
+
+    # Added to an ExactSum, they come to what adding the values one by one would
+    columnar = ExactSum()
+    columnar.add_many(partials)
+    rows = ExactSum()
+    rows.add_many(values)
+    assert columnar.value() == rows.value() == math.fsum(values)
+
+def test_exact_partials_empty():
+    assert ExactPartials(np.array([], dtype=np.float64)) == []
+
+def test_exact_partials_zeros():
+    assert ExactPartials(np.array([0.0, -0.0, 0.0])) == []
+    AssertExact([0.0, -0.0, 1.5, -0.0])
+
+def test_exact_partials_subnormals():
+    AssertExact([SUBNORMAL] * 1000)
+    AssertExact([SUBNORMAL, sys.float_info.min, -SUBNORMAL * 3, 2.5e-310])
+    AssertExact([SUBNORMAL, 1.0, -1.0])
+
+def test_exact_partials_huge_exponents():
+    AssertExact([1e308, -1e308, 1e-308, SUBNORMAL])
+    AssertExact([sys.float_info.max, -sys.float_info.max / 2, 1.0])
+    AssertExact([1e300, 1.0, -1e300, 1e-300])
+
+def test_exact_partials_mixed_signs():
+    rnd = random.Random(1)
+    values = [rnd.uniform(-1, 1) * 10 ** rnd.randint(-30, 30) for i in range(5000)]
+    AssertExact(values)
+
+    # Everything cancels but the smallest
+    AssertExact(values + [-x for x in values] + [1e-40])
+
+def test_exact_partials_many():
+    # Enough to overflow the halves if they weren't split
+    AssertExact([(1 << 53) - 1.0] * 100000)
+
+def AssertSameKeys(sketch, values):
+    keys = SketchKeys(sketch, np.array(values, dtype=np.float64))
+    assert keys.tolist() == [sketch.key(x) for x in values]
+
+def test_sketch_keys_on_bucket_boundaries():
+    sketch = QuantileSketch(0.01)
+    boundaries = [sketch.gamma ** k for k in range(-400, 400, 7)]
+    neighbours = [math.nextafter(x, 0) for x in boundaries] + \
+                    [math.nextafter(x, math.inf) for x in boundaries]
+    AssertSameKeys(sketch, boundaries + neighbours)
+
+def test_sketch_keys_extremes():
+    for accuracy in [0.001, 0.01, 0.05]:
+        sketch = QuantileSketch(accuracy)
+        AssertSameKeys(sketch, [SUBNORMAL, sys.float_info.min, 1.0,
+                                math.nextafter(1.0, 2), sys.float_info.max])
+
+def test_sketch_keys_random():
+    rnd = random.Random(2)
+    sketch = QuantileSketch(0.01)
+    AssertSameKeys(sketch, [rnd.lognormvariate(0, 5) for i in range(20000)])
+
+class QuantityParser:
+    """Just the parts of a quantity parser that QuantityColumn fills in"""
+    def __init__(self):
+        self.count = 0
+        self.moments = Moments()
+        self.quantiles = QuantileSketch()
+
+    def add(self, x):
+        self.count += 1
+        self.moments.add(x)
+        self.quantiles.add(x)
+
+    def state(self):
+        sketch = self.quantiles
+        return (self.count, self.moments.count, repr(self.moments.sum.value()),
+                repr(self.moments.squares.value()), sketch.positive, sketch.negative, 
+                sketch.zeros, repr(sketch.min), repr(sketch.max))
+
+def AssertSameParsers(values):
+    column = QuantityColumn()
+    for x in values:
+        column.append({"valueQuantity": {"value": x}})
+    columnar = QuantityParser()
+    column.apply([columnar])
+
+    rows = QuantityParser()
+    for x in values:
+        rows.add(x)
+    assert columnar.state() == rows.state()
+
+def test_quantity_column_matches_rows():
+    rnd = random.Random(3)
+    AssertSameParsers([rnd.gauss(70, 15) for i in range(1000)])
+    AssertSameParsers([0.0, -0.0, SUBNORMAL, -SUBNORMAL, 7, -3, sys.float_info.min])
+    AssertSameParsers([-0.0, 0.0, 2, 1e-300])
+
+def test_quantity_column_squares_overflow():
+    # Squares too large for a double come out as they do a row at a time
+    AssertSameParsers([1e300, 2.0, -1e200])
+    AssertSameParsers([1e300, -1e300, sys.float_info.max])
+
+def WriteResources(directory, resources):
+    directory.mkdir(parents=True, exist_ok=True)
+    for resource_type, items in resources.items():
+        with (directory / f"{resource_type}.ndjson").open('wt') as outf:
+            for resource in items:
+                outf.write(json.dumps(resource) + "\n")
+
+def Summarize(input_dir, columnar):
+    UseColumnar(columnar)
+    try:
+        client = NdjsonClient(input_dir)
+        SetInputClient(client)
+        research_study = client.get("ResearchStudy?_tag=SYNTH").entries[0]['resource']
+        study = StudySummary(research_study)
+        study.summarize_source()
+        summaries = dict([(population.id, population.return_summaries())
+                            for population in study.enrollment])
+    finally:
+        UseColumnar(False)
+    return json.dumps(summaries, sort_keys=True)
+
+def test_columnar_matches_rows(tmp_path):
+    study = SyntheticStudy(patients=200, condition_codes=5, tables=2, variables=6)
+    resources = dict([(resource_type, list(generated))
+                        for resource_type, generated in study.resources().items()])
+
+    # Awkward quantities, mixed in with the synthetic ones
+    awkward = [0.0, -0.0, SUBNORMAL, -SUBNORMAL, 1e300, -1e300,
+                sys.float_info.min, 7, -3, QuantileSketch().gamma ** 5]
+    quantities = [component for row in resources['Observation']
+                    for component in row['component'] if 'valueQuantity' in component]
+    for component, value in zip(quantities[::3], awkward * len(quantities)):
+        component['valueQuantity']['value'] = value
+    WriteResources(tmp_path, resources)
+
+    assert Summarize(tmp_path, True) == Summarize(tmp_path, False)
@@ -0,0 +1,205 @@
+from urllib.parse import urlparse, parse_qs
+import random
+import threading
+import time
+
+import pytest
+
+from summfhir.fetch import (Prefetch, PartitionedPages, IncompleteSearch, OffsetRanges, 
+                            PageSizer, ProjectionStats, PayloadSize)
+
+class Result:
+    def __init__(self, response, status_code=200):
+        self.response = response
+        self.status_code = status_code
+        self.entries = response.get('entry', [])
+
+    def success(self):
+        return self.status_code < 300
+
+class PagedClient:
+    """Serves total Patients a page at a time, with next links that page """
+    """by offset (as HAPI's do). The server hands out no more than limit """
+    """resources per page, however many are asked for, fails the page at """
+    """fail_at and takes up to delay seconds over each"""
+    def __init__(self, total, page_size=10, limit=None, fail_at=None, delay=None):
+        self.total = total
+        self.page_size = page_size
+        self.limit = limit
+        self.fail_at = fail_at
+        self.delay = delay
+        self.rnd = random.Random(1)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get(self, query, recurse=False):
+        with self.lock:
+            self.requests.append(query)
+            pause = self.rnd.uniform(0, self.delay) if self.delay else 0
+        time.sleep(pause)
+
+        params = parse_qs(urlparse(query).query)
+        offset = int(params.get('_getpagesoffset', ["0"])[0])
+        count = int(params.get('_count', [str(self.page_size)])[0])
+        if self.limit is not None:
+            count = min(count, self.limit)
+
+        if offset == self.fail_at:
+            return Result({"resourceType": "OperationOutcome"}, 500)
+
+        end = min(offset + count, self.total)
+        bundle = {
+            "resourceType": "Bundle",
+            "total": self.total,
+            "entry": [{"resource": {"resourceType": "Patient", "id": f"p{i}"}} 
+                        for i in range(offset, end)]
+        }
+        if end < self.total:
+            bundle['link'] = [{
+                "relation": "next",
+                "url": f"http://fhir.test/fhir?_getpages=x&_getpagesoffset={end}&_count={count}"
+            }]
+        return Result(bundle)
+
+def Ids(pages):
+    return [entry['resource']['id'] for entries in pages for entry in entries]
+
+def Counted(limit=None, fail_after=None, closed=None):
+    """Yields 0, 1, ... (up to limit), raising ValueError after fail_after """
+    """of them and setting closed once finished, however that happens"""
+    try:
+        i = 0
+        while limit is None or i < limit:
+            if i == fail_after:
+                raise ValueError(f"failed after {i}")
+            yield i
+            i += 1
+    finally:
+        if closed is not None:
+            closed.set()
+
+def test_prefetch_keeps_order():
+    assert list(Prefetch(Counted(50), depth=2)) == list(range(50))
+    assert list(Prefetch(Counted(5), depth=0)) == list(range(5))
+
+def test_prefetch_raises_where_the_error_happened():
+    received = []
+    with pytest.raises(ValueError, match="failed after 7"):
+        for item in Prefetch(Counted(fail_after=7), depth=3):
+            received.append(item)
+    assert received == list(range(7))
+
+def test_prefetch_stops_when_closed_early():
+    closed = threading.Event()
+    pages = Prefetch(Counted(closed=closed), depth=2)
+    assert [next(pages) for i in range(3)] == [0, 1, 2]
+
+    pages.close()
+    assert closed.wait(5), "the producing generator was never closed"
+
+def test_failed_page_raises():
+    client = PagedClient(100, fail_at=30)
+    received = []
+    with pytest.raises(IncompleteSearch):
+        for entries in PartitionedPages("Patient?_tag=x", client, partitions=1):
+            received += Ids([entries])
+    assert received == [f"p{i}" for i in range(30)]
+
+def test_failed_first_page_raises():
+    # An empty answer would look complete, as if every resource were gone
+    client = PagedClient(100, fail_at=0)
+    with pytest.raises(IncompleteSearch):
+        list(PartitionedPages("Patient?_tag=x", client, partitions=1))
+
+def Drain(ranges, serve):
+    """Take and release every range, serving serve(start, count) of each. """
+    """Returns the offsets served, in order"""
+    stop = threading.Event()
+    served = []
+    while True:
+        taken = ranges.take(stop)
+        if taken is None:
+            return served
+        start, count = taken
+        assert count > 0
+        served_count = serve(start, count)
+        served += range(start, start + served_count)
+        ranges.release(start, count, served_count)
+
+def test_offset_ranges_cover_everything_once():
+    ranges = OffsetRanges(10, 500, PageSizer(40, minimum=1, maximum=40), 4)
+    assert Drain(ranges, lambda start, count: count) == list(range(10, 500))
+
+def test_offset_ranges_refill_gaps():
+    # The server serves a random part of each range
+    rnd = random.Random(1)
+    ranges = OffsetRanges(10, 500, PageSizer(40, minimum=1, maximum=40), 4)
+    served = Drain(ranges, lambda start, count: rnd.randint(1, count))
+    assert sorted(served) == list(range(10, 500))
+
+def test_offset_ranges_wait_for_outstanding():
+    ranges = OffsetRanges(0, 10, PageSizer(10, minimum=1), 1)
+    stop = threading.Event()
+    assert ranges.take(stop) == (0, 10)
+
+    # Nothing is left to hand out, but the range taken may leave a gap
+    taken = []
+    waiting = threading.Thread(target=lambda: taken.append(ranges.take(stop)))
+    waiting.start()
+    waiting.join(0.3)
+    assert waiting.is_alive()
+
+    ranges.release(0, 10, 4)
+    waiting.join(5)
+    assert taken == [(4, 6)]
+
+    ranges.release(4, 6, 6)
+    assert ranges.take(stop) is None
+
+def test_offset_ranges_stay_ahead_of_delivery():
+    ranges = OffsetRanges(0, 100, PageSizer(10, minimum=10, maximum=10), 1, ahead=2)
+    stop = threading.Event()
+    assert ranges.take(stop) == (0, 10)
+    assert ranges.take(stop) == (10, 10)
+
+    taken = []
+    waiting = threading.Thread(target=lambda: taken.append(ranges.take(stop)))
+    waiting.start()
+    waiting.join(0.3)
+    assert waiting.is_alive()
+
+    ranges.deliver(10)
+    waiting.join(5)
+    assert taken == [(20, 10)]
+
+def test_partitioned_pages_with_short_pages():
+    # The server serves no more than 7 per page, whatever _count says
+    client = PagedClient(500, page_size=10, limit=7)
+    ids = Ids(PartitionedPages("Patient?_tag=x", client, partitions=3))
+    assert ids == [f"p{i}" for i in range(500)]
+
+def test_partitioned_pages_arrive_in_offset_order():
+    # Pages finish in random order, but are delivered as a serial search would
+    client = PagedClient(300, page_size=10, limit=7, delay=0.01)
+    ids = Ids(PartitionedPages("Patient?_tag=x", client, partitions=4))
+    assert ids == [f"p{i}" for i in range(300)]
+
+def test_partitioned_failed_page_raises():
+    # The first page ends at 7, where the ranges start
+    client = PagedClient(500, page_size=10, limit=7, fail_at=7)
+    with pytest.raises(IncompleteSearch):
+        Ids(PartitionedPages("Patient?_tag=x", client, partitions=3))
+
+def test_projection_stats_measure_a_sample_of_pages():
+    client = PagedClient(400, page_size=10)
+    stats = ProjectionStats("Patient?_tag=x", "id")
+    full = 0
+    for offset in range(0, 400, 10):
+        result = client.get(f"Patient?_tag=x&_getpagesoffset={offset}")
+        stats.record_page(result.response, result.entries)
+        full += PayloadSize(result.response)
+
+    # Pages 0, 16 and 32 are measured and the rest estimated from them
+    assert stats.measured_resources == 30
+    assert stats.resources == 400
+    assert abs(stats.bytes - full) < full * 0.01
@@ -0,0 +1,148 @@
+"""
+An incremental run retracts whatever a changed resource contributed and adds
+it again, which must leave the summaries just as a full run over the same
+resources would.
+"""
+
+import json
+
+import pytest
+
+from summfhir import SetInputClient
+from summfhir.ndjson_client import NdjsonClient, NdjsonResult, OperationOutcome
+from summfhir.fetch import IncompleteSearch
+from summfhir.study import StudySummary
+from summfhir.incremental import SummarizeIncremental, SaveStudyState
+from summfhir.synthetic import SyntheticStudy
+
+EARLIER = "2020-01-01T00:00:00Z"
+LATER = "2099-01-01T00:00:00Z"
+
+def BuildResources():
+    study = SyntheticStudy(patients=80, condition_codes=20, tables=2, variables=6)
+    resources = dict([(resource_type, list(generated)) 
+                        for resource_type, generated in study.resources().items()])
+    for resource_type in resources:
+        for resource in resources[resource_type]:
+            resource['meta']['lastUpdated'] = EARLIER
+    return study, resources
+
+def WriteResources(directory, resources):
+    directory.mkdir(parents=True, exist_ok=True)
+    for resource_type, items in resources.items():
+        with (directory / f"{resource_type}.ndjson").open('wt') as outf:
+            for resource in items:
+                outf.write(json.dumps(resource) + "\n")
+
+class FailingClient:
+    """Reads the NDJSON a page at a time, as a server would, failing any """
+    """search that starts with one of failing"""
+    def __init__(self, client, failing):
+        self.client = client
+        self.failing = failing
+
+    @property
+    def target_service_url(self):
+        return self.client.target_service_url
+
+    def get(self, query, *args, **kwargs):
+        if any(query.startswith(prefix) for prefix in self.failing):
+            return NdjsonResult(OperationOutcome("Unavailable"), 503, query)
+        return self.client.get(query, *args, **kwargs)
+
+def Summarize(input_dir, tag, state_dir=None, outdir=None, failing=None):
+    client = NdjsonClient(input_dir)
+    if failing is not None:
+        client = FailingClient(client, failing)
+    SetInputClient(client)
+    research_study = client.get(f"ResearchStudy?_tag={tag}").entries[0]['resource']
+    study = StudySummary(research_study)
+
+    if state_dir is None:
+        study.summarize_patients()
+        study.summarize_conditions()
+        study.summarize_source()
+    else:
+        summarized = SummarizeIncremental(study, state_dir)
+
+    summaries = dict([(population.id, population.return_summaries()) 
+                        for population in study.enrollment])
+
+    if state_dir is not None:
+        study.load_observations(outdir=outdir, upload=False)
+        SaveStudyState(state_dir, study, summarized)
+    return json.loads(json.dumps(summaries, sort_keys=True))
+
+def Touch(resource):
+    resource['meta'] = dict(resource['meta'], lastUpdated=LATER)
+
+def test_changed_resources_match_a_full_run(tmp_path):
+    study, resources = BuildResources()
+    state_dir = tmp_path / "state"
+    outdir = tmp_path / "output"
+
+    WriteResources(tmp_path / "before", resources)
+    before = Summarize(tmp_path / "before", study.tag, state_dir, outdir)
+
+    for patient in resources['Patient'][0:10]:
+        patient['gender'] = "other" if patient.get('gender') != "other" else "female"
+        Touch(patient)
+    for condition in resources['Condition'][0:15]:
+        condition['verificationStatus']['coding'][0]['code'] = "confirmed"
+        Touch(condition)
+    for row in resources['Observation'][0:20]:
+        for component in row['component']:
+            if 'valueString' in component:
+                component['valueString'] = "changed"
+        Touch(row)
+
+    WriteResources(tmp_path / "after", resources)
+    incremental = Summarize(tmp_path / "after", study.tag, state_dir, outdir)
+    full = Summarize(tmp_path / "after", study.tag)
+
+    assert incremental != before
+    assert incremental == full
+
+def test_removed_resources_match_a_full_run(tmp_path):
+    study, resources = BuildResources()
+    state_dir = tmp_path / "state"
+    outdir = tmp_path / "output"
+
+    WriteResources(tmp_path / "before", resources)
+    before = Summarize(tmp_path / "before", study.tag, state_dir, outdir)
+
+    # Some conditions are deleted and others are no longer tagged for the study
+    del resources['Condition'][0:10]
+    for condition in resources['Condition'][0:10]:
+        condition['meta'] = {
+            "tag": [{"system": study.tag_system, "code": "OTHER"}],
+            "lastUpdated": LATER
+        }
+
+    WriteResources(tmp_path / "after", resources)
+    incremental = Summarize(tmp_path / "after", study.tag, state_dir, outdir)
+    full = Summarize(tmp_path / "after", study.tag)
+
+    assert incremental != before
+    assert incremental == full
+
+def test_failed_search_leaves_the_state(tmp_path):
+    study, resources = BuildResources()
+    state_dir = tmp_path / "state"
+    outdir = tmp_path / "output"
+
+    WriteResources(tmp_path / "before", resources)
+    Summarize(tmp_path / "before", study.tag, state_dir, outdir)
+    saved = dict([(path.name, path.read_bytes()) for path in state_dir.iterdir()])
+
+    del resources['Condition'][0:10]
+    WriteResources(tmp_path / "after", resources)
+
+    # The search for the study's conditions, which decides what has gone
+    with pytest.raises(IncompleteSearch):
+        Summarize(tmp_path / "after", study.tag, state_dir, outdir, 
+                    failing=[f"Condition?_tag={study.tag}&_elements"])
+    assert dict([(path.name, path.read_bytes()) for path in state_dir.iterdir()]) == saved
+
+    incremental = Summarize(tmp_path / "after", study.tag, state_dir, outdir)
+    assert incremental == Summarize(tmp_path / "after", study.tag)
@@ -0,0 +1,157 @@
+"""
+CountMatrix must behave like the defaultdict of defaultdict(int) it replaced,
+however counts come and go, and interned concepts must only be shared within
+a study.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import pickle
+import random
+
+from summfhir.interning import CountMatrix, ResetInterning
+from summfhir import interning
+from summfhir.condition import Condition
+from summfhir.summary import ChooseCode
+from summfhir import summary
+
+def AsDict(matrix):
+    return dict([(domain, dict(row.items())) for domain, row in matrix.items()])
+
+def Reference(counts):
+    """What the matrix should hold: everything with a count that isn't zero"""
+    return dict([(domain, dict([(value, count) for value, count in row.items() if count != 0]))
+                    for domain, row in counts.items() if any(row.values())])
+
+def test_counts_match_nested_dicts():
+    rnd = random.Random(1)
+    matrix = CountMatrix()
+    counts = defaultdict(lambda: defaultdict(int))
+    for i in range(5000):
+        domain = f"code-{rnd.randint(0, 40)}"
+        value = rnd.choice(["confirmed", "refuted", "unconfirmed"])
+        change = rnd.choice([1, 1, 1, -1])
+        if counts[domain][value] + change < 0:
+            continue
+        matrix[domain][value] += change
+        counts[domain][value] += change
+    assert AsDict(matrix) == Reference(counts)
+    assert len(matrix) == len(Reference(counts))
+
+def test_retract_to_zero():
+    matrix = CountMatrix()
+    matrix["a"]["confirmed"] += 2
+    matrix["a"]["refuted"] += 1
+    matrix["b"]["confirmed"] += 1
+
+    matrix["a"]["confirmed"] -= 2
+    row = matrix["a"]
+    assert "confirmed" not in row
+    assert row["confirmed"] == 0
+    assert row.get("confirmed") is None
+    assert row.keys() == ["refuted"]
+    assert len(row) == 1
+
+    # A domain without counts is gone, though its position is kept
+    matrix["a"]["refuted"] -= 1
+    assert "a" not in matrix
+    assert matrix.keys() == ["b"]
+    assert len(matrix) == 1
+    matrix["a"]["refuted"] += 3
+    assert AsDict(matrix) == {"a": {"refuted": 3}, "b": {"confirmed": 1}}
+
+    del matrix["b"]
+    del matrix["a"]["refuted"]
+    assert len(matrix) == 0
+    assert AsDict(matrix) == {}
+
+    # Looking a count up doesn't create anything
+    assert matrix["never"]["seen"] == 0
+    assert "never" not in matrix
+    assert len(matrix) == 0
+
+def test_pickle():
+    matrix = CountMatrix()
+    for i in range(100):
+        matrix[f"code-{i % 7}"][f"value-{i % 3}"] += i
+    matrix["code-1"]["value-1"] = 0
+
+    restored = pickle.loads(pickle.dumps(matrix))
+    assert AsDict(restored) == AsDict(matrix)
+
+    restored["code-1"]["value-1"] += 1
+    assert restored["code-1"]["value-1"] == 1
+    assert len(restored["code-1"]) == len(matrix["code-1"]) + 1
+
+def CountInWorker(matrix):
+    matrix["code-x"]["confirmed"] += 1
+    matrix["code-0"]["confirmed"] -= matrix["code-0"]["confirmed"]
+    return matrix
+
+def BuildConditions(resources):
+    condition = Condition()
+    for resource in resources:
+        condition.add_resource(resource)
+    return condition
+
+def ConditionResource(code, display, verstat="confirmed"):
+    return {
+        "resourceType": "Condition",
+        "identifier": [{"system": "https://example.org/fhir/condition", "value": "c"}],
+        "verificationStatus": {"coding": [{"code": verstat}]},
+        "code": {"coding": [{"system": "http://purl.obolibrary.org/obo/hp.owl",
+                                "code": code, "display": display}]}
+    }
+
+def test_pickle_across_processes():
+    matrix = CountMatrix()
+    for i in range(10):
+        matrix[f"code-{i}"]["confirmed"] += i + 1
+
+    resources = [ConditionResource(f"HP:{i % 13:04}", f"Phenotype {i % 13}") for i in range(100)]
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        counted = executor.submit(CountInWorker, matrix).result()
+        built = executor.submit(BuildConditions, resources).result()
+
+    expected = AsDict(matrix)
+    del expected["code-0"]
+    expected["code-x"] = {"confirmed": 1}
+    assert AsDict(counted) == expected
+
+    # Condition summaries built elsewhere merge as if they'd been built here
+    local = BuildConditions(resources)
+    merged = Condition()
+    merged.merge(built)
+    assert AsDict(merged.counts) == AsDict(local.counts)
+    assert merged.observed_codes == local.observed_codes
+
+def test_reset_interning_between_studies():
+    ResetInterning()
+    first = BuildConditions([ConditionResource("HP:0001", "Old name")])
+    also_first = BuildConditions([ConditionResource("HP:0001", "Other name")])
+    assert len(interning._other_concepts) == 1
+
+    # The next study starts without the last one's concepts, though the 
+    # last study's summaries keep theirs
+    ResetInterning()
+    assert interning._codeable_concepts == {}
+    assert interning._other_concepts == {}
+    assert "Old name" in first.observed_codes["HP:0001"]
+    assert "Other name" in also_first.observed_codes["HP:0001"]
+
+    second = BuildConditions([ConditionResource("HP:0001", "New name")])
+    assert interning._codeable_concepts["HP:0001"] is second.observed_codes["HP:0001"]
+
+    # Identical concepts are shared within a study
+    third = BuildConditions([ConditionResource("HP:0001", "New name")])
+    assert third.observed_codes["HP:0001"] is second.observed_codes["HP:0001"]
+
+def test_reset_interning_forgets_code_choices():
+    coding = [{"system": "https://example.org/fhir/data-dictionary/x", "code": "B"},
+              {"system": "http://purl.obolibrary.org/obo/hp.owl", "code": "A"}]
+    assert ChooseCode(coding)['code'] == "A"
+    assert len(summary._code_choices) > 0
+
+    ResetInterning()
+    assert len(summary._code_choices) == 0
+    assert ChooseCode(coding)['code'] == "A"
@@ -0,0 +1,122 @@
+"""
+NdjsonClient answers searches over a directory of NDJSON the way a FHIR server
+would, a page at a time.
+"""
+
+import gzip
+import json
+from urllib.parse import parse_qs
+
+from summfhir.ndjson_client import NdjsonClient, BuildMatcher
+
+def Patient(id, tag="TST", updated="2024-01-01T00:00:00Z", **extra):
+    resource = {
+        "resourceType": "Patient",
+        "id": id,
+        "meta": {
+            "lastUpdated": updated,
+            "tag": [{"system": "https://example.org/fhir/study", "code": tag}]
+        },
+        "identifier": [{"system": "https://example.org/fhir/patient", "value": f"pt-{id}"}]
+    }
+    resource.update(extra)
+    return resource
+
+def Matches(query, resources):
+    matches = BuildMatcher(parse_qs(query))
+    return [resource['id'] for resource in resources if matches(resource)]
+
+def test_matcher_tokens():
+    resources = [Patient("a"), Patient("b", tag="OTHER"), Patient("c")]
+    resources[2]['meta']['tag'].append({"code": "untagged"})
+
+    assert Matches("_tag=TST", resources) == ["a", "c"]
+    assert Matches("_tag=https://example.org/fhir/study|TST", resources) == ["a", "c"]
+    assert Matches("_tag=https://example.org/elsewhere|TST", resources) == []
+    assert Matches("_tag=TST,OTHER", resources) == ["a", "b", "c"]
+    assert Matches("_tag=|untagged", resources) == ["c"]
+    assert Matches("identifier=https://example.org/fhir/patient|pt-b", resources) == ["b"]
+
+def test_matcher_codes():
+    resources = [
+        {"id": "1", "code": {"coding": [{"system": "http://loinc.org", "code": "1234-5"}]}},
+        {"id": "2", "code": {"coding": [{"system": "http://snomed.info/sct", "code": "1234-5"}]}},
+        {"id": "3"}
+    ]
+    assert Matches("code=1234-5", resources) == ["1", "2"]
+    assert Matches("code=http://loinc.org|1234-5", resources) == ["1"]
+    assert Matches("code=http://loinc.org|", resources) == ["1"]
+
+def test_matcher_references_and_ids():
+    resources = [{"id": f"c{i}", "subject": {"reference": f"Patient/p{i % 3}"}} for i in range(6)]
+    assert Matches("_id=c1,c4,missing", resources) == ["c1", "c4"]
+    assert Matches("subject=Patient/p0,Patient/p2", resources) == ["c0", "c2", "c3", "c5"]
+    assert Matches("patient=Patient/p1", resources) == ["c1", "c4"]
+
+    # Every parameter must match
+    assert Matches("patient=Patient/p1&_id=c1,c2", resources) == ["c1"]
+
+def test_matcher_last_updated():
+    resources = [Patient(str(year), updated=f"{year}-06-01T00:00:00Z") for year in range(2020, 2025)]
+    assert Matches("_lastUpdated=gt2022-06-01T00:00:00Z", resources) == ["2023", "2024"]
+    assert Matches("_lastUpdated=ge2022-06-01T00:00:00Z", resources) == ["2022", "2023", "2024"]
+    assert Matches("_lastUpdated=lt2021-01-01", resources) == ["2020"]
+    assert Matches("_lastUpdated=2021", resources) == ["2021"]
+    assert Matches("_lastUpdated=ge2021-01-01&_lastUpdated=le2022-12-31", resources) == ["2021", "2022"]
+
+def test_matcher_ignores_unknown_params():
+    ignored = set()
+    matches = BuildMatcher(parse_qs("_tag=TST&gender=female&_count=10"), ignored)
+    assert matches(Patient("a"))
+    assert ignored == set(["gender"])
+
+def WritePatients(directory, ids):
+    """Spread across a plain and a gzipped file, with a blank line or two"""
+    half = len(ids) // 2
+    with (directory / "Patient.ndjson").open('wt') as outf:
+        for id in ids[:half]:
+            outf.write(json.dumps(Patient(id, tag="TST" if int(id) % 4 else "OTHER")) + "\n")
+        outf.write("\n")
+    with gzip.open(directory / "Patient_2.ndjson.gz", 'wt') as outf:
+        for id in ids[half:]:
+            outf.write(json.dumps(Patient(id, tag="TST" if int(id) % 4 else "OTHER")) + "\n\n")
+
+def Pages(client, query):
+    pages = []
+    while query is not None:
+        result = client.get(query, recurse=False)
+        assert result.success()
+        pages.append([entry['resource']['id'] for entry in result.entries])
+        query = None
+        for link in result.response.get('link', []):
+            if link['relation'] == "next":
+                query = link['url']
+    return pages
+
+def test_cursor_paging(tmp_path):
+    ids = [str(i) for i in range(1, 42)]
+    WritePatients(tmp_path, ids)
+    client = NdjsonClient(tmp_path, page_size=5)
+    tagged = [id for id in ids if int(id) % 4]
+
+    pages = Pages(client, "Patient?_tag=TST")
+    assert [id for page in pages for id in page] == tagged
+    assert all(len(page) == 5 for page in pages[:-1])
+
+    # As would reading the files straight through
+    assert [resource['id'] for resource in client.stream_resources("Patient?_tag=TST")] == tagged
+
+    pages = Pages(client, "Patient?_tag=TST&_count=7&_offset=3")
+    assert [id for page in pages for id in page] == tagged[3:]
+    assert len(pages[0]) == 7
+
+    result = client.get("Patient?_tag=TST&_summary=count")
+    assert result.response['total'] == len(tagged)
+
+def test_read_by_id(tmp_path):
+    ids = [str(i) for i in range(1, 12)]
+    WritePatients(tmp_path, ids)
+    client = NdjsonClient(tmp_path)
+    assert client.get("Patient/3").response['id'] == "3"
+    assert client.get("Patient/11").response['id'] == "11"
+    assert client.get("Patient/99").status_code == 404
@@ -0,0 +1,58 @@
+"""
+Source rows that don't fit the data dictionary are reported and counted, and
+summarization carries on without them.
+"""
+
+import json
+
+from summfhir import SetInputClient
+from summfhir.ndjson_client import NdjsonClient
+from summfhir.metrics import ResetMetrics
+from summfhir.study import StudySummary
+from summfhir.synthetic import SyntheticStudy
+
+def WriteResources(directory, resources):
+    directory.mkdir(parents=True, exist_ok=True)
+    for resource_type, items in resources.items():
+        with (directory / f"{resource_type}.ndjson").open('wt') as outf:
+            for resource in items:
+                outf.write(json.dumps(resource) + "\n")
+
+def SummarizeSource(input_dir):
+    client = NdjsonClient(input_dir)
+    SetInputClient(client)
+    research_study = client.get("ResearchStudy?_tag=SYNTH").entries[0]['resource']
+    study = StudySummary(research_study)
+    study.summarize_source()
+    return study
+
+def test_unexpected_components_are_counted(tmp_path):
+    study = SyntheticStudy(patients=20, condition_codes=5, tables=1, variables=6)
+    resources = dict([(resource_type, list(generated))
+                        for resource_type, generated in study.resources().items()])
+
+    rows = resources['Observation']
+    system = rows[0]['component'][0]['code']['coding'][0]['system']
+    rows[0]['component'].append({
+        "code": {"coding": [{"system": system, "code": "var-99"}]},
+        "valueString": "not in the dictionary"
+    })
+    rows[1]['component'].append({
+        "code": {"coding": [{"system": system, "code": "var-99"}]},
+        "valueString": "nor is this"
+    })
+    rows[2]['component'] = [component for component in rows[2]['component']
+                                if 'valueCodeableConcept' not in component]
+    rows[2]['component'].append({
+        "code": {"coding": [{"system": system, "code": "var-2"}]},
+        "valueCodeableConcept": {"coding": [{"system": "elsewhere", "code": "cat-0"}]}
+    })
+    WriteResources(tmp_path, resources)
+
+    metrics = ResetMetrics()
+    summarized = SummarizeSource(tmp_path)
+
+    # Every population parses each row into its own copy of the table
+    populations = len(summarized.enrollment)
+    assert metrics.counters["source components skipped"] == 2 * populations
+    assert metrics.counters["source values unparsed"] == populations
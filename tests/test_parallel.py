@@ -0,0 +1,78 @@
+"""
+Summarizing shards of the NDJSON in a pool of processes must give the very
+same summaries as reading it all in one.
+"""
+
+import gzip
+import json
+
+import pytest
+
+from summfhir import SetInputClient
+from summfhir.ndjson_client import NdjsonClient
+from summfhir.parallel import ParallelSummarizer, ShardFile
+from summfhir.columnar import UseColumnar
+from summfhir.study import StudySummary
+from summfhir.synthetic import SyntheticStudy
+
+def WriteResources(directory):
+    """A small synthetic study, with the Conditions split across a plain """
+    """and a gzipped file"""
+    study = SyntheticStudy(patients=150, condition_codes=30, tables=2, variables=6)
+    directory.mkdir(parents=True, exist_ok=True)
+    for resource_type, generated in study.resources().items():
+        resources = list(generated)
+        if resource_type == "Condition":
+            half = len(resources) // 2
+            with gzip.open(directory / "Condition_2.ndjson.gz", 'wt') as outf:
+                for resource in resources[half:]:
+                    outf.write(json.dumps(resource) + "\n")
+            resources = resources[:half]
+        with (directory / f"{resource_type}.ndjson").open('wt') as outf:
+            for resource in resources:
+                outf.write(json.dumps(resource) + "\n")
+    return study.tag
+
+def Summarize(input_dir, tag, workers=1, shard_size=None):
+    client = NdjsonClient(input_dir)
+    SetInputClient(client)
+    research_study = client.get(f"ResearchStudy?_tag={tag}").entries[0]['resource']
+    study = StudySummary(research_study, workers=workers)
+    if workers > 1:
+        # Small shards, so that every file is split between the workers
+        assert study.parallel is not None
+        study.parallel = ParallelSummarizer(client, workers, shard_size=shard_size)
+
+    study.summarize_patients()
+    study.summarize_conditions()
+    study.summarize_source()
+    summaries = dict([(population.id, population.return_summaries())
+                        for population in study.enrollment])
+    return json.dumps(summaries, sort_keys=True)
+
+def test_shards_cover_the_file(tmp_path):
+    path = tmp_path / "lines.ndjson"
+    lines = [json.dumps({"line": i, "padding": "x" * (i % 17)}) for i in range(500)]
+    path.write_text("\n".join(lines) + "\n")
+
+    shards = ShardFile(path, shard_size=1000)
+    assert len(shards) > 5
+    assert shards[0][1] == 0 and shards[-1][2] is None
+    content = path.read_bytes()
+    for before, after in zip(shards, shards[1:]):
+        assert before[2] == after[1]
+        assert content[before[2] - 1:before[2]] == b"\n"
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_parallel_matches_serial(tmp_path, columnar):
+    if columnar:
+        pytest.importorskip("numpy")
+    tag = WriteResources(tmp_path)
+    serial = Summarize(tmp_path, tag)
+
+    UseColumnar(columnar)
+    try:
+        parallel = Summarize(tmp_path, tag, workers=3, shard_size=4096)
+    finally:
+        UseColumnar(False)
+    assert parallel == serial
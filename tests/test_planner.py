@@ -0,0 +1,129 @@
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from summfhir.fetch import IncompleteSearch
+from summfhir.planner import (PlanMembershipFetch, MemberResources, Chunks, SCAN, LOOKUP, 
+                              CHUNK_SIZE, MAX_QUERY_LENGTH)
+
+class Result:
+    def __init__(self, response, status_code=200):
+        self.response = response
+        self.status_code = status_code
+        self.entries = response.get('entry', [])
+
+    def success(self):
+        return self.status_code < 300
+
+class StubServer:
+    """patients Patients with conditions Conditions each, all carrying the """
+    """tag. Searches are served page_size at a time, and any request """
+    """containing fail fails"""
+    def __init__(self, patients, conditions=2, page_size=50, counts=True, fail=None):
+        self.resources = {
+            "Patient": [{"resourceType": "Patient", "id": f"p{i}"} for i in range(patients)],
+            "Condition": [{"resourceType": "Condition", "id": f"c{i}-{j}", 
+                            "subject": {"reference": f"Patient/p{i}"}}
+                            for i in range(patients) for j in range(conditions)]
+        }
+        self.page_size = page_size
+        self.counts = counts
+        self.fail = fail
+        self.requests = []
+
+    def get(self, query, recurse=False):
+        self.requests.append(query)
+        if self.fail is not None and self.fail in query:
+            return Result({"resourceType": "OperationOutcome"}, 500)
+
+        url = urlparse(query)
+        resource_type = url.path.strip("/").split("/")[-1]
+        params = parse_qs(url.query)
+        matches = self.resources[resource_type]
+
+        if params.get('_summary') == ["count"]:
+            if not self.counts:
+                return Result({"resourceType": "OperationOutcome"}, 400)
+            return Result({"resourceType": "Bundle", "total": len(matches)})
+
+        if '_id' in params:
+            ids = set(params['_id'][0].split(","))
+            matches = [x for x in matches if x['id'] in ids]
+        if 'subject' in params:
+            subjects = set(params['subject'][0].split(","))
+            matches = [x for x in matches if x['subject']['reference'] in subjects]
+
+        offset = int(params.get('_offset', ["0"])[0])
+        bundle = {
+            "resourceType": "Bundle",
+            "entry": [{"resource": x} for x in matches[offset:offset + self.page_size]]
+        }
+        if offset + self.page_size < len(matches):
+            params['_offset'] = [str(offset + self.page_size)]
+            following = "&".join(f"{name}={value[0]}" for name, value in params.items())
+            bundle['link'] = [{"relation": "next", "url": f"{resource_type}?{following}"}]
+        return Result(bundle)
+
+def Members(count, step=1):
+    return [f"Patient/p{i}" for i in range(0, count * step, step)]
+
+def test_plan_small_group_looks_up():
+    server = StubServer(5000)
+    assert PlanMembershipFetch("Patient", "TST", Members(20), server)[0] == LOOKUP
+    assert PlanMembershipFetch("Condition", "TST", Members(20), server)[0] == LOOKUP
+
+def test_plan_whole_study_scans():
+    server = StubServer(500)
+    assert PlanMembershipFetch("Patient", "TST", Members(500), server)[0] == SCAN
+    assert PlanMembershipFetch("Condition", "TST", Members(500), server)[0] == SCAN
+
+def test_plan_without_counts_scans():
+    server = StubServer(5000, counts=False)
+    assert PlanMembershipFetch("Patient", "TST", Members(20), server)[0] == SCAN
+
+def test_plan_without_members():
+    assert PlanMembershipFetch("Patient", "TST", [], StubServer(10))[0] == LOOKUP
+
+def test_plan_local_input_scans():
+    class LocalInput(StubServer):
+        def stream_resources(self, query):
+            return []
+    assert PlanMembershipFetch("Patient", "TST", Members(1), LocalInput(5000))[0] == SCAN
+
+def test_chunks():
+    values = [f"Patient/p{i}" for i in range(250)]
+    chunks = list(Chunks(values, 100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 50]
+    assert sum(chunks, []) == values
+
+    chunks = list(Chunks(values, 100, 200))
+    assert sum(chunks, []) == values
+    assert all(len(",".join(chunk)) <= 200 for chunk in chunks)
+
+    # A value longer than the limit still gets a chunk of its own
+    assert list(Chunks(["x" * 10, "y"], 100, 5)) == [["x" * 10], ["y"]]
+
+@pytest.mark.parametrize("resource_type", ["Patient", "Condition"])
+def test_lookup_in_chunks(resource_type):
+    server = StubServer(20000, page_size=50)
+    members = Members(250, step=7)
+    resources = list(MemberResources(resource_type, "TST", members, "test", server))
+
+    lookups = [query for query in server.requests if "_summary" not in query]
+    assert len(lookups) > 1
+    for query in lookups:
+        values = parse_qs(urlparse(query).query).get('_id', parse_qs(urlparse(query).query).get('subject'))[0]
+        assert len(values.split(",")) <= CHUNK_SIZE
+        assert len(values) <= MAX_QUERY_LENGTH
+
+    if resource_type == "Patient":
+        assert sorted(f"Patient/{x['id']}" for x in resources) == sorted(members)
+    else:
+        assert len(resources) == 2 * len(members)
+        assert set(x['subject']['reference'] for x in resources) == set(members)
+
+def test_lookup_failure_raises():
+    # The second chunk fails, which mustn't quietly leave its members out
+    server = StubServer(20000, fail="p700")
+    with pytest.raises(IncompleteSearch):
+        list(MemberResources("Patient", "TST", Members(250, step=7), "test", server))
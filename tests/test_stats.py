@@ -0,0 +1,204 @@
+from collections import Counter
+import pickle
+import random
+
+import pytest
+
+from summfhir.stats import Moments, QuantileSketch, HyperLogLog, SpaceSaving
+
+def SkewedValues(count, distinct, seed=1):
+    rnd = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(distinct)]
+    return [f"value-{x}" for x in rnd.choices(range(distinct), weights=weights, k=count)]
+
+def Summarize(values, k=5, capacity=40):
+    summary = SpaceSaving(k, capacity)
+    for value in values:
+        summary.add(value)
+    return summary
+
+def AssertBounds(summary, values):
+    """Every count is an overestimate by no more than its error, and """
+    """nothing left uncounted was seen more often than the floor"""
+    truth = Counter(values)
+    floor = summary.floor()
+    for value, count in summary.counts.items():
+        assert count - summary.errors[value] <= truth[value] <= count
+    for value, seen in truth.items():
+        if value not in summary.counts:
+            assert seen <= floor
+        if seen > len(values) / summary.capacity:
+            assert value in summary.counts
+
+    # The values reported are certainly ahead of anything left out
+    for value, count, error in summary.top():
+        assert count - error > floor
+        assert all(truth[value] > seen for other, seen in truth.items() 
+                    if other not in summary.counts)
+
+def test_exact_within_capacity():
+    values = SkewedValues(1000, 30)
+    summary = Summarize(values)
+    truth = Counter(values)
+
+    assert summary.floor() == 0
+    assert summary.counts == truth
+    assert [(value, count) for value, count, error in summary.top()] == \
+        sorted(truth.items(), key=lambda item: (-item[1], item[0]))[0:5]
+
+def test_bounds():
+    values = SkewedValues(20000, 2000)
+    AssertBounds(Summarize(values), values)
+
+def test_merge_bounds():
+    values = SkewedValues(20000, 2000)
+    for shards in [2, 3, 7]:
+        size = -(-len(values) // shards)
+        parts = [values[i:i + size] for i in range(0, len(values), size)]
+        merged = Summarize(parts[0])
+        for part in parts[1:]:
+            merged.merge(Summarize(part))
+
+        assert len(merged.counts) <= merged.capacity
+        AssertBounds(merged, values)
+
+def test_merge_with_empty():
+    values = SkewedValues(5000, 500)
+    summary = Summarize(values)
+    before = summary.top()
+
+    summary.merge(SpaceSaving(5, 40))
+    assert summary.top() == before
+
+    empty = SpaceSaving(5, 40)
+    empty.merge(Summarize(values))
+    assert empty.top() == before
+
+def test_pickle():
+    values = SkewedValues(5000, 500)
+    summary = Summarize(values)
+    restored = pickle.loads(pickle.dumps(summary))
+    assert restored.top() == summary.top()
+
+    # The counters still work once restored
+    for value in values:
+        summary.add(value)
+        restored.add(value)
+    assert restored.top() == summary.top()
+    assert restored.floor() == summary.floor()
+
+def Values(count, seed=1):
+    """Mixed signs and magnitudes, with a few zeros and repeats"""
+    rnd = random.Random(seed)
+    values = [rnd.gauss(0, 1) * 10 ** rnd.randint(-5, 5) for i in range(count)]
+    return values + [0.0, -0.0, values[0], values[1]]
+
+def Moment(values):
+    moments = Moments()
+    for x in values:
+        moments.add(x)
+    return moments
+
+def MomentState(moments):
+    return (moments.count, moments.sum.value(), moments.squares.value(), 
+            moments.mean(), moments.variance())
+
+def test_moments_merge():
+    values = Values(3000)
+    for split in [0, 1, 1000, len(values)]:
+        merged = Moment(values[:split])
+        merged.merge(Moment(values[split:]))
+        assert MomentState(merged) == MomentState(Moment(values))
+
+    # Exact sums don't care which order the parts come in
+    reversed_parts = Moment(values[1000:])
+    reversed_parts.merge(Moment(values[:1000]))
+    assert MomentState(reversed_parts) == MomentState(Moment(values))
+
+def test_moments_remove():
+    values = Values(3000)
+    moments = Moment(values)
+    for x in Values(500, seed=2):
+        moments.add(x)
+    for x in Values(500, seed=2):
+        moments.remove(x)
+    assert MomentState(moments) == MomentState(Moment(values))
+
+    for x in values:
+        moments.remove(x)
+    assert MomentState(moments) == (0, 0.0, 0.0, None, None)
+
+def Sketch(values):
+    sketch = QuantileSketch(0.01)
+    for x in values:
+        sketch.add(x)
+    return sketch
+
+def SketchState(sketch):
+    return (sketch.count, sketch.zeros, sketch.positive, sketch.negative, 
+            sketch.min, sketch.max)
+
+def test_quantile_sketch_merge():
+    values = Values(3000)
+    for split in [0, 1, 1000, len(values)]:
+        merged = Sketch(values[:split])
+        merged.merge(Sketch(values[split:]))
+        assert SketchState(merged) == SketchState(Sketch(values))
+
+    with pytest.raises(ValueError):
+        Sketch(values).merge(QuantileSketch(0.05))
+
+def test_quantile_sketch_remove():
+    values = Values(3000)
+    sketch = Sketch(values)
+
+    # Removing values inside the range restores everything, extremes included
+    inside = [x for x in Values(500, seed=2) if min(values) < x < max(values)]
+    for x in inside:
+        sketch.add(x)
+    for x in inside:
+        sketch.remove(x)
+    assert SketchState(sketch) == SketchState(Sketch(values))
+
+    # Removing an extreme leaves an estimate of the next one, within accuracy
+    ordered = sorted(values)
+    sketch.remove(ordered[0])
+    sketch.remove(ordered[-1])
+    assert sketch.min == pytest.approx(ordered[1], rel=0.01)
+    assert sketch.max == pytest.approx(ordered[-2], rel=0.01)
+    for q in [0.1, 0.5, 0.9]:
+        truth = ordered[1:-1][int(q * (len(ordered) - 3))]
+        assert sketch.quantile(q) == pytest.approx(truth, rel=0.01, abs=1e-300)
+
+    for x in ordered[1:-1]:
+        sketch.remove(x)
+    assert SketchState(sketch) == (0, 0, {}, {}, None, None)
+
+def Distinct(values, precision=12):
+    hll = HyperLogLog(precision)
+    hll.add_many(values)
+    return hll
+
+def test_hyperloglog_merge():
+    values = [f"value-{i}" for i in range(20000)]
+    merged = Distinct(values[:5000])
+    merged.merge(Distinct(values[3000:]))
+    assert merged.registers == Distinct(values).registers
+
+    # Nor does it matter how often a value is seen, or what order they come in
+    assert Distinct(values + values[:100]).registers == Distinct(values[::-1]).registers
+
+    with pytest.raises(ValueError):
+        merged.merge(HyperLogLog(14))
+
+def test_hyperloglog_estimate():
+    assert Distinct([]).estimate() == 0
+    for count in [10, 1000, 50000]:
+        hll = Distinct([f"value-{i}" for i in range(count)])
+        assert abs(hll.estimate() - count) <= 4 * hll.error() * count + 1
+
+def test_hyperloglog_pickle():
+    hll = Distinct([f"value-{i}" for i in range(1000)])
+    restored = pickle.loads(pickle.dumps(hll))
+    assert restored.registers == hll.registers
+    assert restored.estimate() == hll.estimate()
@@ -0,0 +1,223 @@
+from urllib.parse import unquote
+from copy import deepcopy
+
+from summfhir.upload import (Canonical, ContentHash, ExistingSummaries, SingleUploader,
+                                BundleUploader, ConditionalUrl)
+
+def BuildSummary(value="group-1.HP:0001", count=12):
+    return {
+        "resourceType": "Observation",
+        "id": "1234",
+        "meta": {
+            "versionId": "3",
+            "lastUpdated": "2024-01-01T00:00:00Z",
+            "tag": [{"system": "https://example.org/fhir/study", "code": "TST"}]
+        },
+        "identifier": [{
+            "system": "https://example.org/fhir/condition/summary",
+            "value": value
+        }],
+        "status": "final",
+        "valueCodeableConcept": {
+            "coding": [{"system": "http://purl.obolibrary.org/obo/hp.owl", "code": "HP:0001"}]
+        },
+        "component": [{
+            "code": {"coding": [{"code": "count"}]},
+            "valueInteger": count
+        }, {
+            "code": {"coding": [{"code": "mean"}]},
+            "valueQuantity": {"value": 70.0, "unit": "kg"}
+        }]
+    }
+
+def test_canonical_drops_empty_elements():
+    value = {
+        "a": "",
+        "b": None,
+        "c": [],
+        "d": {},
+        "e": {"f": [None, "", {}], "g": {"h": ""}},
+        "i": [1, "", {"j": None}, "k"],
+        "l": False,
+        "m": 0
+    }
+    assert Canonical(value) == {"i": [1, "k"], "l": False, "m": 0}
+
+def test_canonical_whole_decimals():
+    assert Canonical({"value": 70.0}) == {"value": 70}
+    assert type(Canonical(70.0)) is int
+    assert Canonical(70.5) == 70.5
+    assert Canonical(True) is True
+
+def test_content_hash_ignores_what_the_server_adds():
+    built = BuildSummary()
+    del built['id']
+    del built['meta']
+
+    # As the server returns it: its own id and meta, keys in another order,
+    # whole decimals as integers and nothing empty
+    stored = BuildSummary()
+    stored['component'][1]['valueQuantity']['value'] = 70
+    stored['text'] = {"status": "generated", "div": "<div/>"}
+    stored = dict(reversed(list(stored.items())))
+
+    built['note'] = []
+    assert ContentHash(built) == ContentHash(stored)
+
+def test_content_hash_sees_changes():
+    summary = BuildSummary()
+    assert ContentHash(summary) != ContentHash(BuildSummary(count=13))
+    assert ContentHash(summary) != ContentHash(BuildSummary(value="group-2.HP:0001"))
+
+    changed = deepcopy(summary)
+    changed['component'][1]['valueQuantity']['value'] = 70.5
+    assert ContentHash(summary) != ContentHash(changed)
+
+class Result:
+    def __init__(self, response, status_code=200):
+        self.response = response
+        self.status_code = status_code
+        self.entries = response.get('entry', [])
+
+    def success(self):
+        return self.status_code < 300
+
+class SummaryServer:
+    """Serves the summaries two to a page, failing the page at fail_at"""
+    def __init__(self, summaries, fail_at=None):
+        self.summaries = summaries
+        self.fail_at = fail_at
+
+    def get(self, query, recurse=False):
+        offset = 0
+        if "offset=" in query:
+            offset = int(query.split("offset=")[1])
+        if offset == self.fail_at:
+            return Result({"resourceType": "OperationOutcome"}, 500)
+
+        page = self.summaries[offset:offset + 2]
+        bundle = {"resourceType": "Bundle", "entry": [{"resource": x} for x in page]}
+        if offset + 2 < len(self.summaries):
+            bundle['link'] = [{"relation": "next", "url": f"http://fhir.test/fhir?offset={offset + 2}"}]
+        return Result(bundle)
+
+def test_existing_summaries():
+    summaries = [BuildSummary(value=f"group-1.HP:000{i}") for i in range(5)]
+    summaries.append(BuildSummary(value="group-1.HP:0003"))
+    summaries.append({"resourceType": "Observation", "identifier": []})
+
+    existing = ExistingSummaries("TST", SummaryServer(summaries))
+    system = "https://example.org/fhir/condition/summary"
+    assert len(existing) == 5
+    assert existing[f"{system}|group-1.HP:0001"] == ContentHash(summaries[1])
+
+    # Found twice, so it must be loaded again whatever it holds
+    assert existing[f"{system}|group-1.HP:0003"] is None
+
+def test_existing_summaries_incomplete():
+    summaries = [BuildSummary(value=f"group-1.HP:000{i}") for i in range(5)]
+    assert ExistingSummaries("TST", SummaryServer(summaries, fail_at=2)) is None
+
+def test_existing_summaries_first_page_failed():
+    # Had the failure looked like an empty study, everything would be "created"
+    summaries = [BuildSummary(value=f"group-1.HP:000{i}") for i in range(5)]
+    assert ExistingSummaries("TST", SummaryServer(summaries, fail_at=0)) is None
+
+class StoringClient:
+    """Keeps summaries by identifier value. A conditional POST leaves an """
+    """existing summary as it is, as If-None-Exist does"""
+    def __init__(self):
+        self.stored = {}
+        self.methods = []
+
+    def post(self, resource, data, identifier=None, identifier_system=None, identifier_type=None):
+        self.methods.append("POST")
+        if identifier not in self.stored:
+            self.stored[identifier] = data
+        return {"status_code": 201, "request_url": resource, "response": data}
+
+    def put(self, resource, data):
+        self.methods.append("PUT")
+        system, value = resource.split("identifier=")[1].split("|")
+        self.stored[unquote(value)] = data
+        return {"status_code": 200, "request_url": resource, "response": data}
+
+def test_single_uploader_updates_with_put():
+    client = StoringClient()
+    uploader = SingleUploader(client=client, retry_delay=0)
+    uploader.add(BuildSummary(count=12))
+    uploader.add(BuildSummary(count=13))
+    assert client.stored["group-1.HP:0001"]['component'][0]['valueInteger'] == 12
+
+    uploader.add(BuildSummary(count=14), update=True)
+    assert client.stored["group-1.HP:0001"]['component'][0]['valueInteger'] == 14
+    assert client.methods == ["POST", "POST", "PUT"]
+    assert uploader.loaded == 3
+
+def test_conditional_url_escapes_the_identifier():
+    url = ConditionalUrl("https://example.org/summary", "group 1|HP:0001")
+    assert url == "Observation?identifier=https%3A%2F%2Fexample.org%2Fsummary|group%201%7CHP%3A0001"
+
+class BundleServer:
+    """Answers each entry of a batch with the next status scripted for its """
+    """identifier value (201 once the script runs out). A scripted bundle """
+    """status is used for the whole Bundle instead, with no entries"""
+    def __init__(self, statuses=None, bundle_statuses=None):
+        self.statuses = dict([(value, list(script)) for value, script in (statuses or {}).items()])
+        self.bundle_statuses = list(bundle_statuses or [])
+        self.sent = []
+
+    def post(self, resource, bundle):
+        values = [unquote(entry['request']['url'].split("|")[-1]) for entry in bundle['entry']]
+        self.sent.append(values)
+        if len(self.bundle_statuses) > 0:
+            status = self.bundle_statuses.pop(0)
+            return {"status_code": status, "request_url": resource,
+                    "response": {"resourceType": "OperationOutcome"}}
+
+        entries = []
+        for value in values:
+            script = self.statuses.get(value, [])
+            status = script.pop(0) if len(script) > 0 else 201
+            entries.append({"response": {"status": f"{status} Whatever"}})
+        return {"status_code": 200, "request_url": resource,
+                "response": {"resourceType": "Bundle", "entry": entries}}
+
+def Upload(server, values, retry_count=5, bundle_type="batch"):
+    uploader = BundleUploader(bundle_type=bundle_type, batch_size=10, client=server, 
+                                retry_count=retry_count, retry_delay=0)
+    for value in values:
+        uploader.add(BuildSummary(value=value))
+    uploader.flush()
+    return uploader
+
+def test_bundle_resends_only_retryable_entries():
+    server = BundleServer({"b": [503], "c": [400], "d": [429, 409]})
+    uploader = Upload(server, ["a", "b", "c", "d", "e"])
+    assert server.sent == [["a", "b", "c", "d", "e"], ["b", "d"], ["d"]]
+    assert (uploader.loaded, uploader.failed) == (4, 1)
+
+def test_bundle_gives_up_after_retry_count():
+    server = BundleServer({"b": [503] * 10, "c": [500, 201]})
+    uploader = Upload(server, ["a", "b", "c"], retry_count=3)
+    assert server.sent == [["a", "b", "c"], ["b", "c"], ["b"]]
+    assert (uploader.loaded, uploader.failed) == (2, 1)
+
+def test_bundle_failures_resend_everything():
+    # A transaction which fails for a retryable reason goes again whole
+    server = BundleServer(bundle_statuses=[409, 503])
+    uploader = Upload(server, ["a", "b"], bundle_type="transaction")
+    assert server.sent == [["a", "b"]] * 3
+    assert (uploader.loaded, uploader.failed) == (2, 0)
+
+    # Otherwise nothing in it is worth sending again
+    server = BundleServer(bundle_statuses=[400])
+    uploader = Upload(server, ["a", "b"], bundle_type="transaction")
+    assert server.sent == [["a", "b"]]
+    assert (uploader.loaded, uploader.failed) == (0, 2)
+
+def test_bundles_fill_to_batch_size():
+    server = BundleServer({"v3": [503]})
+    uploader = Upload(server, [f"v{i}" for i in range(25)])
+    assert [len(sent) for sent in server.sent] == [10, 1, 10, 5]
+    assert (uploader.loaded, uploader.failed) == (25, 0)